@@ -0,0 +1,72 @@
+"""
+Payload size and encode time for a 100-movie /movies genre response.
+
+Compares what /movies used to send (every TMDB field through Flask's
+default JSON encoder) with the projected fields the CLI asks for, encoded by
+responses.dumps() and compressed the way install_compression() does.
+
+usage: python benchmarks/bench_movies_payload.py
+"""
+import gzip
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "microservices"))
+import responses
+
+ROUNDS = 2000
+
+
+def sample_movies(count=100):
+    return [{
+        "adult": False,
+        "backdrop_path": f"/backdrop{i:05d}abcdefghijklmnop.jpg",
+        "genre_ids": [18, 80, 53],
+        "id": 238 + i,
+        "original_language": "en",
+        "original_title": f"The Sample Movie Number {i}",
+        "overview": ("Spanning the years 1945 to 1955, a chronicle of the fictional Italian-American "
+                     "crime family. When organized crime family patriarch Vito Corleone barely survives "
+                     "an attempt on his life, his youngest son steps in to take care of the would-be "
+                     "killers, launching a campaign of bloody revenge."),
+        "popularity": 123.456 + i,
+        "poster_path": f"/poster{i:05d}abcdefghijklmnop.jpg",
+        "release_date": "1972-03-14",
+        "title": f"The Sample Movie Number {i}",
+        "video": False,
+        "vote_average": 8.7,
+        "vote_count": 21000 + i,
+    } for i in range(count)]
+
+
+def flask_default_dumps(data):
+    # Flask's DefaultJSONProvider outside debug mode
+    return json.dumps(data, ensure_ascii=True, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def report(label, encode):
+    body = encode()
+    seconds = timeit.timeit(encode, number=ROUNDS) / ROUNDS
+    print(f"{label:<44} {len(body):>8} bytes {seconds * 1e6:>9.1f} us/request")
+    return len(body), seconds
+
+
+def main():
+    movies = sample_movies()
+    fields = responses.parse_fields("title,release_date,vote_average")
+    encoder = "orjson" if responses.orjson is not None else "json (orjson not installed)"
+    print(f"encoder: {encoder}\n")
+
+    base_size, base_time = report("full payload, Flask default encoder", lambda: flask_default_dumps(movies))
+    report("full payload, responses.dumps", lambda: responses.dumps(movies))
+    report("fields=title,release_date,vote_average", lambda: responses.dumps(responses.project(movies, fields)))
+    size, seconds = report("projected + gzip", lambda: gzip.compress(
+        responses.dumps(responses.project(movies, fields)), compresslevel=responses.GZIP_LEVEL))
+    print(f"\nprojected + gzip vs before: {base_size / size:.1f}x smaller, "
+          f"{base_time / seconds:.1f}x encode speed (including compression)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Memory per recommendation candidate, before and after columnar pools.
+
+Measures with tracemalloc what the recommendation service holds for
+CANDIDATES cached candidates when each is kept as:
+ - the full TMDB result dict (what /movies returned before `fields=`)
+ - an {id, title} dict (the projected response)
+ - a CandidatePool row (ids, scores, genre bitmask, title)
+and the transient (id, title) tuples plus dedupe set that get_recommendations()
+used to build on every request.
+
+usage: python benchmarks/candidate_pool_memory.py [CANDIDATES]
+"""
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "microservices"))
+import candidate_pool
+
+GENRES = [18, 28, 35, 80, 53, 878, 27, 10749, 16, 99, 12, 14]
+# Distinct movies; the rest of the candidates repeat them across genre pools
+DISTINCT_RATIO = 0.5
+
+
+def tmdb_movies(count):
+    distinct = max(1, int(count * DISTINCT_RATIO))
+    return [{
+        "adult": False,
+        "backdrop_path": f"/backdrop{i % distinct:07d}abcdefghijklmnop.jpg",
+        "genre_ids": [GENRES[i % len(GENRES)], GENRES[(i * 7) % len(GENRES)]],
+        "id": 1000 + i % distinct,
+        "original_language": "en",
+        "original_title": f"Sample Movie Number {i % distinct}",
+        "overview": ("A chronicle of the fictional family at the centre of the story, told over a decade "
+                     "of triumphs, betrayals and reconciliations."),
+        "popularity": 12.5 + i % 97,
+        "poster_path": f"/poster{i % distinct:07d}abcdefghijklmnop.jpg",
+        "release_date": "1999-10-15",
+        "title": f"Sample Movie Number {i % distinct}",
+        "video": False,
+        "vote_average": 5 + (i % 50) / 10,
+        "vote_count": 100 + i,
+    } for i in range(count)]
+
+
+def measure(build):
+    """Return (bytes held by build()'s result, the result)"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+def main(argv):
+    count = int(argv[0]) if argv else 100_000
+    # Source data is built outside the measurements and decoded fresh, as from a response body
+    payload = json.dumps(tmdb_movies(count))
+    projected_payload = json.dumps([{"id": m["id"], "title": m["title"]} for m in json.loads(payload)])
+    candidates_payload = json.dumps([{k: m[k] for k in ("id", "title", "vote_average", "genre_ids")}
+                                     for m in json.loads(payload)])
+
+    full_bytes, _ = measure(lambda: json.loads(payload))
+    projected_bytes, projected = measure(lambda: json.loads(projected_payload))
+    tuples_bytes, _ = measure(lambda: set((m["id"], m["title"]) for m in projected))
+
+    # Decoded inside the measurement: the pool keeps the title strings once the dicts are gone
+    pool_bytes, pool = measure(lambda: candidate_pool.CandidatePool.from_movies(json.loads(candidates_payload)))
+    column_bytes = sum(getattr(pool, name).nbytes for name in candidate_pool.CandidatePool.__slots__)
+
+    print(f"{count} candidates ({int(count * DISTINCT_RATIO)} distinct titles)\n")
+    for label, size in (
+        ("full TMDB dicts", full_bytes),
+        ("projected {id, title} dicts", projected_bytes),
+        ("per-request (id, title) tuples + set", tuples_bytes),
+        ("CandidatePool (columns + titles)", pool_bytes),
+        ("CandidatePool columns only (title pointers)", column_bytes),
+    ):
+        print(f"{label:<48} {size / count:>8.1f} bytes/candidate")
+    print(f"\nCandidatePool vs full dicts: {full_bytes / pool_bytes:.1f}x smaller; "
+          f"vs projected dicts: {projected_bytes / pool_bytes:.1f}x smaller")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,19 +1,39 @@
 import sqlite3
-import bcrypt
-import requests
 import os
+import sys
 from urllib.parse import quote
 from dotenv import load_dotenv
 from flask import Flask
+import requests
 import time
 import html
+import json
+
+# Before the shared helpers, some of which (auth) read their settings on import
+load_dotenv()
+
+# Shared helpers (upstream calls, tracing) live alongside the microservices
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "microservices"))
+import auth
+import rate_budget
+import rating_aggregates
+import review_query
+import tracing
+import upstream
 
 MICROSERVICE_SEARCH_URL = "http://localhost:8080/movies"
 MICROSERVICE_RECOMMENDATION_URL = "http://localhost:8083/recommendations"
+MICROSERVICE_COMMUNITY_TOP_URL = "http://localhost:8083/community/top"
 MICROSERVICE_WHERE_TO_WATCH_URL = "http://localhost:8082/watch"
 MICROSERVICE_TRIVIA_URL = "http://localhost:8081/trivia"
+MICROSERVICE_GENRES_URL = "http://localhost:8080/genres"
+
+# Only the fields the CLI prints are requested from the movie search service
+SEARCH_RESULT_FIELDS = "id,title,release_date,genre_ids"
+GENRE_LIST_FIELDS = "title,release_date,vote_average"
+# Identifies this CLI session to the services (prefetch cancellation, admission control)
+CLIENT_ID = f"cli:{os.getpid()}"
 
-load_dotenv()
 TMDB_API_KEY = os.getenv("TMDB_API_KEY")
 
 if not TMDB_API_KEY:
@@ -30,15 +50,14 @@ app = Flask(__name__)
 def fetch_movie_from_tmdb(title):
     """
     param: title:- Movie title
-    Fetch movie details from the TMDB API for a user to review
+    Fetch movie details for a user to review (served from the movie search
+    service's local title index when possible)
     """
-    url = f"https://api.themoviedb.org/3/search/movie?api_key={TMDB_API_KEY}&query={title}"
-    response = requests.get(url)
-    data = response.json()
+    results = fetch_movie_data(title)
 
-    if data["results"]:
-        movie = data["results"][0]
-        return movie["id"], movie["title"], movie["release_date"][:4]
+    if results:
+        movie = results[0]
+        return movie["id"], movie["title"], movie.get("release_date", "")[:4], movie.get("genre_ids", [])
     
     return None
 
@@ -65,7 +84,9 @@ def fetch_movie_data(title):
     """
     Fetch movie search results from the microservice
     """
-    response = requests.get(MICROSERVICE_SEARCH_URL, params={"title": title.strip()})
+    response = upstream.get("movie_search", "/movies", MICROSERVICE_SEARCH_URL,
+                            params={"title": title.strip(), "fields": SEARCH_RESULT_FIELDS},
+                            headers={"X-Client-Id": CLIENT_ID})
     if response.status_code != 200:
         return None
     return response.json() or None
@@ -73,10 +94,10 @@ def fetch_movie_data(title):
 
 def fetch_movie_details(movie_id):
     """
-    Fetch detailed movie info from TMDB
+    Fetch detailed movie info (with credits) through the movie search
+    service, which usually has it prefetched
     """
-    details_url = f"https://api.themoviedb.org/3/movie/{movie_id}?api_key={TMDB_API_KEY}&append_to_response=credits"
-    response = requests.get(details_url)
+    response = upstream.get("movie_search", "/movies/{id}", f"{MICROSERVICE_SEARCH_URL}/{movie_id}")
     return response.json() if response.status_code == 200 else {}
 
 
@@ -91,7 +112,8 @@ def display_movie_details(details_data, movie_id):
     director = next((crew["name"] for crew in details_data.get("credits", {}).get("crew", []) if crew["job"] == "Director"), "N/A")
 
     title_encoded = quote(title)
-    response = requests.get(f"{MICROSERVICE_WHERE_TO_WATCH_URL}/{title_encoded}/{movie_id}")
+    response = upstream.get("where_to_watch", "/watch/{title}/{movie_id}",
+                            f"{MICROSERVICE_WHERE_TO_WATCH_URL}/{title_encoded}/{movie_id}")
     if response.status_code == 200:
         streaming_data = response.json()
         streaming_platforms = streaming_data.get("services", [])
@@ -99,6 +121,8 @@ def display_movie_details(details_data, movie_id):
             platforms_str = ", ".join(streaming_platforms)
         else:
             platforms_str = "Not Available"
+        if streaming_data.get("stale"):
+            platforms_str += " (last known; live data is unavailable)"
     else:
         return {"Error": "Movie not found on streaming services"}
 
@@ -140,20 +164,23 @@ def search_for_movie_from_tmdb(title):
     display_movie_details(details_data, movie_id)
 
 
+# Genre name (lowercase) -> TMDB id, fetched once per session from the movie search service
+genre_ids = {}
+
+
 def get_genre_id(genre_name):
     """
     param: genre_name:- genre name
-    Fetch all the genre ids from TMDB and return a specified genre's ID
+    Return a specified genre's ID from the movie search service's genre catalog
     """
-    url = f"https://api.themoviedb.org/3/genre/movie/list?api_key={TMDB_API_KEY}&language=en-US"
-    response = requests.get(url)
-    data = response.json()
+    if not genre_ids:
+        response = upstream.get("movie_search", "/genres", MICROSERVICE_GENRES_URL)
+        if response.status_code != 200:
+            return None
+        for genre in response.json():
+            genre_ids[genre["name"].lower()] = genre["id"]
 
-    for genre in data["genres"]:
-        if genre["name"].lower() == genre_name.lower():
-            return genre["id"]
-        
-    return None
+    return genre_ids.get(genre_name.lower())
 
 
 def print_genre_list(top_movies, genre_name, num_of_movies):
@@ -184,12 +211,34 @@ def fetch_genre_from_tmdb(genre_name, num_of_movies):
         print("Genre not found. Please check your entry and try again.")
         return []
     
-    response = requests.get(MICROSERVICE_SEARCH_URL, params={"genre": genre_id, "num_of_movies": num_of_movies})
-    if response.status_code == 200:
-        all_movies = response.json()
-        print_genre_list(all_movies, genre_name, num_of_movies)
-    else:
-        print(f"Error fetching movies: {response.status_code} - {response.text}")
+    # Streamed as NDJSON so rows print as each page of results arrives
+    response = upstream.get("movie_search", "/movies", MICROSERVICE_SEARCH_URL, stream=True,
+                            params={"genre": genre_id, "num_of_movies": num_of_movies,
+                                    "fields": GENRE_LIST_FIELDS, "stream": 1})
+    with response:
+        if response.status_code == 200:
+            # The stream ends with a status line covering every page
+            status = {}
+
+            def movies():
+                for line in response.iter_lines():
+                    if line:
+                        movie = json.loads(line)
+                        if "_status" in movie:
+                            status.update(movie["_status"])
+                        else:
+                            yield movie
+
+            try:
+                print_genre_list(movies(), genre_name, num_of_movies)
+            except requests.RequestException:
+                status["complete"] = False
+            if not status.get("complete"):
+                print("Note: the list was cut short because some results couldn't be loaded.")
+            if response.headers.get("X-Data-Stale") or status.get("stale"):
+                print("Note: TMDB is unavailable, so this list may be out of date.")
+        else:
+            print(f"Error fetching movies: {response.status_code} - {response.text}")
 
 
 def init_movie_db():
@@ -213,12 +262,24 @@ def init_movie_db():
                 movie_id INTEGER,
                 rating INTEGER,
                 review_text TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users(id),
                 FOREIGN KEY (movie_id) REFERENCES movies(id)
             )""")
 
+        # Title lookups during bulk review import
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_movies_title ON movies (title COLLATE NOCASE)")
+
         conn.commit()
 
+        # Community rating aggregates, kept in step with the reviews table
+        rating_aggregates.init_db(conn)
+        # Genres of older reviewed movies, where the title index has them
+        rating_aggregates.link_missing_genres(conn)
+
+        # Review dates and the indexes behind paged review listing
+        review_query.init_db(conn)
+
 
 # Initialize movie database for reviews
 init_movie_db()
@@ -242,15 +303,19 @@ def init_user_db():
 # Initialize user database for authetication
 init_user_db()
 
+# Signed token sent to the microservices on behalf of the logged in user
+session_token = None
+
 
 def signup():
     """
     Handles the signup and account creation for a new user
     """
+    global session_token
     username = input("Enter username: ")
     password = input("Enter password: ")
 
-    hashed_password = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+    hashed_password = auth.hash_password(password)
 
     with sqlite3.connect("users.db") as conn:
         cursor = conn.cursor()
@@ -258,33 +323,28 @@ def signup():
         conn.commit()
         print("Sign up successful!")
 
+    user_id = cursor.lastrowid
+    session_token = auth.issue_token(user_id)
+    return user_id
+
 
 def login():
     """
     Logs in user by checking entered username and password by decryption
+    (re-hashing the stored password if the configured bcrypt cost changed)
     """
+    global session_token
     while True:
         username = input("Enter username: ")
-        password = input("Enter password: ").encode("utf-8")
-        
-        with sqlite3.connect("users.db") as conn:
-            cursor = conn.cursor()
-
-            # Fetch the stored hashed password for the given username
-            cursor.execute("SELECT id, password FROM users WHERE username = ?", (username,))
-            user = cursor.fetchone()
+        password = input("Enter password: ")
 
-            if user:
-                user_id, stored_hashed_password = user
-                stored_hashed_password = stored_hashed_password
-
-                if bcrypt.checkpw(password, stored_hashed_password):
-                    print("Login successful")
-                    return user_id
-                else:
-                    print("Invalid login credentials. Please try again.")
-            else:    
-                print("Invalid login credentials. Please try again.")
+        user_id = auth.authenticate(username, password, "users.db")
+        if user_id is not None:
+            print("Login successful")
+            session_token = auth.issue_token(user_id)
+            return user_id
+        else:
+            print("Invalid login credentials. Please try again.")
    
 
 def login_or_signup():
@@ -329,6 +389,8 @@ def main_menu():
     print("6. Random Trivia")
     print("7. Help")
     print("8. Quit")
+    # Added after Help and Quit so their numbers stay the same
+    print("9. Community Top Movies")
 
 
 def add_review(user_id):
@@ -348,7 +410,7 @@ def add_review(user_id):
                 print("Movie not found in TMDB.")
                 return
             
-            tmdb_id, title, release_year = movie_data
+            tmdb_id, title, release_year, genre_ids = movie_data
 
             # Check if movie exists in database
             cursor.execute("SELECT id FROM movies WHERE tmdb_id = ?", (tmdb_id,))
@@ -361,12 +423,14 @@ def add_review(user_id):
                 movie_id = cursor.lastrowid
             else:
                 movie_id = movie[0]
+            rating_aggregates.link_genres(conn, movie_id, genre_ids)
 
             rating = float(input("Enter rating (1.0-10.0): "))
             review_text = input("Enter your review: ")
 
             cursor.execute("INSERT INTO reviews (user_id, movie_id, rating, review_text) VALUES (?, ?, ?, ?)",
                            (user_id, movie_id, rating, review_text))
+            rating_aggregates.record_review(conn, movie_id, rating)
             conn.commit()
 
             print("Review added successfully!")
@@ -388,7 +452,7 @@ def delete_review(review_id, user_id):
     with sqlite3.connect("movies.db") as conn:
         cursor = conn.cursor()
 
-        cursor.execute("SELECT id FROM reviews WHERE id = ? AND user_id = ?", (review_id, user_id))
+        cursor.execute("SELECT id, movie_id, rating FROM reviews WHERE id = ? AND user_id = ?", (review_id, user_id))
         review = cursor.fetchone()
 
         if not review:
@@ -398,6 +462,7 @@ def delete_review(review_id, user_id):
             choice = input("Are you sure you would like to permanently delete this review? [Y] [N]: ")
             if choice.upper() == "Y":
                 cursor.execute("DELETE FROM reviews WHERE id = ?", (review_id,))
+                rating_aggregates.remove_review(conn, review[1], review[2])
                 conn.commit()
                 print("✅ Review deleted successfully!")
                 return
@@ -408,52 +473,93 @@ def delete_review(review_id, user_id):
                 print("Enter a valid input.\n")
 
 
+def review_filters():
+    """
+    Ask how to sort and filter the review list; every prompt can be skipped
+    Return keyword arguments for review_query.query_reviews()
+    """
+    filters = {"sort": "rating" if input("Sort by [D]ate or [R]ating (press Enter for date): ").upper() == "R"
+               else "date"}
+
+    min_rating = input("Minimum rating (or press Enter for any): ").strip()
+    try:
+        filters["min_rating"] = float(min_rating) if min_rating else None
+    except ValueError:
+        print("Invalid rating, showing all ratings.")
+
+    genre = input("Genre (or press Enter for any): ").strip()
+    if genre:
+        filters["genre_id"] = get_genre_id(genre)
+        if filters["genre_id"] is None:
+            print("Genre not found, showing all genres.")
+
+    year = input("Release year (or press Enter for any): ").strip()
+    if year.isdigit():
+        filters["year"] = int(year)
+    return filters
+
+
 def view_reviews(user_id):
     """
     param: user_id:- Used to view specific user's list of reviews
-    View the entire list of a user's reviews
+    Page through a user's reviews, sorted and filtered as they choose
     """
-    with sqlite3.connect("movies.db") as conn:
-        cursor = conn.cursor()
-
-        # Fetch user reviews
-        cursor.execute("""
-            SELECT reviews.id, movies.title, reviews.rating, reviews.review_text
-            FROM reviews
-            JOIN movies ON reviews.movie_id = movies.id
-            WHERE reviews.user_id = ?
-        """, (user_id,))
+    filters = review_filters()
+    cursor = None
 
-        reviews = cursor.fetchall()
+    while True:
+        with sqlite3.connect("movies.db") as conn:
+            page = review_query.query_reviews(conn, user_id, cursor=cursor, **filters)
 
-        if not reviews:
+        if not page["reviews"]:
             print("No reviews found.")
             return
-        
-        print("\nYour Reviews:")
-        for review_id, title, rating, review in reviews:
-            print(f"ID: {review_id} | 🎬 Movie: {title}\n⭐ Rating: {rating}/10.0\n📝 Review: {review}\n")
 
-        delete_choice = input("Enter the ID of the review to delete (or press Enter to go back): ")
-        if delete_choice.isdigit():
-            delete_review(int(delete_choice), user_id)
+        print("\nYour Reviews:")
+        for review in page["reviews"]:
+            print(f"ID: {review['review_id']} | 🎬 Movie: {review['title']} ({review['year'] or 'N/A'})\n"
+                  f"⭐ Rating: {review['rating']}/10.0\n📝 Review: {review['review']}\n")
+
+        options = [option for option, cursor_key in (("[N]ext page", "next"), ("[P]revious page", "prev"))
+                   if page[cursor_key]]
+        choice = input(f"{', '.join(options + ['the ID of a review to delete'])} (or press Enter to go back): ")
+        if choice.upper() == "N" and page["next"]:
+            cursor = page["next"]
+        elif choice.upper() == "P" and page["prev"]:
+            cursor = page["prev"]
+        elif choice.isdigit():
+            delete_review(int(choice), user_id)
+            return
+        else:
+            return
 
 def receive_rec(user_id):
-    response = requests.get(f"{MICROSERVICE_RECOMMENDATION_URL}?user_id={user_id}", timeout=10)
+    response = upstream.get("recommendation", "/recommendations",
+                            MICROSERVICE_RECOMMENDATION_URL, timeout=10,
+                            headers={"Authorization": f"Bearer {session_token}"})
 
     if response.status_code != 200:
         print("Failed to get recommendations!")
         return
     
-    recommendations = response.json()
+    data = response.json()
+    recommendations = data["recommendations"]
+    meta = data["meta"]
 
     if not recommendations:
-        print("No new recommendations found.")
+        if meta["dropped"]:
+            print("Recommendations are taking too long right now. Please try again shortly.")
+        else:
+            print("No new recommendations found. Try reviewing more!")
         return
     
     print("\n 🎬 Recommended Movies:")
     for movie in recommendations:
         print(f"- {movie[1]} (ID: {movie[0]})")
+    if meta["dropped"] or meta["failed"]:
+        print("Note: some lookups didn't complete in time, so these are drawn from fewer of your reviews.")
+    if response.headers.get("X-Data-Stale"):
+        print("Note: some movie data is unavailable right now, so these may be out of date.")
 
 def browse_genres_instructions():
     """
@@ -517,7 +623,7 @@ def search():
 
 
 def trivia():
-    response = requests.get(f"{MICROSERVICE_TRIVIA_URL}/random")
+    response = upstream.get("trivia", "/trivia/random", f"{MICROSERVICE_TRIVIA_URL}/random")
     if response.status_code != 200:
         print("Failed to get trivia question!")
         return
@@ -537,7 +643,7 @@ def trivia():
         print("Invalid selection.")
         return
     
-    check_response = requests.post(f"{MICROSERVICE_TRIVIA_URL}/answer", json={
+    check_response = upstream.post("trivia", "/trivia/answer", f"{MICROSERVICE_TRIVIA_URL}/answer", json={
         "question": html.unescape(trivia["question"]).strip(),
         "answer": user_answer
     })
@@ -552,6 +658,34 @@ def trivia():
         print("Error checking answer!")
 
 
+def community_top():
+    """
+    Lists the movies rated highest by the community, overall or per genre
+    """
+    genre = input("Enter a genre (or press Enter for all movies): ").strip()
+    response = upstream.get("recommendation", "/community/top", MICROSERVICE_COMMUNITY_TOP_URL,
+                            params={"genre": genre, "limit": 10} if genre else {"limit": 10})
+    if response.status_code == 404:
+        print("Genre not found. Please check your entry and try again.")
+        return
+    if response.status_code != 200:
+        print("Failed to get community ratings!")
+        return
+
+    data = response.json()
+    heading = genre.title() if genre else "All"
+    if not data["movies"]:
+        print(f"\nNo community ratings yet for {heading} movies.")
+        return
+
+    print(f"\n🏆 Community Top {heading} Movies:")
+    if data["genre"]:
+        print(f"({data['genre']['reviews']} reviews, average ⭐ {data['genre']['average']}/10)")
+    for i, movie in enumerate(data["movies"], start=1):
+        print(f"{i}. {movie['title']} ({movie['release_year'] or 'N/A'}) - "
+              f"⭐ {movie['average']}/10 from {movie['reviews']} review(s), score {movie['score']}")
+
+
 def help():
     """
     Provides basic info to the user to enhance experience
@@ -559,9 +693,10 @@ def help():
     print("<===HELP===>")
     print("- Utilize the main menu to navigate around.\n"
           "- 'Add Review' allows you to add a review to your library of existing reviews.\n"
-          "- 'View Review' allows you to bring up the entire list of all your reviews and delete them as you wish.\n"
+          "- 'View Review' lets you page through your reviews, sorted by date or rating and filtered by rating, genre or year, and delete them as you wish.\n"
           "- 'Browse Genres' allows you to visit multiple genres and generate a list of the top movies from them.\n"
           "- 'Search' allows you to type in the specific name of a movie and have all the basic details provided to you\n"
+          "- 'Community Top Movies' lists the movies rated highest by all users, overall or for one genre.\n"
           "- 'Quit' allows you to exist the program which will automatically log you out and save any review changes made."
         )
 
@@ -571,28 +706,39 @@ def run_server():
 
 
 def run_cli():
+    tracing.configure("cli")
     user_id = intro()
     while True:
         main_menu()
         user_input = input("Enter your choice by number: ")
-        if user_input == "1":
-            add_review(user_id)
-        elif user_input == "2":
-            view_reviews(user_id)
-        elif user_input == "3":
-            receive_rec(user_id)
-        elif user_input == "4":
-            browse_genres()
-        elif user_input == "5":
-            search()
-        elif user_input == "6":
-            trivia()
-        elif user_input == "7":
-            help()
-        elif user_input == "8":
-            break
-        else:
-            print("\nPlease enter a valid input.")
+        # Each menu action is the root span of its own trace
+        with tracing.start_span(f"cli menu {user_input}", attributes={"user_id": user_id}):
+            try:
+                if user_input == "1":
+                    add_review(user_id)
+                elif user_input == "2":
+                    view_reviews(user_id)
+                elif user_input == "3":
+                    receive_rec(user_id)
+                elif user_input == "4":
+                    browse_genres()
+                elif user_input == "5":
+                    search()
+                elif user_input == "6":
+                    trivia()
+                elif user_input == "7":
+                    help()
+                elif user_input == "8":
+                    break
+                elif user_input == "9":
+                    community_top()
+                else:
+                    print("\nPlease enter a valid input.")
+            # Services that are down, shedding load or behind an open circuit shouldn't end the session
+            except rate_budget.RateBudgetExceeded:
+                print("\nTMDB is busy right now. Please try again in a moment.")
+            except requests.RequestException:
+                print("\nA service is unavailable right now. Please try again in a moment.")
 
     print("\nThanks for using Your Movie Review Dashboard.\n")
 
@@ -0,0 +1,228 @@
+"""
+Password checks and signed session tokens.
+
+bcrypt work runs on a bounded pool of AUTH_HASH_WORKERS threads with at most
+AUTH_QUEUE_LIMIT checks waiting, so expensive hashes never tie up request
+threads and auth throughput is set by the pool size. Hashes use
+BCRYPT_ROUNDS (default 12); a stored hash with a different cost is
+transparently re-hashed after a successful login.
+
+Session tokens are base64url(JSON {"uid", "exp"}) + "." + HMAC-SHA256 of that
+payload under SESSION_SECRET, so validating one is a constant-time compare
+and never touches users.db.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import bcrypt
+import metrics
+from service_logging import get_logger
+
+USERS_DB = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "users.db"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+AUTH_HASH_WORKERS = int(os.getenv("AUTH_HASH_WORKERS", "4"))
+AUTH_QUEUE_LIMIT = int(os.getenv("AUTH_QUEUE_LIMIT", "32"))
+AUTH_TIMEOUT = float(os.getenv("AUTH_TIMEOUT", "5"))
+SESSION_TTL = float(os.getenv("SESSION_TTL_HOURS", "12")) * 3600
+
+SESSION_SECRET = os.getenv("SESSION_SECRET")
+if not SESSION_SECRET:
+    raise ValueError("Session secret is missing! Set SESSION_SECRET in the .env file.")
+_SECRET = SESSION_SECRET.encode("utf-8")
+
+logger = get_logger("auth")
+
+_hash_pool = ThreadPoolExecutor(max_workers=AUTH_HASH_WORKERS, thread_name_prefix="bcrypt")
+# Running plus queued hash jobs; bounded so a login storm is rejected, not queued forever
+_hash_slots = threading.BoundedSemaphore(AUTH_HASH_WORKERS + AUTH_QUEUE_LIMIT)
+
+HASH_LATENCY = metrics.register(metrics.Histogram(
+    "auth_hash_duration_seconds",
+    "Time from submitting a bcrypt job to its result, including queueing",
+    ("service", "operation"),
+))
+
+
+class AuthBusy(Exception):
+    """The hash pool is saturated; the caller should retry later"""
+
+
+def _run_hash_job(operation, fn, *args):
+    if not _hash_slots.acquire(blocking=False):
+        raise AuthBusy("Too many logins in progress")
+    start = time.perf_counter()
+    try:
+        future = _hash_pool.submit(fn, *args)
+    except BaseException:
+        _hash_slots.release()
+        raise
+    # A running bcrypt job can't be cancelled, so its slot is only freed when it finishes
+    future.add_done_callback(lambda _: _hash_slots.release())
+    try:
+        return future.result(timeout=AUTH_TIMEOUT)
+    except FutureTimeoutError:
+        future.cancel()
+        raise AuthBusy("Password check timed out")
+    finally:
+        HASH_LATENCY.observe(metrics.SERVICE_NAME, operation, value=time.perf_counter() - start)
+
+
+def hash_password(password):
+    """
+    param: password:- Plain-text password (str or bytes)
+    Hash a password at the configured cost on the hash pool
+    """
+    if isinstance(password, str):
+        password = password.encode("utf-8")
+    return _run_hash_job("hash", lambda: bcrypt.hashpw(password, bcrypt.gensalt(rounds=BCRYPT_ROUNDS)))
+
+
+def _cost(stored_hash):
+    try:
+        return int(stored_hash.split(b"$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def needs_rehash(stored_hash):
+    return _cost(stored_hash) != BCRYPT_ROUNDS
+
+
+def verify_password(password, stored_hash):
+    """
+    param: password:- Plain-text password (str or bytes)
+    param: stored_hash:- bcrypt hash from users.db
+    Check a password on the hash pool
+    """
+    if isinstance(password, str):
+        password = password.encode("utf-8")
+    if isinstance(stored_hash, str):
+        stored_hash = stored_hash.encode("utf-8")
+    return _run_hash_job("verify", bcrypt.checkpw, password, stored_hash)
+
+
+def authenticate(username, password, db_path=USERS_DB):
+    """
+    param: username:- Account name
+    param: password:- Plain-text password
+    param: db_path:- users.db to check against
+    Return the user's id if the credentials are valid, else None. Raises
+    AuthBusy when the hash pool is too saturated to check the password; a
+    rehash after a successful check is skipped instead.
+    """
+    with sqlite3.connect(db_path) as conn:
+        with metrics.time_query("users", "select_user"):
+            user = conn.execute("SELECT id, password FROM users WHERE username = ?", (username,)).fetchone()
+    if not user:
+        return None
+
+    user_id, stored_hash = user
+    if isinstance(stored_hash, str):
+        stored_hash = stored_hash.encode("utf-8")
+    if not verify_password(password, stored_hash):
+        return None
+
+    if needs_rehash(stored_hash):
+        # Best effort: the password is verified, so a busy pool only postpones the upgrade
+        try:
+            new_hash = hash_password(password)
+            with sqlite3.connect(db_path) as conn:
+                with metrics.time_query("users", "rehash_password"):
+                    conn.execute("UPDATE users SET password = ? WHERE id = ?", (new_hash, user_id))
+        except (AuthBusy, sqlite3.Error) as e:
+            logger.warning("Password rehash skipped", extra={"user_id": user_id, "error": repr(e)})
+    return user_id
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(payload):
+    return _b64encode(hmac.new(_SECRET, payload.encode("ascii"), hashlib.sha256).digest())
+
+
+def issue_token(user_id, ttl=SESSION_TTL):
+    """
+    param: user_id:- Authenticated user's id
+    param: ttl:- Seconds until the token expires
+    Return a signed session token
+    """
+    expires_at = int(time.time() + ttl)
+    payload = _b64encode(json.dumps({"uid": user_id, "exp": expires_at}, separators=(",", ":")).encode("utf-8"))
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_token(token):
+    """
+    param: token:- Session token from issue_token()
+    Return the user id if the signature is valid and unexpired, else None
+    """
+    if not token or "." not in token or not token.isascii():
+        return None
+    payload, signature = token.rsplit(".", 1)
+    if not hmac.compare_digest(signature, _sign(payload)):
+        return None
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    if not isinstance(claims, dict) or not isinstance(claims.get("exp"), (int, float)):
+        return None
+    if claims["exp"] < time.time():
+        return None
+    return claims.get("uid")
+
+
+def token_from_header(header):
+    """
+    param: header:- Value of the Authorization header
+    """
+    if header and header.startswith("Bearer "):
+        return header[len("Bearer "):].strip()
+    return None
+
+
+def install_login(app, db_path=USERS_DB):
+    """
+    param: app:- Flask app to add POST /login to
+    param: db_path:- users.db to check against
+    """
+    from flask import jsonify, request
+
+    @app.route("/login", methods=["POST"])
+    def login():
+        data = request.get_json(silent=True) or {}
+        username = data.get("username", "")
+        password = data.get("password", "")
+        if not username or not password:
+            return jsonify({"Error": "Username and password are required"}), 400
+        try:
+            user_id = authenticate(username, password, db_path)
+        except AuthBusy:
+            return jsonify({"Error": "Login service busy, please retry later"}), 503, {"Retry-After": "1"}
+        if user_id is None:
+            return jsonify({"Error": "Invalid login credentials"}), 401
+        return jsonify({"token": issue_token(user_id), "user_id": user_id}), 200
+
+    return app
+
+
+def current_user_id():
+    """
+    Return the user id from the current request's bearer token, or None
+    """
+    from flask import request
+
+    return verify_token(token_from_header(request.headers.get("Authorization")))
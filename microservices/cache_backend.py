@@ -0,0 +1,296 @@
+"""
+Pluggable cache shared by the microservices.
+
+get_cache(namespace) returns a cache whose storage is chosen by CACHE_BACKEND:
+ - memory (default): per-process LRU of CACHE_MAX_ENTRIES entries
+ - sqlite: one table in CACHE_DB shared by every worker process on the host
+ - redis: any server speaking the Redis protocol at CACHE_URL
+   (redis://host:port/db)
+
+With sqlite or redis, N workers of a service share one cache, so hit rates
+and upstream call volume don't change as workers are added. Values must be
+JSON-serialisable. A backend error is logged and treated as a miss.
+
+A cache created with stale_ttl keeps each entry that much longer than its
+TTL: get() only returns fresh entries, while get_stale() still returns the
+last value, for serving when the upstream is unavailable.
+
+A cache created with encode/decode functions stores arbitrary objects: the
+memory backend keeps them as they are, the shared backends store
+encode(value) and rebuild the object with decode() on the way out. A stored
+value decode() rejects is logged and treated as a miss.
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+import metrics
+from service_logging import get_logger
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower()
+CACHE_DB = os.getenv("CACHE_DB", os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "cache.db")))
+CACHE_URL = os.getenv("CACHE_URL", "redis://localhost:6379/0")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+
+logger = get_logger("cache_backend")
+
+
+class MemoryCache:
+    # Values are kept as Python objects, so they need no encoding
+    serializes = False
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SQLiteCache:
+    serializes = True
+    # Expired rows are purged on roughly one write in this many
+    PURGE_EVERY = 1000
+
+    def __init__(self, path=CACHE_DB):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires REAL
+                )""")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        conn = self._connect()
+        conn.execute("INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                     (key, json.dumps(value), expires))
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute("DELETE FROM cache WHERE expires IS NOT NULL AND expires < ?", (time.time(),))
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+
+class RedisCache:
+    """Minimal RESP2 client covering GET, SET (with EX) and DEL"""
+
+    serializes = True
+
+    def __init__(self, url=CACHE_URL, timeout=1.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.password = parsed.password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            conn = (sock, sock.makefile("rb"))
+            self._local.conn = conn
+            if self.password:
+                self._command("AUTH", self.password)
+            if self.db:
+                self._command("SELECT", str(self.db))
+        return conn
+
+    def _reset(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn[0].close()
+        self._local.conn = None
+
+    def _command(self, *args):
+        sock, reader = self._connect()
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        try:
+            sock.sendall(b"".join(parts))
+            return self._read_reply(reader)
+        except (OSError, ConnectionError):
+            self._reset()
+            raise
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("Cache server closed the connection")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode()
+        if kind == b"-":
+            raise RuntimeError(body.decode())
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length == -1:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            return [self._read_reply(reader) for _ in range(int(body))]
+        raise RuntimeError(f"Unexpected reply from cache server: {line!r}")
+
+    def get(self, key):
+        value = self._command("GET", key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        if ttl:
+            self._command("SET", key, json.dumps(value), "EX", str(max(1, int(ttl))))
+        else:
+            self._command("SET", key, json.dumps(value))
+
+    def delete(self, key):
+        self._command("DEL", key)
+
+
+class NamespacedCache:
+    def __init__(self, namespace, backend, default_ttl=None, stale_ttl=None, encode=None, decode=None):
+        self.namespace = namespace
+        self.backend = backend
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        # Only shared backends need objects turned into JSON and back
+        self._encode = encode if backend.serializes else None
+        self._decode = decode if backend.serializes else None
+
+    def _key(self, key):
+        return f"{self.namespace}:{key}"
+
+    def _load(self, key):
+        try:
+            return self.backend.get(self._key(key))
+        except Exception as e:
+            logger.warning("Cache get failed", extra={"cache": self.namespace, "error": repr(e)})
+            return None
+
+    def _decoded(self, value):
+        if value is None or not self._decode:
+            return value
+        try:
+            return self._decode(value)
+        except Exception as e:
+            # An entry written in an older format is a miss, and gets overwritten on the next set()
+            logger.warning("Cache decode failed", extra={"cache": self.namespace, "error": repr(e)})
+            return None
+
+    def get(self, key):
+        value = self._load(key)
+        if self.stale_ttl:
+            # Past fresh_until an entry is only served by get_stale()
+            entry = value if isinstance(value, dict) and "fresh_until" in value else {}
+            fresh_until = entry.get("fresh_until")
+            value = entry.get("value") if fresh_until is None or fresh_until >= time.time() else None
+        value = self._decoded(value)
+        metrics.record_cache(self.namespace, value is not None)
+        return value
+
+    def get_stale(self, key):
+        """
+        param: key:- Cache key
+        Return the last stored value even if it is past its TTL, or None
+        """
+        value = self._load(key)
+        if self.stale_ttl:
+            value = value.get("value") if isinstance(value, dict) else None
+        value = self._decoded(value)
+        metrics.record_cache(f"{self.namespace}_stale", value is not None)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.default_ttl
+        if self._encode:
+            value = self._encode(value)
+        if self.stale_ttl:
+            value = {"fresh_until": time.time() + ttl if ttl else None, "value": value}
+            ttl = ttl + self.stale_ttl if ttl else None
+        try:
+            self.backend.set(self._key(key), value, ttl)
+        except Exception as e:
+            logger.warning("Cache set failed", extra={"cache": self.namespace, "error": repr(e)})
+
+    def delete(self, key):
+        try:
+            self.backend.delete(self._key(key))
+        except Exception as e:
+            logger.warning("Cache delete failed", extra={"cache": self.namespace, "error": repr(e)})
+
+
+def _build_backend(kind):
+    if kind == "sqlite":
+        return SQLiteCache()
+    if kind == "redis":
+        return RedisCache()
+    return MemoryCache()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_cache(namespace, default_ttl=None, stale_ttl=None, encode=None, decode=None):
+    """
+    param: namespace:- Prefix for this cache's keys and its metrics label
+    param: default_ttl:- Seconds entries live unless set() says otherwise
+    param: stale_ttl:- Extra seconds expired entries stay available to get_stale()
+    param: encode:- Turns a value into JSON-serialisable data for shared backends
+    param: decode:- Rebuilds a value from what encode() returned
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = _build_backend(CACHE_BACKEND)
+    return NamespacedCache(namespace, _backend, default_ttl, stale_ttl, encode, decode)
@@ -0,0 +1,134 @@
+"""
+Columnar candidate pools for the recommendation service.
+
+A CandidatePool holds a genre's candidate movies as parallel NumPy arrays:
+TMDB ids (int64), TMDB vote averages (float32), a genre bitmask (uint64, one
+bit per TMDB movie genre in the fixed GENRE_BITS order, so masks mean the
+same in every process sharing the cache) and titles (an object array holding
+one string per distinct title in the pool, freed with the pool), so each
+candidate costs a fraction of a dict of Python objects. Excluding already-reviewed ids is a vectorized
+sorted-array lookup.
+
+Pools round-trip through to_columns()/from_columns() for the shared cache
+backends, which can only store JSON.
+"""
+import numpy as np
+
+_EMPTY_IDS = np.empty(0, dtype=np.int64)
+
+
+# TMDB's movie genre ids in bit order; new bits go at the end, ids not listed set no bit
+GENRE_BITS = {genre_id: bit for bit, genre_id in enumerate((
+    28, 12, 16, 35, 80, 99, 18, 10751, 14, 36, 27, 10402, 9648, 10749, 878, 10770, 53, 10752, 37,
+))}
+
+
+def _genre_mask(genre_ids):
+    mask = 0
+    for genre_id in genre_ids or ():
+        bit = GENRE_BITS.get(genre_id)
+        if bit is not None:
+            mask |= 1 << bit
+    return mask
+
+
+class CandidatePool:
+    __slots__ = ("ids", "scores", "genres", "titles")
+
+    def __init__(self, ids, scores, genres, titles):
+        self.ids = ids
+        self.scores = scores
+        self.genres = genres
+        self.titles = titles
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_movies(cls, movies):
+        """
+        param: movies:- TMDB result dicts (id and title required; vote_average
+                        and genre_ids used when present)
+        """
+        movies = [movie for movie in movies if movie.get("id") is not None]
+        return cls(
+            np.fromiter((movie["id"] for movie in movies), dtype=np.int64, count=len(movies)),
+            np.fromiter((movie.get("vote_average") or 0.0 for movie in movies), dtype=np.float32, count=len(movies)),
+            np.fromiter((_genre_mask(movie.get("genre_ids")) for movie in movies), dtype=np.uint64, count=len(movies)),
+            _titles(movie.get("title") or "" for movie in movies),
+        )
+
+    def to_columns(self):
+        """JSON-serialisable form for the shared cache backends"""
+        return {
+            "ids": self.ids.tolist(),
+            "scores": [round(score, 3) for score in self.scores.tolist()],
+            "genres": self.genres.tolist(),
+            "titles": self.titles.tolist(),
+        }
+
+    @classmethod
+    def from_columns(cls, columns):
+        return cls(
+            np.array(columns["ids"], dtype=np.int64),
+            np.array(columns["scores"], dtype=np.float32),
+            np.array(columns["genres"], dtype=np.uint64),
+            _titles(columns["titles"]),
+        )
+
+    @classmethod
+    def concat(cls, pools):
+        pools = [pool for pool in pools if len(pool)]
+        if not pools:
+            return cls.empty()
+        return cls(*(np.concatenate([getattr(pool, name) for pool in pools]) for name in cls.__slots__))
+
+    @classmethod
+    def empty(cls):
+        return cls(_EMPTY_IDS, np.empty(0, dtype=np.float32), np.empty(0, dtype=np.uint64),
+                   np.empty(0, dtype=object))
+
+    def _take(self, selector):
+        return CandidatePool(self.ids[selector], self.scores[selector], self.genres[selector],
+                             self.titles[selector])
+
+    def exclude(self, sorted_ids):
+        """
+        param: sorted_ids:- Sorted int64 array of ids to drop (see sorted_ids())
+        """
+        if not len(sorted_ids) or not len(self):
+            return self
+        positions = np.searchsorted(sorted_ids, self.ids)
+        positions[positions == len(sorted_ids)] = 0
+        return self._take(sorted_ids[positions] != self.ids)
+
+    def unique(self):
+        """Drop repeated ids, keeping the first occurrence"""
+        _, first = np.unique(self.ids, return_index=True)
+        first.sort()
+        return self._take(first)
+
+    def sample(self, count, rng=None):
+        """Return up to count random candidates as (id, title) pairs"""
+        if not len(self):
+            return []
+        rng = rng or np.random.default_rng()
+        picks = rng.choice(len(self), size=min(count, len(self)), replace=False)
+        return list(zip(self.ids[picks].tolist(), self.titles[picks].tolist()))
+
+
+def _titles(titles):
+    # Repeated titles within a pool share one string; nothing outlives the pool
+    shared = {}
+    titles = [shared.setdefault(title, title) for title in titles]
+    array = np.empty(len(titles), dtype=object)
+    array[:] = titles
+    return array
+
+
+def sorted_ids(ids):
+    """
+    param: ids:- Iterable of movie ids
+    Return them as a sorted, de-duplicated int64 array for exclude()
+    """
+    return np.unique(np.fromiter((int(i) for i in ids if i is not None), dtype=np.int64))
@@ -0,0 +1,164 @@
+"""
+Bulk import of TMDB's daily movie ID export into the local title catalog.
+
+The export is a gzipped file with one JSON object per line, e.g.
+{"adult":false,"id":3924,"original_title":"Blondie","popularity":2.9,"video":false}
+It is streamed line by line (memory stays flat regardless of file size) and
+upserted into title_index.db in batches of --batch-size rows per transaction.
+
+With --enrich N the N most popular imported titles that have no release date
+yet are fetched from TMDB's /movie/{id} endpoint by --workers threads, with
+at most 2 x workers requests in flight, and merged back into the index. These
+calls run at background priority in the shared TMDB rate budget.
+
+usage: python catalog_import.py movie_ids_MM_DD_YYYY.json.gz [--batch-size 50000]
+                                [--include-adult] [--enrich N] [--workers 8]
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import requests
+import rate_budget
+import title_index
+import upstream
+from service_logging import get_logger
+
+TMDB_MOVIE_URL = "https://api.themoviedb.org/3/movie/{}"
+
+logger = get_logger("catalog_import")
+
+
+def read_export(path, include_adult=False):
+    """
+    param: path:- Path to a gzipped (or plain) NDJSON export
+    param: include_adult:- Keep entries flagged adult
+    Yield (tmdb_id, original_title, popularity) one line at a time
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("Skipping malformed line", extra={"line": line_number})
+                continue
+            if entry.get("adult") and not include_adult:
+                continue
+            if not entry.get("id") or not entry.get("original_title"):
+                continue
+            yield entry["id"], entry["original_title"], entry.get("popularity") or 0
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_export(path, batch_size=50000, include_adult=False):
+    """
+    param: path:- Path to the export file
+    param: batch_size:- Rows per transaction
+    param: include_adult:- Keep entries flagged adult
+    Stream the export into the title index and return the number of rows
+    """
+    title_index.init_index()
+    conn = title_index.bulk_connection()
+    total = 0
+    start = time.perf_counter()
+    try:
+        for batch in _batches(read_export(path, include_adult), batch_size):
+            with conn:
+                title_index.upsert_export_rows(conn, batch)
+            total += len(batch)
+            logger.info("Imported batch", extra={"rows": total,
+                                                 "rows_per_second": int(total / (time.perf_counter() - start))})
+    finally:
+        conn.close()
+    return total
+
+
+def fetch_details(tmdb_id):
+    """
+    param: tmdb_id:- TMDB movie id
+    Return the movie's TMDB details at background priority, or None
+    """
+    params = {"api_key": os.getenv("TMDB_API_KEY")}
+    try:
+        with rate_budget.priority(rate_budget.BACKGROUND):
+            response = upstream.get("tmdb", "/movie/{id}", TMDB_MOVIE_URL.format(tmdb_id), params=params, timeout=10)
+    except requests.RequestException as e:
+        logger.warning("Detail fetch failed", extra={"tmdb_id": tmdb_id, "error": repr(e)})
+        return None
+    return response.json() if response.status_code == 200 else None
+
+
+def enrich(limit, workers=8, flush_every=500):
+    """
+    param: limit:- Number of titles to enrich, most popular first
+    param: workers:- Concurrent TMDB requests
+    param: flush_every:- Details written per transaction
+    Fill in release dates, ratings and genres for unenriched titles
+    """
+    conn = title_index.bulk_connection()
+    ids = conn.execute("""
+        SELECT tmdb_id FROM titles WHERE enriched = 0
+        ORDER BY popularity DESC LIMIT ?
+    """, (limit,))
+
+    enriched = 0
+    pending = set()
+    details = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for (tmdb_id,) in ids:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                details.extend(d for d in (f.result() for f in done) if d)
+            pending.add(executor.submit(fetch_details, tmdb_id))
+            if len(details) >= flush_every:
+                title_index.add_movies(details)
+                enriched += len(details)
+                details = []
+        done, _ = wait(pending)
+        details.extend(d for d in (f.result() for f in done) if d)
+    conn.close()
+
+    if details:
+        title_index.add_movies(details)
+        enriched += len(details)
+    return enriched
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Import a TMDB daily movie ID export into the local catalog")
+    parser.add_argument("path")
+    parser.add_argument("--batch-size", type=int, default=50000)
+    parser.add_argument("--include-adult", action="store_true")
+    parser.add_argument("--enrich", type=int, default=0, metavar="N")
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    total = import_export(args.path, args.batch_size, args.include_adult)
+    logger.info("Import finished", extra={"rows": total, "seconds": round(time.perf_counter() - start, 1)})
+
+    if args.enrich:
+        enriched = enrich(args.enrich, args.workers)
+        logger.info("Enrichment finished", extra={"enriched": enriched})
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
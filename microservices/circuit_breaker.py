@@ -0,0 +1,168 @@
+"""
+Per-upstream circuit breakers for outbound calls.
+
+upstream.request() asks the breaker for its upstream before every call:
+ - closed: calls go through; CIRCUIT_FAILURE_THRESHOLD consecutive failures
+   (connection errors, timeouts, 5xx or 429 answers) open the circuit
+ - open: calls fail immediately with CircuitOpen for CIRCUIT_RESET_SECONDS,
+   so request threads never pile up waiting on a degraded upstream
+ - half-open: up to CIRCUIT_HALF_OPEN_CALLS trial calls are let through; a
+   success closes the circuit again, a failure re-opens it
+
+Thresholds can be set per upstream with CIRCUIT_<UPSTREAM>_FAILURE_THRESHOLD,
+CIRCUIT_<UPSTREAM>_RESET_SECONDS and CIRCUIT_<UPSTREAM>_HALF_OPEN_CALLS
+(e.g. CIRCUIT_TMDB_RESET_SECONDS). Breakers are per process. Callers are
+expected to catch CircuitOpen (a requests.RequestException) and answer from
+their local caches, flagging the data as stale.
+"""
+import math
+import os
+import threading
+import time
+import requests
+import metrics
+from service_logging import get_logger
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+CIRCUIT_HALF_OPEN_CALLS = int(os.getenv("CIRCUIT_HALF_OPEN_CALLS", "1"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+CIRCUIT_STATE = metrics.register(metrics.Gauge(
+    "circuit_breaker_state",
+    "Circuit state per upstream (0 closed, 1 half-open, 2 open)",
+    ("service", "upstream"),
+))
+CIRCUIT_REJECTED = metrics.register(metrics.Counter(
+    "circuit_breaker_rejected_total",
+    "Upstream calls failed fast because the circuit was open",
+    ("service", "upstream"),
+))
+
+logger = get_logger("circuit_breaker")
+
+
+class CircuitOpen(requests.RequestException):
+    """The upstream's circuit is open; the call was not attempted"""
+
+    def __init__(self, upstream, retry_after):
+        super().__init__(f"Circuit for {upstream} is open")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, upstream, failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 reset_seconds=CIRCUIT_RESET_SECONDS, half_open_calls=CIRCUIT_HALF_OPEN_CALLS):
+        self.upstream = upstream
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.half_open_calls = half_open_calls
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trials = 0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning("Circuit state changed", extra={"upstream": self.upstream,
+                                                           "from": self.state, "to": state})
+            self.state = state
+        CIRCUIT_STATE.set(metrics.SERVICE_NAME, self.upstream, value=_STATE_VALUES[state])
+
+    def retry_after(self):
+        """Seconds until an open circuit lets a trial call through"""
+        return max(0.0, self._opened_at + self.reset_seconds - time.monotonic())
+
+    def allow(self):
+        """
+        Reserve a call or raise CircuitOpen. Every allowed call must be
+        followed by record_success(), record_failure() or release().
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if self.retry_after() > 0:
+                    CIRCUIT_REJECTED.inc(metrics.SERVICE_NAME, self.upstream)
+                    raise CircuitOpen(self.upstream, self.retry_after())
+                self._set_state(HALF_OPEN)
+                self._trials = 0
+            if self.state == HALF_OPEN:
+                if self._trials >= self.half_open_calls:
+                    CIRCUIT_REJECTED.inc(metrics.SERVICE_NAME, self.upstream)
+                    raise CircuitOpen(self.upstream, self.reset_seconds)
+                self._trials += 1
+
+    def release(self):
+        """Give back a reservation for a call that was never made"""
+        with self._lock:
+            if self.state == HALF_OPEN and self._trials > 0:
+                self._trials -= 1
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self.state != CLOSED:
+                self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def _setting(upstream, name, default, cast):
+    value = os.getenv(f"CIRCUIT_{upstream.upper()}_{name}")
+    return cast(value) if value else default
+
+
+def get(upstream):
+    """
+    param: upstream:- Upstream name as passed to upstream.request()
+    Return the process-wide breaker for this upstream
+    """
+    breaker = _breakers.get(upstream)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(upstream)
+            if breaker is None:
+                breaker = _breakers[upstream] = CircuitBreaker(
+                    upstream,
+                    failure_threshold=_setting(upstream, "FAILURE_THRESHOLD", CIRCUIT_FAILURE_THRESHOLD, int),
+                    reset_seconds=_setting(upstream, "RESET_SECONDS", CIRCUIT_RESET_SECONDS, float),
+                    half_open_calls=_setting(upstream, "HALF_OPEN_CALLS", CIRCUIT_HALF_OPEN_CALLS, int),
+                )
+    return breaker
+
+
+def is_failure(status_code):
+    return status_code >= 500 or status_code == 429
+
+
+def install_handler(app):
+    """
+    param: app:- The service's Flask app
+    Answer requests whose upstream failed (or whose circuit is open) with
+    nothing to fall back on with 503 and Retry-After
+    """
+    from flask import jsonify
+
+    @app.errorhandler(requests.RequestException)
+    def _upstream_unavailable(error):
+        upstream = getattr(error, "upstream", "An upstream service")
+        response = jsonify({"Error": f"{upstream} is unavailable, please retry later"})
+        response.status_code = 503
+        response.headers["Retry-After"] = str(max(1, math.ceil(getattr(error, "retry_after", 1))))
+        return response
+
+    return app
@@ -0,0 +1,132 @@
+"""
+Per-request deadlines for outbound calls.
+
+budget(seconds) sets a deadline for the enclosed code in a context variable,
+so it follows the request into executor threads started with
+contextvars.copy_context(). upstream.request() shortens each call's timeout
+and rate budget wait to the time left and refuses calls once the deadline
+has passed, raising DeadlineExceeded (a requests.Timeout) that callers
+already handle like any other upstream failure. requests' read timeout
+applies per socket read, so a call can overrun the deadline by at most one
+read's worth of a slowly trickling response.
+
+Calls to the other microservices carry the time left in DEADLINE_HEADER.
+install(app) runs each request under the deadline its caller sent, so a
+service stops working on a request its caller has already given up on, and
+answers 504 with EXCEEDED_HEADER set when that deadline passes. Only the
+work done while the view runs is covered; the later pages of a streamed
+response are not.
+"""
+import contextvars
+import math
+import time
+from contextlib import contextmanager
+import requests
+
+DEADLINE_HEADER = "X-Request-Deadline"
+EXCEEDED_HEADER = "X-Deadline-Exceeded"
+
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(requests.Timeout):
+    """The request's deadline passed before or during an upstream call"""
+
+
+@contextmanager
+def budget(seconds):
+    """
+    param: seconds:- Time allowed for the enclosed work
+    Set a deadline; an enclosing, earlier deadline still applies
+    """
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left before the deadline (0 once passed), or None without one"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def check():
+    """Raise DeadlineExceeded if the deadline has passed"""
+    if remaining() == 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+
+
+def cap(seconds):
+    """
+    param: seconds:- A wait or timeout in seconds (None for unbounded)
+    Return it shortened to the time left before the deadline
+    """
+    left = remaining()
+    if left is None:
+        return seconds
+    return left if seconds is None else min(seconds, left)
+
+
+def cap_timeout(timeout):
+    """
+    param: timeout:- A `requests` timeout: seconds, (connect, read) or None
+    Return it with each part shortened to the time left before the deadline.
+    Raises DeadlineExceeded once it has passed, since `requests` rejects a
+    zero timeout
+    """
+    check()
+    if isinstance(timeout, tuple):
+        return tuple(cap(part) for part in timeout)
+    return cap(timeout)
+
+
+def inject(headers=None):
+    """
+    param: headers:- Outgoing header dict (created if None)
+    Add the time left before the deadline, if there is one, to the headers
+    """
+    headers = dict(headers or {})
+    left = remaining()
+    if left is not None:
+        headers[DEADLINE_HEADER] = f"{left:.3f}"
+    return headers
+
+
+def install(app):
+    """
+    param: app:- The service's Flask app
+    Run each request under the deadline in its DEADLINE_HEADER and answer
+    504 when that deadline passes
+    """
+    from flask import g, jsonify, request
+
+    @app.before_request
+    def _set_deadline():
+        try:
+            seconds = float(request.headers[DEADLINE_HEADER])
+        except (KeyError, ValueError):
+            return None
+        if math.isfinite(seconds):
+            g._deadline_token = _deadline.set(time.monotonic() + max(0.0, seconds))
+        return None
+
+    @app.errorhandler(DeadlineExceeded)
+    def _deadline_exceeded(error):
+        response = jsonify({"Error": "Request deadline exceeded"})
+        response.status_code = 504
+        response.headers[EXCEEDED_HEADER] = "1"
+        return response
+
+    @app.teardown_request
+    def _reset_deadline(error=None):
+        token = g.pop("_deadline_token", None)
+        if token is not None:
+            _deadline.reset(token)
+
+    return app
@@ -0,0 +1,164 @@
+"""
+Local TMDB genre catalog shared by the services.
+
+The full /genre/movie/list response is persisted in genres.db and refreshed
+at most once per GENRE_CATALOG_TTL_HOURS (default 24). Lookups in both
+directions are dictionary hits; the TTL is only checked against a timestamp
+held in memory, so steady-state lookups never touch SQLite or TMDB. Once the
+catalog expires, one background thread refreshes it while lookups keep
+using the expired copy; only a process with no catalog at all fetches it on
+the request path, at interactive priority.
+"""
+import os
+import sqlite3
+import threading
+import time
+import requests
+import metrics
+import rate_budget
+import upstream
+from service_logging import get_logger
+
+GENRE_DB = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "genres.db"))
+TMDB_GENRE_LIST_URL = "https://api.themoviedb.org/3/genre/movie/list"
+GENRE_CATALOG_TTL = float(os.getenv("GENRE_CATALOG_TTL_HOURS", "24")) * 3600
+# How long to keep serving an expired catalog before retrying a failed refresh
+REFRESH_RETRY_SECONDS = 60
+
+logger = get_logger("genre_catalog")
+
+
+class GenreCatalog:
+    def __init__(self, db_path=GENRE_DB, ttl=GENRE_CATALOG_TTL):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._by_id = {}
+        self._by_name = {}
+        self._fetched_at = 0.0
+        self._retry_after = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _init_db(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS genres (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL
+            )""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS genre_catalog_meta (
+                key TEXT PRIMARY KEY,
+                value REAL
+            )""")
+
+    def _load_from_db(self):
+        with sqlite3.connect(self.db_path) as conn:
+            self._init_db(conn)
+            with metrics.time_query("genres", "load_catalog"):
+                rows = conn.execute("SELECT id, name FROM genres").fetchall()
+                meta = conn.execute("SELECT value FROM genre_catalog_meta WHERE key = 'fetched_at'").fetchone()
+        self._set(rows, meta[0] if meta else 0.0)
+
+    def _set(self, rows, fetched_at):
+        self._by_id = {genre_id: name for genre_id, name in rows}
+        self._by_name = {name.lower(): genre_id for genre_id, name in rows}
+        self._fetched_at = fetched_at
+
+    def _refresh_from_tmdb(self, level):
+        params = {"api_key": os.getenv("TMDB_API_KEY"), "language": "en-US"}
+        try:
+            with rate_budget.priority(level):
+                response = upstream.get("tmdb", "/genre/movie/list", TMDB_GENRE_LIST_URL, params=params, timeout=10)
+        except requests.RequestException as e:
+            logger.error("Error fetching genres", extra={"error": repr(e)})
+            return False
+        if response.status_code != 200:
+            logger.error("Error fetching genres", extra={"status": response.status_code})
+            return False
+
+        rows = [(genre["id"], genre["name"]) for genre in response.json().get("genres", [])
+                if isinstance(genre, dict) and genre.get("name")]
+        fetched_at = time.time()
+        with sqlite3.connect(self.db_path) as conn:
+            self._init_db(conn)
+            with metrics.time_query("genres", "store_catalog"):
+                conn.execute("DELETE FROM genres")
+                conn.executemany("INSERT INTO genres (id, name) VALUES (?, ?)", rows)
+                conn.execute("INSERT OR REPLACE INTO genre_catalog_meta (key, value) VALUES ('fetched_at', ?)",
+                             (fetched_at,))
+        self._set(rows, fetched_at)
+        logger.info("Genre catalog refreshed", extra={"genres": len(rows)})
+        return True
+
+    def _is_stale(self):
+        return not self._by_id or time.time() - self._fetched_at > self.ttl
+
+    def _refresh(self, level):
+        with self._lock:
+            # Another thread may have refreshed while this one waited for the lock
+            if not self._is_stale() or time.time() < self._retry_after:
+                return
+            if not self._refresh_from_tmdb(level):
+                # Keep serving the expired copy if TMDB can't be reached
+                self._retry_after = time.time() + REFRESH_RETRY_SECONDS
+
+    def _refresh_in_background(self):
+        try:
+            self._refresh(rate_budget.BACKGROUND)
+        finally:
+            self._refreshing = False
+
+    def load(self):
+        """
+        Load the persisted catalog and refresh it from TMDB if it has expired.
+        Called at service start so the first request doesn't pay for it.
+        """
+        with self._lock:
+            self._load_from_db()
+        self._refresh(rate_budget.BACKGROUND)
+
+    def _ensure_fresh(self):
+        if not self._is_stale() or time.time() < self._retry_after:
+            return
+        if self._by_id:
+            with self._lock:
+                if self._refreshing:
+                    return
+                self._refreshing = True
+            threading.Thread(target=self._refresh_in_background, name="genre-catalog-refresh", daemon=True).start()
+            return
+        # Nothing to serve yet, so this request waits for the catalog
+        with self._lock:
+            if not self._by_id:
+                self._load_from_db()
+        self._refresh(rate_budget.INTERACTIVE)
+
+    def id_for(self, genre_name):
+        """
+        param: genre_name:- Genre name (case-insensitive)
+        Return the TMDB genre id or None
+        """
+        self._ensure_fresh()
+        genre_id = self._by_name.get(genre_name.lower())
+        metrics.record_cache("genre_catalog", genre_id is not None)
+        return genre_id
+
+    def name_for(self, genre_id):
+        """
+        param: genre_id:- TMDB genre id
+        Return the genre name or None
+        """
+        self._ensure_fresh()
+        try:
+            name = self._by_id.get(int(genre_id))
+        except (TypeError, ValueError):
+            name = None
+        metrics.record_cache("genre_catalog", name is not None)
+        return name
+
+    def all(self):
+        self._ensure_fresh()
+        return [{"id": genre_id, "name": name} for genre_id, name in sorted(self._by_id.items())]
+
+
+catalog = GenreCatalog()
@@ -0,0 +1,257 @@
+"""
+Prometheus-style metrics shared by the microservices.
+
+Every service calls instrument_app() once, which times each Flask route and
+exposes the registry in the Prometheus text format on /metrics. Upstream
+calls, SQLite queries and cache lookups are recorded through the helpers
+below so the same names are used across all four services.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from flask import Response, g, request
+import tracing
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join(f'{name}="{_escape(value)}"' for name, value in pairs)
+    return "{" + body + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        return self._values.get(labelvalues, 0)
+
+    def _store(self, labelvalues, value):
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labelvalues, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, *labelvalues, value):
+        self._store(labelvalues, value)
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, *labelvalues, value):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labelvalues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*labelvalues, value=time.perf_counter() - start)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, (list(s[0]), s[1], s[2])) for key, s in self._series.items())
+        for labelvalues, (bucket_counts, total, count) in items:
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                labels = _format_labels(self.labelnames, labelvalues, ("le", bound))
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = _format_labels(self.labelnames, labelvalues, ("le", "+Inf"))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+SERVICE_NAME = "unknown"
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Latency of Flask routes",
+    ("service", "method", "route", "status"),
+)
+UPSTREAM_LATENCY = Histogram(
+    "upstream_request_duration_seconds",
+    "Latency of calls to TMDB and the other microservices",
+    ("service", "upstream", "endpoint", "status"),
+)
+UPSTREAM_ERRORS = Counter(
+    "upstream_errors_total",
+    "Upstream calls that raised before returning a response",
+    ("service", "upstream", "endpoint"),
+)
+DB_QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds",
+    "Latency of SQLite queries",
+    ("service", "db", "query"),
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Cache lookups by outcome",
+    ("service", "cache", "result"),
+)
+CACHE_HIT_RATIO = Gauge(
+    "cache_hit_ratio",
+    "Hits divided by lookups since process start",
+    ("service", "cache"),
+)
+
+_registry = [REQUEST_LATENCY, UPSTREAM_LATENCY, UPSTREAM_ERRORS, DB_QUERY_LATENCY, CACHE_REQUESTS, CACHE_HIT_RATIO]
+
+
+def register(metric):
+    """
+    param: metric:- Counter, Gauge or Histogram to include in /metrics
+    """
+    _registry.append(metric)
+    return metric
+
+
+def time_upstream(upstream, endpoint):
+    """
+    param: upstream:- Name of the remote system ("tmdb", "movie_search", ...)
+    param: endpoint:- Templated path of the call (no ids or query strings)
+    Context manager that records the latency of one upstream call
+    """
+    return _UpstreamTimer(upstream, endpoint)
+
+
+class _UpstreamTimer:
+    def __init__(self, upstream, endpoint):
+        self.upstream = upstream
+        self.endpoint = endpoint
+        self.status = "error"
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        if exc_type is not None:
+            UPSTREAM_ERRORS.inc(SERVICE_NAME, self.upstream, self.endpoint)
+        UPSTREAM_LATENCY.observe(SERVICE_NAME, self.upstream, self.endpoint, str(self.status), value=elapsed)
+        return False
+
+
+def time_query(db, query):
+    """
+    param: db:- Database file label ("movies", "trivia", ...)
+    param: query:- Short name of the statement being run
+    Context manager that records the latency of one SQLite query and wraps it
+    in a trace span
+    """
+    return _timed_query(db, query)
+
+
+@contextmanager
+def _timed_query(db, query):
+    with tracing.start_span(f"sqlite {query}", kind="client", attributes={"db": db}):
+        with DB_QUERY_LATENCY.time(SERVICE_NAME, db, query):
+            yield
+
+
+def record_cache(cache, hit):
+    """
+    param: cache:- Name of the cache that was consulted
+    param: hit:- Whether the lookup was served from the cache
+    """
+    CACHE_REQUESTS.inc(SERVICE_NAME, cache, "hit" if hit else "miss")
+
+
+def _refresh_cache_ratios():
+    with CACHE_REQUESTS._lock:
+        caches = {labels[1] for labels in CACHE_REQUESTS._values}
+    for cache in caches:
+        hits = CACHE_REQUESTS.value(SERVICE_NAME, cache, "hit")
+        misses = CACHE_REQUESTS.value(SERVICE_NAME, cache, "miss")
+        if hits + misses:
+            CACHE_HIT_RATIO.set(SERVICE_NAME, cache, value=hits / (hits + misses))
+
+
+def render():
+    """
+    Render every registered metric in the Prometheus text exposition format
+    """
+    _refresh_cache_ratios()
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def instrument_app(app, service_name):
+    """
+    param: app:- The service's Flask app
+    param: service_name:- Value of the "service" label for this process
+    Times every route and adds the /metrics endpoint
+    """
+    global SERVICE_NAME
+    SERVICE_NAME = service_name
+
+    @app.before_request
+    def _start_timer():
+        g._metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _record_latency(response):
+        start = g.pop("_metrics_start", None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            REQUEST_LATENCY.observe(SERVICE_NAME, request.method, route, str(response.status_code),
+                                    value=time.perf_counter() - start)
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
+
+    return app
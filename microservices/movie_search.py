@@ -1,12 +1,34 @@
 from flask import Flask, request, jsonify, abort
-import requests
 import os
+from urllib.parse import quote
 from dotenv import load_dotenv
+import requests
+import cache_backend
+import circuit_breaker
+import deadline
+import metrics
+import prefetch
+import title_index
+from genre_catalog import catalog as genre_catalog
+import profiling
+import rate_budget
+import responses
+import tracing
+import upstream
+from service_logging import get_logger
 
 # Load environment variables from .env file
 load_dotenv()
 
 app = Flask(__name__)
+metrics.instrument_app(app, "movie_search")
+tracing.instrument_app(app, "movie_search")
+profiling.instrument_app(app, "movie_search")
+rate_budget.install_admission(app)
+deadline.install(app)
+circuit_breaker.install_handler(app)
+responses.install_compression(app)
+logger = get_logger("movie_search")
 
 # Get API key from environment variable
 TMDB_API_KEY = os.getenv("TMDB_API_KEY")
@@ -17,67 +39,252 @@ if not TMDB_API_KEY:
 TMDB_SEARCH_URL = "https://api.themoviedb.org/3/search/movie"
 # TMDb discover endpoint for genre-based searches
 TMDB_DISCOVER_URL = "https://api.themoviedb.org/3/discover/movie"
+# TMDb movie details endpoint (credits appended for the director)
+TMDB_MOVIE_URL = "https://api.themoviedb.org/3/movie/{}"
+MICROSERVICE_WHERE_TO_WATCH_URL = "http://localhost:8082/watch"
+
+title_index.init_index()
+# Discover pages are cached individually so any num_of_movies can reuse them.
+# Expired copies are kept a while longer to serve while TMDb is down.
+discover_cache = cache_backend.get_cache("discover_pages", default_ttl=6 * 3600, stale_ttl=7 * 24 * 3600)
+details_cache = cache_backend.get_cache("movie_details", default_ttl=24 * 3600, stale_ttl=30 * 24 * 3600)
+prefetcher = prefetch.Prefetcher()
 
 def get_movies_by_title(title):
+    """
+    Search the local title index, falling back to TMDb on a miss. Returns
+    (results, stale); stale results are local matches served because TMDb
+    was unavailable.
+    """
+    try:
+        return title_index.search(title, fetch_movies_by_title), False
+    except requests.RequestException as e:
+        results = title_index.search_offline(title)
+        if not results:
+            raise
+        logger.warning("TMDB unavailable, serving local title matches", extra={"title": title, "error": repr(e)})
+        return results, True
+
+def fetch_movies_by_title(title):
     """Call TMDb API to search for movies by title."""
     params = {
         'api_key': TMDB_API_KEY,
         'query': title
     }
-    response = requests.get(TMDB_SEARCH_URL, params=params)
+    response = upstream.get("tmdb", "/search/movie", TMDB_SEARCH_URL, params=params)
     if response.status_code == 200:
         return response.json().get("results", [])
+    logger.warning("TMDB title search failed", extra={"status": response.status_code})
+    if circuit_breaker.is_failure(response.status_code):
+        response.raise_for_status()
     return []
 
-def get_movies_by_genre(genre, num_of_movies):
-    """Call TMDb API to search for movies by genre."""
-    all_movies = []
+def get_discover_page(genre, page):
+    """
+    Fetch one page of TMDb discover results for a genre, cached per page.
+    Returns (results, stale); if TMDb is unavailable the last cached copy is
+    returned as stale.
+    """
+    key = f"{genre}:{page}"
+    results = discover_cache.get(key)
+    if results is not None:
+        return results, False
+
+    params = {
+        'api_key': TMDB_API_KEY,
+        'with_genres': genre,
+        'sort_by': 'vote_average.desc',
+        'vote_count.gte': 100,
+        'page': page
+    }
+
+    try:
+        response = upstream.get("tmdb", "/discover/movie", TMDB_DISCOVER_URL, params=params)
+        if circuit_breaker.is_failure(response.status_code):
+            response.raise_for_status()
+    except requests.RequestException as e:
+        results = discover_cache.get_stale(key)
+        if results is None:
+            raise
+        logger.warning("TMDB unavailable, serving stale discover page", extra={"page": page, "error": repr(e)})
+        return results, True
+    if response.status_code != 200:
+        logger.warning("TMDB discover failed", extra={"status": response.status_code, "page": page})
+        return None, False
+
+    results = response.json().get("results", [])
+    discover_cache.set(key, results)
+    title_index.add_movies(results)
+    return results, False
+
+def iter_genre_pages(genre, num_of_movies):
+    """
+    Yield (movies, stale) for each discover page of a genre as it arrives,
+    up to num_of_movies movies in total. An unavailable first page raises;
+    an unavailable later page ends the sequence with an empty stale page.
+    """
+    remaining = num_of_movies
     page = 1
 
-    while len(all_movies) < num_of_movies:
-        params = {
-            'api_key': TMDB_API_KEY,
-            'with_genres': genre,
-            'sort_by': 'vote_average.desc',
-            'vote_count.gte': 100,
-            'page': page
-        }
-
-        response = requests.get(TMDB_DISCOVER_URL, params=params)
-        if response.status_code == 200:
-            results = response.json().get("results", [])
-            all_movies.extend(results)
-        else:
-            break
+    while remaining > 0:
+        try:
+            results, stale = get_discover_page(genre, page)
+        except requests.RequestException:
+            if page == 1:
+                raise
+            yield [], True
+            return
+        # Stop on errors and once TMDb runs out of pages
+        if not results:
+            return
+        yield results[:remaining], stale
+        remaining -= len(results)
 
         page += 1
 
-    return all_movies[:num_of_movies]
+def get_movies_by_genre(genre, num_of_movies):
+    """
+    Call TMDb API to search for movies by genre. Returns (movies, stale);
+    stale is set when any page came from an expired copy or a later page
+    could not be fetched.
+    """
+    all_movies = []
+    any_stale = False
+    for results, stale in iter_genre_pages(genre, num_of_movies):
+        all_movies.extend(results)
+        any_stale = any_stale or stale
+    return all_movies, any_stale
+
+def stream_movies_by_genre(genre, num_of_movies, fields):
+    """
+    Stream a genre listing as NDJSON, sending each page as soon as TMDb
+    returns it. The first page is fetched before responding so errors still
+    get a proper status; X-Data-Stale reflects that page. The last line is
+    {"_status": {"complete", "stale"}} covering every page, so a client can
+    tell a listing cut short by a failed later page (or a stream missing its
+    status line) from a complete one.
+    """
+    pages = iter_genre_pages(genre, num_of_movies)
+    first, stale = next(pages, ([], False))
+    if not first:
+        abort(404, description="No movies found for the specified genre.")
+    logger.info("Streaming genre query", extra={"genre": genre, "num_of_movies": num_of_movies})
+    prefetch_top_results(first)
+
+    def rows():
+        complete, any_stale = True, stale
+        yield from responses.project(first, fields)
+        try:
+            for results, page_stale in pages:
+                any_stale = any_stale or page_stale
+                # iter_genre_pages ends with an empty stale page when a later page is unavailable
+                complete = complete and (bool(results) or not page_stale)
+                yield from responses.project(results, fields)
+        except Exception as e:
+            logger.warning("Genre stream failed", extra={"genre": genre, "error": repr(e)})
+            complete = False
+        yield {responses.STREAM_STATUS_KEY: {"complete": complete, "stale": any_stale}}
+
+    return responses.ndjson_response(rows(), headers=responses.stale_headers(stale))
+
+def get_movie_details(movie_id):
+    """
+    Fetch a movie's TMDb details with credits, cached. Returns
+    (details, stale).
+    """
+    details = details_cache.get(movie_id)
+    if details is not None:
+        return details, False
+
+    params = {'api_key': TMDB_API_KEY, 'append_to_response': 'credits'}
+    try:
+        response = upstream.get("tmdb", "/movie/{id}", TMDB_MOVIE_URL.format(movie_id), params=params)
+        if circuit_breaker.is_failure(response.status_code):
+            response.raise_for_status()
+    except requests.RequestException:
+        details = details_cache.get_stale(movie_id)
+        if details is None:
+            raise
+        return details, True
+    if response.status_code != 200:
+        return None, False
+    details = response.json()
+    details_cache.set(movie_id, details)
+    return details, False
+
+def warm_watch_providers(movie_id, title):
+    """Ask the where-to-watch service to load a movie's providers into its cache."""
+    # Background priority without waiting: with no TMDB token free the service answers 503 at once
+    response = upstream.get("where_to_watch", "/watch/{title}/{movie_id}",
+                            f"{MICROSERVICE_WHERE_TO_WATCH_URL}/{quote(title)}/{movie_id}", timeout=10,
+                            headers={"X-Priority": "background", "X-Budget-Wait": "0",
+                                     "X-Client-Id": "prefetch:movie_search"})
+    if response.status_code == 503:
+        raise rate_budget.RateBudgetExceeded("where_to_watch has no TMDB budget for prefetching")
+
+def prefetch_top_results(results):
+    """Warm details and providers for the entries the user is likely to open next."""
+    if request.args.get('prefetch') == '0':
+        return
+    jobs = []
+    for movie in results[:prefetch.PREFETCH_TOP_K]:
+        movie_id, title = movie.get("id"), movie.get("title")
+        if not movie_id:
+            continue
+        jobs.append(lambda movie_id=movie_id: get_movie_details(movie_id))
+        if title:
+            jobs.append(lambda movie_id=movie_id, title=title: warm_watch_providers(movie_id, title))
+    client = request.headers.get("X-Client-Id") or request.remote_addr or "unknown"
+    prefetcher.submit(client, jobs)
 
 @app.route('/movies', methods=['GET'])
 def movies():
     title = request.args.get('title')
     genre = request.args.get('genre')
     num_of_movies = request.args.get('num_of_movies', default=20, type=int)
+    fields = responses.parse_fields(request.args.get('fields'))
 
     if title:
-        print("Searching by title...")
-        results = get_movies_by_title(title)
+        logger.debug("Searching by title", extra={"title": title})
+        results, stale = get_movies_by_title(title)
         if not results:
             abort(404, description="No movies found for search entry.")
-        print("Movie search successful!")
-        return jsonify(results)
+        logger.info("Movie search successful", extra={"title": title, "results": len(results)})
+        prefetch_top_results(results)
+        return responses.json_response(responses.project(results, fields), headers=responses.stale_headers(stale))
     elif genre:
-        print("Searching by genre...")
-        results = get_movies_by_genre(genre, num_of_movies)
+        logger.debug("Searching by genre", extra={"genre": genre, "num_of_movies": num_of_movies})
+        if request.args.get('stream') == '1':
+            return stream_movies_by_genre(genre, num_of_movies, fields)
+        results, stale = get_movies_by_genre(genre, num_of_movies)
         if not results:
             abort(404, description="No movies found for the specified genre.")
-        print("Genre query successful!")
-        return jsonify(results)
+        logger.info("Genre query successful", extra={"genre": genre, "results": len(results)})
+        prefetch_top_results(results)
+        return responses.json_response(responses.project(results, fields), headers=responses.stale_headers(stale))
     else:
         abort(400, description="Invalid request. Provide either a 'title' or 'genre' query parameter.")
 
+@app.route('/movies/<int:movie_id>', methods=['GET'])
+def movie_details(movie_id):
+    details, stale = get_movie_details(movie_id)
+    if not details:
+        abort(404, description="Movie not found.")
+    return responses.json_response(details, headers=responses.stale_headers(stale))
+
+@app.route('/genres', methods=['GET'])
+def genres():
+    name = request.args.get('name')
+    if name:
+        genre_id = genre_catalog.id_for(name)
+        if genre_id is None:
+            abort(404, description="Genre not found.")
+        return jsonify({"id": genre_id, "name": genre_catalog.name_for(genre_id)})
+    return responses.json_response(genre_catalog.all())
+
 def run_movie_search_service():
+    genre_catalog.load()
+    title_index.import_reviewed_movies()
     app.run(port=8080)
 
 @app.errorhandler(404)
@@ -0,0 +1,81 @@
+"""
+Background prefetching for result lists.
+
+When a service serves a list of movies, the user usually opens one of the
+first few next. Prefetcher.submit() queues warm-up jobs for those entries on
+a small pool of PREFETCH_WORKERS threads. Jobs run at background priority in
+the shared TMDB rate budget and give up immediately rather than wait for a
+token, at most PREFETCH_QUEUE_LIMIT jobs may be pending, and a new list for
+the same client cancels whatever is still pending from its previous one.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import rate_budget
+from service_logging import get_logger
+
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1").lower() in ("1", "true", "yes")
+PREFETCH_TOP_K = int(os.getenv("PREFETCH_TOP_K", "3"))
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "4"))
+PREFETCH_QUEUE_LIMIT = int(os.getenv("PREFETCH_QUEUE_LIMIT", "64"))
+
+PREFETCH_JOBS = metrics.register(metrics.Counter(
+    "prefetch_jobs_total",
+    "Prefetch jobs by outcome",
+    ("service", "outcome"),
+))
+
+logger = get_logger("prefetch")
+
+
+class Prefetcher:
+    def __init__(self, workers=PREFETCH_WORKERS, queue_limit=PREFETCH_QUEUE_LIMIT):
+        self.queue_limit = queue_limit
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self._pending = {}
+        self._count = 0
+        # Re-entrant: done callbacks may run inline while submit() holds the lock
+        self._lock = threading.RLock()
+
+    def submit(self, client, jobs):
+        """
+        param: client:- Key whose previous pending jobs should be cancelled
+        param: jobs:- Callables that warm a cache; each runs at most once
+        """
+        if not PREFETCH_ENABLED:
+            return
+        with self._lock:
+            for future in self._pending.pop(client, []):
+                if future.cancel():
+                    self._count -= 1
+                    PREFETCH_JOBS.inc(metrics.SERVICE_NAME, "cancelled")
+
+            futures = []
+            for job in jobs:
+                if self._count >= self.queue_limit:
+                    PREFETCH_JOBS.inc(metrics.SERVICE_NAME, "dropped")
+                    continue
+                self._count += 1
+                future = self._executor.submit(self._run, job)
+                future.add_done_callback(self._finished)
+                futures.append(future)
+            self._pending[client] = futures
+            if len(self._pending) > 1000:
+                self._pending = {c: fs for c, fs in self._pending.items() if not all(f.done() for f in fs)}
+
+    def _finished(self, future):
+        if not future.cancelled():
+            with self._lock:
+                self._count -= 1
+
+    def _run(self, job):
+        try:
+            with rate_budget.priority(rate_budget.BACKGROUND, max_wait=0):
+                job()
+            PREFETCH_JOBS.inc(metrics.SERVICE_NAME, "done")
+        except rate_budget.RateBudgetExceeded:
+            PREFETCH_JOBS.inc(metrics.SERVICE_NAME, "no_budget")
+        except Exception as e:
+            PREFETCH_JOBS.inc(metrics.SERVICE_NAME, "failed")
+            logger.debug("Prefetch job failed", extra={"error": repr(e)})
@@ -0,0 +1,238 @@
+"""
+Opt-in per-request profiling for the microservices.
+
+Profiling is off unless PROFILING_ENABLED=1. When enabled, a request carrying
+an `X-Profile` header or a `profile` query parameter is profiled:
+ - "sample" (default): a background thread samples the stacks of every busy
+   thread in the process every PROFILE_INTERVAL_MS (default 5) and stores
+   them as collapsed stacks (<id>.folded), so work handed to thread pools is
+   captured too
+ - "cprofile": cProfile runs around the request thread (<id>.prof)
+
+Profiles are written to PROFILE_DIR (default "profiles") and the file name is
+returned in the X-Profile-Id response header.
+
+`python profiling.py collapse <files or dirs> [-o out.folded]` merges stored
+profiles into one flame-graph-ready collapsed stack file. cProfile output has
+no full call paths, so each function is attributed along its most expensive
+caller chain.
+"""
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0").lower() in ("1", "true", "yes")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+
+# Leaf frames of threads that are parked rather than doing work
+_IDLE_LEAVES = {
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("socketserver.py", "serve_forever"),
+    ("thread.py", "_worker"),
+}
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def _collapse_frame(frame):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiling-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.samples
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in _IDLE_LEAVES:
+                    continue
+                thread_name = names.get(ident, str(ident))
+                self.samples[f"{thread_name};{_collapse_frame(frame)}"] += 1
+
+
+def write_folded(samples, path):
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+
+
+def start(mode):
+    """
+    param: mode:- "sample" or "cprofile"
+    Start profiling the current request and return a handle for stop()
+    """
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        mode = "sample"
+        profiler = SamplingProfiler()
+        profiler.start()
+    return mode, profiler
+
+
+def stop(handle, service_name):
+    """
+    param: handle:- Value returned by start()
+    param: service_name:- Prefix for the stored file name
+    Stop profiling and store the result, returning the profile file name
+    """
+    mode, profiler = handle
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profile_id = f"{service_name}-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    if mode == "cprofile":
+        profiler.disable()
+        filename = f"{profile_id}.prof"
+        profiler.dump_stats(os.path.join(PROFILE_DIR, filename))
+    else:
+        filename = f"{profile_id}.folded"
+        write_folded(profiler.stop(), os.path.join(PROFILE_DIR, filename))
+    return filename
+
+
+def instrument_app(app, service_name):
+    """
+    param: app:- The service's Flask app
+    param: service_name:- Prefix for stored profile files
+    Profile requests that ask for it when PROFILING_ENABLED is set
+    """
+    if not PROFILING_ENABLED:
+        return app
+
+    from flask import g, request
+
+    @app.before_request
+    def _start_profile():
+        mode = request.headers.get("X-Profile") or request.args.get("profile")
+        if mode:
+            g._profile_handle = start(mode.lower())
+
+    @app.after_request
+    def _store_profile(response):
+        handle = g.pop("_profile_handle", None)
+        if handle is not None:
+            response.headers["X-Profile-Id"] = stop(handle, service_name)
+        return response
+
+    @app.teardown_request
+    def _discard_profile(error=None):
+        # Only reached with a live handle when the request raised
+        handle = g.pop("_profile_handle", None)
+        if handle is not None:
+            stop(handle, service_name)
+
+    return app
+
+
+def _cprofile_to_folded(path):
+    """
+    param: path:- A stored .prof file
+    Attribute each function's own time along its most expensive caller chain
+    """
+    stats = pstats.Stats(path).stats
+    samples = Counter()
+
+    def label(func):
+        filename, _, name = func
+        return f"{os.path.basename(filename)}:{name}"
+
+    for func, (_, _, tottime, _, callers) in stats.items():
+        weight = int(tottime * 1_000_000)
+        if weight <= 0:
+            continue
+        chain = [label(func)]
+        seen = {func}
+        current = callers
+        while current:
+            parent = max(current, key=lambda caller: current[caller][3])
+            if parent in seen or parent not in stats:
+                break
+            seen.add(parent)
+            chain.append(label(parent))
+            current = stats[parent][4]
+        samples[";".join(reversed(chain))] += weight
+    return samples
+
+
+def _read_folded(path):
+    samples = Counter()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if stack and count.isdigit():
+                samples[stack] += int(count)
+    return samples
+
+
+def collapse(paths):
+    """
+    param: paths:- Profile files or directories containing them
+    Merge .folded and .prof files into a single Counter of collapsed stacks
+    """
+    merged = Counter()
+    for path in paths:
+        files = [os.path.join(path, name) for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+        for file in files:
+            if file.endswith(".folded"):
+                merged.update(_read_folded(file))
+            elif file.endswith(".prof"):
+                merged.update(_cprofile_to_folded(file))
+    return merged
+
+
+def main(argv):
+    if not argv or argv[0] != "collapse" or len(argv) < 2:
+        print("usage: python profiling.py collapse <files or dirs> [-o out.folded]")
+        return 1
+    args = argv[1:]
+    output = None
+    if "-o" in args:
+        index = args.index("-o")
+        output = args[index + 1]
+        args = args[:index] + args[index + 2:]
+
+    merged = collapse(args)
+    if output:
+        write_folded(merged, output)
+    else:
+        for stack, count in merged.most_common():
+            print(f"{stack} {count}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
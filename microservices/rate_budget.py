@@ -0,0 +1,297 @@
+"""
+Shared TMDB rate budget and per-client admission control.
+
+Upstream budget: every process that calls TMDB draws tokens from one token
+bucket kept in rate_budget.db, so the CLI and all four services together stay
+under TMDB_RATE_LIMIT requests per second (burst TMDB_BURST). Updates run in
+a BEGIN IMMEDIATE transaction, which makes SQLite's file lock the
+cross-process mutex. Calls run at one of two priorities:
+ - interactive (default): may drain the bucket, waits up to RATE_BUDGET_WAIT
+   seconds for a token
+ - background: may only use tokens above BACKGROUND_RESERVE of the burst, so
+   refresh/prefetch/import work never starves user-facing requests
+
+Admission control: install_admission(app) gives each client (X-Client-Id
+header or remote address) an in-process token bucket of ADMISSION_RATE
+requests per second and caps concurrent requests at ADMISSION_MAX_INFLIGHT.
+Requests over either limit get 429 with Retry-After instead of queueing. A
+request holds its in-flight slot until its response is closed, so a
+streamed body counts until it has been sent.
+"""
+import contextvars
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import requests
+import deadline
+import metrics
+
+RATE_BUDGET_DB = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "rate_budget.db"))
+TMDB_RATE_LIMIT = float(os.getenv("TMDB_RATE_LIMIT", "40"))
+TMDB_BURST = float(os.getenv("TMDB_BURST", "40"))
+BACKGROUND_RESERVE = float(os.getenv("BACKGROUND_RESERVE", "0.5"))
+RATE_BUDGET_WAIT = float(os.getenv("RATE_BUDGET_WAIT", "2"))
+BACKGROUND_WAIT = float(os.getenv("BACKGROUND_RATE_BUDGET_WAIT", "30"))
+# Upper bound on the per-token wait a caller may ask for with X-Budget-Wait
+MAX_BUDGET_WAIT = float(os.getenv("MAX_BUDGET_WAIT", "30"))
+
+ADMISSION_RATE = float(os.getenv("ADMISSION_RATE", "20"))
+ADMISSION_BURST = float(os.getenv("ADMISSION_BURST", "40"))
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", "64"))
+# Routes that must stay reachable while a service is shedding load
+ADMISSION_EXEMPT = {"/metrics", "/traces"}
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+BUDGET_WAIT = metrics.register(metrics.Histogram(
+    "rate_budget_wait_seconds",
+    "Time spent waiting for an upstream rate budget token",
+    ("service", "upstream", "priority"),
+))
+BUDGET_DENIED = metrics.register(metrics.Counter(
+    "rate_budget_denied_total",
+    "Upstream calls refused because no token arrived in time",
+    ("service", "upstream", "priority"),
+))
+ADMISSION_REJECTED = metrics.register(metrics.Counter(
+    "admission_rejected_total",
+    "Requests answered with 429 by admission control",
+    ("service", "reason"),
+))
+
+_priority = contextvars.ContextVar("rate_priority", default=INTERACTIVE)
+_max_wait = contextvars.ContextVar("rate_max_wait", default=None)
+
+
+class RateBudgetExceeded(requests.RequestException):
+    """No upstream token became available within the caller's wait limit"""
+
+
+@contextmanager
+def priority(level, max_wait=None):
+    """
+    param: level:- INTERACTIVE or BACKGROUND
+    param: max_wait:- Longest to wait for each token (defaults by priority)
+    Run the enclosed upstream calls at the given priority
+    """
+    token = _priority.set(level)
+    wait_token = _max_wait.set(max_wait)
+    try:
+        yield
+    finally:
+        _max_wait.reset(wait_token)
+        _priority.reset(token)
+
+
+def current_priority():
+    return _priority.get()
+
+
+class SharedTokenBucket:
+    def __init__(self, name, rate, burst, db_path=RATE_BUDGET_DB):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Losing a few tokens of state on a crash is harmless
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    name TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                )""")
+            self._local.conn = conn
+        return conn
+
+    def try_take(self, reserve=0.0):
+        """
+        param: reserve:- Tokens that must remain in the bucket afterwards
+        Take one token if available; otherwise return seconds until one is
+        """
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (self.name,)).fetchone()
+            tokens = self.burst if row is None else min(self.burst, row[0] + (now - row[1]) * self.rate)
+            if tokens - 1 >= reserve:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (reserve + 1 - tokens) / self.rate
+            conn.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                         (self.name, tokens, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def acquire(self, level=INTERACTIVE, timeout=None):
+        """
+        param: level:- INTERACTIVE or BACKGROUND
+        param: timeout:- Longest to wait for a token (defaults by priority)
+        Block until a token is taken; return False if the wait would exceed timeout
+        """
+        reserve = self.burst * BACKGROUND_RESERVE if level == BACKGROUND else 0.0
+        if timeout is None:
+            timeout = BACKGROUND_WAIT if level == BACKGROUND else RATE_BUDGET_WAIT
+        start = time.monotonic()
+        deadline = start + timeout
+        while True:
+            wait = self.try_take(reserve)
+            if wait == 0:
+                BUDGET_WAIT.observe(metrics.SERVICE_NAME, self.name, level, value=time.monotonic() - start)
+                return True
+            remaining = deadline - time.monotonic()
+            if wait > remaining:
+                BUDGET_DENIED.inc(metrics.SERVICE_NAME, self.name, level)
+                return False
+            time.sleep(wait)
+
+
+_buckets = {"tmdb": SharedTokenBucket("tmdb", TMDB_RATE_LIMIT, TMDB_BURST)}
+
+
+def acquire(upstream, timeout=None):
+    """
+    param: upstream:- Upstream name; only budgeted upstreams are limited
+    param: timeout:- Longest to wait for a token
+    Take a token for one call at the current priority or raise RateBudgetExceeded
+    """
+    bucket = _buckets.get(upstream)
+    if bucket is None:
+        return
+    level = current_priority()
+    if timeout is None:
+        timeout = _max_wait.get()
+    if timeout is None:
+        timeout = BACKGROUND_WAIT if level == BACKGROUND else RATE_BUDGET_WAIT
+    if not bucket.acquire(level, deadline.cap(timeout)):
+        raise RateBudgetExceeded(f"{upstream} rate budget exhausted for {level} requests")
+
+
+class _ClientBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, now, tokens):
+        self.tokens = tokens
+        self.updated = now
+
+
+class AdmissionController:
+    def __init__(self, rate=ADMISSION_RATE, burst=ADMISSION_BURST, max_inflight=ADMISSION_MAX_INFLIGHT):
+        self.rate = rate
+        self.burst = burst
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def admit(self, client):
+        """
+        param: client:- Client identifier
+        Return 0 if admitted (caller must call release()), else seconds to retry after
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.inflight >= self.max_inflight:
+                return 1.0
+            bucket = self._clients.get(client)
+            if bucket is None:
+                if len(self._clients) > 10000:
+                    self._prune(now)
+                bucket = self._clients[client] = _ClientBucket(now, self.burst)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            if bucket.tokens < 1:
+                return (1 - bucket.tokens) / self.rate
+            bucket.tokens -= 1
+            self.inflight += 1
+            return 0
+
+    def release(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def _prune(self, now):
+        # Clients idle long enough to have refilled completely carry no state worth keeping
+        idle = self.burst / self.rate
+        self._clients = {c: b for c, b in self._clients.items() if now - b.updated < idle}
+
+
+def install_admission(app, controller=None):
+    """
+    param: app:- The service's Flask app
+    param: controller:- AdmissionController to use (one per app by default)
+    Reject over-limit requests with 429, honour the X-Priority and
+    X-Budget-Wait (longest seconds to wait for each upstream token, at most
+    MAX_BUDGET_WAIT) headers and turn an exhausted upstream budget into 503 with Retry-After
+    """
+    from flask import g, jsonify, request
+
+    controller = controller or AdmissionController()
+
+    @app.before_request
+    def _admit():
+        if request.path in ADMISSION_EXEMPT:
+            return None
+        client = request.headers.get("X-Client-Id") or request.remote_addr or "unknown"
+        retry_after = controller.admit(client)
+        if retry_after:
+            reason = "inflight" if controller.inflight >= controller.max_inflight else "client_rate"
+            ADMISSION_REJECTED.inc(metrics.SERVICE_NAME, reason)
+            response = jsonify({"Error": "Too many requests, please retry later"})
+            response.status_code = 429
+            response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+            return response
+        g._admitted = True
+        if request.headers.get("X-Priority", "").lower() == BACKGROUND:
+            g._priority_token = _priority.set(BACKGROUND)
+        try:
+            max_wait = float(request.headers["X-Budget-Wait"])
+        except (KeyError, ValueError):
+            max_wait = None
+        if max_wait is not None and math.isfinite(max_wait) and max_wait >= 0:
+            g._max_wait_token = _max_wait.set(min(max_wait, MAX_BUDGET_WAIT))
+        return None
+
+    @app.after_request
+    def _release_on_close(response):
+        # A streamed body is still being sent after teardown, so the slot is freed on close
+        if g.pop("_admitted", False):
+            response.call_on_close(controller.release)
+        return response
+
+    @app.errorhandler(RateBudgetExceeded)
+    def _budget_exhausted(error):
+        response = jsonify({"Error": "Upstream rate budget exhausted, please retry later"})
+        response.status_code = 503
+        response.headers["Retry-After"] = "1"
+        return response
+
+    @app.teardown_request
+    def _release(error=None):
+        # Only still set if the response never reached after_request
+        if g.pop("_admitted", False):
+            controller.release()
+        token = g.pop("_priority_token", None)
+        if token is not None:
+            _priority.reset(token)
+        wait_token = g.pop("_max_wait_token", None)
+        if wait_token is not None:
+            _max_wait.reset(wait_token)
+
+    return controller
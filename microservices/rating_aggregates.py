@@ -0,0 +1,378 @@
+"""
+Community rating aggregates, maintained incrementally in movies.db.
+
+movie_ratings keeps count, sum and sum of squares of every movie's ratings
+plus a Bayesian-average score, (PRIOR_WEIGHT * PRIOR_MEAN + sum) /
+(PRIOR_WEIGHT + count), so a movie needs several good ratings to outrank a
+well-reviewed one. The prior is fixed rather than the live global mean, which
+keeps every update O(genres of the movie) instead of re-scoring all movies.
+genre_ratings keeps the same sums per TMDB genre, and movie_genres links
+movies to genres with a copy of the score, indexed by (genre_id, score), so a
+genre's top list is an index range scan of k rows whatever the review volume.
+
+Writers call record_review()/remove_review()/apply_reviews() on their own
+connection inside the transaction that changes `reviews`, so aggregates
+never drift from the table. init_db() fills the aggregates from existing
+reviews the first time it runs on a database, and rebuild() recomputes
+everything from scratch.
+
+Genre links come from the genre ids writers pass in. link_missing_genres()
+links reviewed movies that have none (reviews older than the aggregates,
+imports whose titles had no genres) from the title index, and optionally
+from TMDB details for movies the index has no genres for.
+
+usage: python rating_aggregates.py rebuild [--db movies.db] [--fetch-genres]
+"""
+import argparse
+import math
+import os
+import sqlite3
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import catalog_import
+import metrics
+import title_index
+from service_logging import get_logger
+
+MOVIES_REVIEWS_DB = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "movies.db"))
+PRIOR_MEAN = float(os.getenv("RATING_PRIOR_MEAN", "6.5"))
+PRIOR_WEIGHT = float(os.getenv("RATING_PRIOR_WEIGHT", "5"))
+MAX_TOP_LIMIT = 100
+# Movies linked per transaction by link_missing_genres()
+GENRE_LINK_BATCH = 500
+
+logger = get_logger("rating_aggregates")
+
+
+def init_db(conn):
+    """
+    param: conn:- Connection to movies.db
+    Create the aggregate tables and indexes if needed, and fill them from
+    the reviews already in the database the first time
+    """
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS movie_ratings (
+            movie_id INTEGER PRIMARY KEY REFERENCES movies(id),
+            review_count INTEGER NOT NULL,
+            rating_sum REAL NOT NULL,
+            rating_sumsq REAL NOT NULL,
+            score REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_movie_ratings_score ON movie_ratings (score DESC);
+
+        CREATE TABLE IF NOT EXISTS movie_genres (
+            movie_id INTEGER NOT NULL REFERENCES movies(id),
+            genre_id INTEGER NOT NULL,
+            score REAL,
+            PRIMARY KEY (movie_id, genre_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_movie_genres_score ON movie_genres (genre_id, score DESC);
+
+        CREATE TABLE IF NOT EXISTS genre_ratings (
+            genre_id INTEGER PRIMARY KEY,
+            review_count INTEGER NOT NULL,
+            rating_sum REAL NOT NULL,
+            rating_sumsq REAL NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS rating_aggregates_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """)
+    backfilled = conn.execute("SELECT 1 FROM rating_aggregates_meta WHERE key = 'backfilled'").fetchone()
+    has_reviews = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'reviews'").fetchone()
+    if not backfilled and has_reviews:
+        with conn:
+            _recompute(conn)
+        logger.info("Filled rating aggregates from existing reviews")
+
+
+def bayes_score(count, total):
+    return (PRIOR_WEIGHT * PRIOR_MEAN + total) / (PRIOR_WEIGHT + count)
+
+
+def _add_to_genres(conn, movie_id, count, total, total_sq, genre_ids=None):
+    """Add (or with negative values, subtract) rating sums to the movie's genres"""
+    if genre_ids is None:
+        genre_ids = [g for (g,) in conn.execute("SELECT genre_id FROM movie_genres WHERE movie_id = ?",
+                                                (movie_id,))]
+    conn.executemany("""
+        INSERT INTO genre_ratings (genre_id, review_count, rating_sum, rating_sumsq) VALUES (?, ?, ?, ?)
+        ON CONFLICT (genre_id) DO UPDATE SET
+            review_count = review_count + excluded.review_count,
+            rating_sum = rating_sum + excluded.rating_sum,
+            rating_sumsq = rating_sumsq + excluded.rating_sumsq
+    """, [(genre_id, count, total, total_sq) for genre_id in genre_ids])
+
+
+def link_genres(conn, movie_id, genre_ids):
+    """
+    param: conn:- Connection to movies.db, inside the caller's transaction
+    param: movie_id:- movies.id
+    param: genre_ids:- TMDB genre ids of the movie
+    Link a movie to its genres, carrying any existing ratings over to them
+    """
+    existing = {g for (g,) in conn.execute("SELECT genre_id FROM movie_genres WHERE movie_id = ?", (movie_id,))}
+    new = [genre_id for genre_id in set(genre_ids or ()) if genre_id not in existing]
+    if not new:
+        return
+    row = conn.execute("SELECT review_count, rating_sum, rating_sumsq, score FROM movie_ratings WHERE movie_id = ?",
+                       (movie_id,)).fetchone()
+    score = row[3] if row else None
+    conn.executemany("INSERT INTO movie_genres (movie_id, genre_id, score) VALUES (?, ?, ?)",
+                     [(movie_id, genre_id, score) for genre_id in new])
+    if row:
+        _add_to_genres(conn, movie_id, row[0], row[1], row[2], new)
+
+
+def movies_without_genres(conn):
+    """
+    param: conn:- Connection to movies.db
+    Return (movie_id, tmdb_id) for reviewed movies not linked to any genre
+    """
+    return conn.execute("""
+        SELECT movies.id, movies.tmdb_id FROM movies
+        WHERE movies.id IN (SELECT movie_id FROM reviews)
+          AND movies.tmdb_id IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM movie_genres WHERE movie_genres.movie_id = movies.id)
+    """).fetchall()
+
+
+def link_missing_genres(conn, fetch_details=None, workers=8):
+    """
+    param: conn:- Connection to movies.db
+    param: fetch_details:- Optional function returning a movie's TMDB details
+                           (or None), for movies the title index has no genres for
+    param: workers:- Concurrent fetch_details calls
+    Link reviewed movies without genres, GENRE_LINK_BATCH per transaction,
+    and return how many were linked. Fetched details are added to the title index.
+    """
+    missing = movies_without_genres(conn)
+    if not missing:
+        return 0
+    title_index.init_index()
+    linked = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(missing), GENRE_LINK_BATCH):
+            batch = missing[start:start + GENRE_LINK_BATCH]
+            known = title_index.genre_ids(tmdb_id for _, tmdb_id in batch)
+            unknown = [tmdb_id for _, tmdb_id in batch if tmdb_id not in known]
+            if fetch_details and unknown:
+                details = [d for d in executor.map(fetch_details, unknown) if d]
+                if details:
+                    title_index.add_movies(details)
+                known.update((d["id"], [genre["id"] for genre in d.get("genres") or []]) for d in details)
+            try:
+                with conn:
+                    for movie_id, tmdb_id in batch:
+                        if known.get(tmdb_id):
+                            link_genres(conn, movie_id, known[tmdb_id])
+                            linked += 1
+            except sqlite3.IntegrityError:
+                # A review added meanwhile linked one of these movies; the rest wait for the next run
+                logger.warning("Genre links changed during backfill, batch skipped", extra={"movies": len(batch)})
+    if linked:
+        logger.info("Linked genres for reviewed movies", extra={"linked": linked, "missing": len(missing)})
+    return linked
+
+
+def apply_reviews(conn, changes):
+    """
+    param: conn:- Connection to movies.db, inside the caller's transaction
+    param: changes:- (movie_id, rating, sign) tuples; sign is 1 for an added
+                     review and -1 for a removed one
+    Fold added/removed reviews into the movie and genre aggregates
+    """
+    deltas = defaultdict(lambda: [0, 0.0, 0.0])
+    for movie_id, rating, sign in changes:
+        delta = deltas[movie_id]
+        delta[0] += sign
+        delta[1] += sign * rating
+        delta[2] += sign * rating * rating
+
+    with metrics.time_query("movies", "update_rating_aggregates"):
+        for movie_id, (count, total, total_sq) in deltas.items():
+            if count == 0 and total == 0:
+                continue
+            conn.execute("""
+                INSERT INTO movie_ratings (movie_id, review_count, rating_sum, rating_sumsq, score)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (movie_id) DO UPDATE SET
+                    review_count = review_count + excluded.review_count,
+                    rating_sum = rating_sum + excluded.rating_sum,
+                    rating_sumsq = rating_sumsq + excluded.rating_sumsq,
+                    score = (? + rating_sum + excluded.rating_sum) / (? + review_count + excluded.review_count)
+            """, (movie_id, count, total, total_sq, bayes_score(count, total),
+                  PRIOR_WEIGHT * PRIOR_MEAN, PRIOR_WEIGHT))
+            # A movie with no reviews left drops out of every top list
+            conn.execute("DELETE FROM movie_ratings WHERE movie_id = ? AND review_count <= 0", (movie_id,))
+            conn.execute("""
+                UPDATE movie_genres SET score = (SELECT score FROM movie_ratings WHERE movie_id = ?)
+                WHERE movie_id = ?
+            """, (movie_id, movie_id))
+            _add_to_genres(conn, movie_id, count, total, total_sq)
+
+
+def record_review(conn, movie_id, rating):
+    apply_reviews(conn, [(movie_id, rating, 1)])
+
+
+def remove_review(conn, movie_id, rating):
+    apply_reviews(conn, [(movie_id, rating, -1)])
+
+
+def _stats(count, total, total_sq):
+    average = total / count
+    variance = max(0.0, total_sq / count - average * average)
+    return round(average, 2), round(math.sqrt(variance), 2)
+
+
+def top_movies(conn, genre_id=None, limit=10, min_reviews=1):
+    """
+    param: conn:- Connection to movies.db
+    param: genre_id:- TMDB genre id, or None for all movies
+    param: limit:- Number of movies to return
+    param: min_reviews:- Skip movies with fewer reviews
+    Return the community's highest-scored movies, best first
+    """
+    limit = max(1, min(int(limit), MAX_TOP_LIMIT))
+    if genre_id is None:
+        sql = """
+            SELECT movies.tmdb_id, movies.title, movies.release_year,
+                   r.score, r.review_count, r.rating_sum, r.rating_sumsq
+            FROM movie_ratings AS r
+            JOIN movies ON movies.id = r.movie_id
+            WHERE r.review_count >= ?
+            ORDER BY r.score DESC
+            LIMIT ?
+        """
+        params = (min_reviews, limit)
+    else:
+        sql = """
+            SELECT movies.tmdb_id, movies.title, movies.release_year,
+                   r.score, r.review_count, r.rating_sum, r.rating_sumsq
+            FROM movie_genres AS g
+            JOIN movie_ratings AS r ON r.movie_id = g.movie_id
+            JOIN movies ON movies.id = g.movie_id
+            WHERE g.genre_id = ? AND g.score IS NOT NULL AND r.review_count >= ?
+            ORDER BY g.score DESC
+            LIMIT ?
+        """
+        params = (genre_id, min_reviews, limit)
+
+    with metrics.time_query("movies", "community_top"):
+        rows = conn.execute(sql, params).fetchall()
+
+    top = []
+    for tmdb_id, title, year, score, count, total, total_sq in rows:
+        average, stddev = _stats(count, total, total_sq)
+        top.append({"tmdb_id": tmdb_id, "title": title, "release_year": year, "score": round(score, 2),
+                    "reviews": count, "average": average, "stddev": stddev})
+    return top
+
+
+def genre_summary(conn, genre_id):
+    """
+    param: conn:- Connection to movies.db
+    param: genre_id:- TMDB genre id
+    Return review count, average and standard deviation for a genre, or None
+    """
+    row = conn.execute("SELECT review_count, rating_sum, rating_sumsq FROM genre_ratings WHERE genre_id = ?",
+                       (genre_id,)).fetchone()
+    if not row or row[0] <= 0:
+        return None
+    average, stddev = _stats(*row)
+    return {"reviews": row[0], "average": average, "stddev": stddev}
+
+
+def _recompute(conn):
+    """Recompute every aggregate from `reviews`, inside the caller's transaction"""
+    conn.execute("DELETE FROM movie_ratings")
+    conn.execute("DELETE FROM genre_ratings")
+    conn.execute("""
+        INSERT INTO movie_ratings (movie_id, review_count, rating_sum, rating_sumsq, score)
+        SELECT movie_id, COUNT(*), SUM(rating), SUM(rating * rating),
+               (? + SUM(rating)) / (? + COUNT(*))
+        FROM reviews
+        WHERE movie_id IS NOT NULL AND rating IS NOT NULL
+        GROUP BY movie_id
+    """, (PRIOR_WEIGHT * PRIOR_MEAN, PRIOR_WEIGHT))
+    conn.execute("""
+        UPDATE movie_genres SET score = (
+            SELECT score FROM movie_ratings WHERE movie_ratings.movie_id = movie_genres.movie_id
+        )
+    """)
+    conn.execute("""
+        INSERT INTO genre_ratings (genre_id, review_count, rating_sum, rating_sumsq)
+        SELECT g.genre_id, SUM(r.review_count), SUM(r.rating_sum), SUM(r.rating_sumsq)
+        FROM movie_genres AS g
+        JOIN movie_ratings AS r ON r.movie_id = g.movie_id
+        GROUP BY g.genre_id
+    """)
+    conn.execute("INSERT OR REPLACE INTO rating_aggregates_meta (key, value) VALUES ('backfilled', CURRENT_TIMESTAMP)")
+
+
+def rebuild(conn):
+    """
+    param: conn:- Connection to movies.db
+    Recompute every aggregate from `reviews` in one transaction and return
+    how many movie and genre rows differed from the incremental values
+    """
+    init_db(conn)
+    with conn:
+        before_movies = {row[0]: row[1:] for row in conn.execute(
+            "SELECT movie_id, review_count, rating_sum, rating_sumsq FROM movie_ratings")}
+        before_genres = {row[0]: row[1:] for row in conn.execute(
+            "SELECT genre_id, review_count, rating_sum, rating_sumsq FROM genre_ratings")}
+
+        _recompute(conn)
+
+        after_movies = {row[0]: row[1:] for row in conn.execute(
+            "SELECT movie_id, review_count, rating_sum, rating_sumsq FROM movie_ratings")}
+        after_genres = {row[0]: row[1:] for row in conn.execute(
+            "SELECT genre_id, review_count, rating_sum, rating_sumsq FROM genre_ratings")}
+
+    return {
+        "movies": len(after_movies),
+        "genres": len(after_genres),
+        "movies_changed": _count_changed(before_movies, after_movies),
+        "genres_changed": _count_changed(before_genres, after_genres),
+    }
+
+
+def _count_changed(before, after):
+    changed = 0
+    for key in before.keys() | after.keys():
+        old, new = before.get(key), after.get(key)
+        # Genres/movies whose reviews were all removed keep a zero row until rebuilt
+        if old is not None and new is None and old[0] == 0:
+            continue
+        if old is None or new is None or old[0] != new[0] or any(
+                not math.isclose(a, b, abs_tol=1e-6) for a, b in zip(old[1:], new[1:])):
+            changed += 1
+    return changed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Maintain community rating aggregates")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = subparsers.add_parser("rebuild", help="Recompute all aggregates from the reviews table")
+    rebuild_parser.add_argument("--db", default=MOVIES_REVIEWS_DB)
+    rebuild_parser.add_argument("--fetch-genres", action="store_true",
+                                help="Look up genres on TMDB for movies the title index has none for")
+    args = parser.parse_args(argv)
+
+    with sqlite3.connect(args.db) as conn:
+        init_db(conn)
+        linked = link_missing_genres(conn, catalog_import.fetch_details if args.fetch_genres else None)
+        result = rebuild(conn)
+    logger.info("Rebuilt rating aggregates", extra=result)
+    print(f"{linked} movies linked to their genres; {result['movies']} movies and {result['genres']} genres rebuilt; "
+          f"{result['movies_changed']} movie and {result['genres_changed']} genre aggregates differed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
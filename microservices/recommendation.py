@@ -1,162 +1,372 @@
-from flask import Flask, request, jsonify
-import requests
+from flask import Flask, Response, request, jsonify
+import io
 import sqlite3
 import os
-import random
-#from dotenv import load_dotenv
-from functools import lru_cache
-from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import requests
+
+# Before the helpers below, some of which (auth) read their settings on import
+load_dotenv()
+
+import auth
+import cache_backend
+import candidate_pool
+import catalog_import
+import circuit_breaker
+import deadline
+import metrics
+import review_io
+import review_query
+from genre_catalog import catalog as genre_catalog
+import profiling
+import rate_budget
+import rating_aggregates
+import responses
+import tracing
+import upstream
+from service_logging import get_logger
 
 MOVIES_REVIEWS_DB = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "movies.db"))
 MICROSERVICE_SEARCH_URL = "http://localhost:8080/movies"
+# Similar-movie lookups are seeded from the user's best-rated reviews only
+LIKED_RATING = 7
+RECOMMENDATION_SEEDS = int(os.getenv("RECOMMENDATION_SEEDS", "20"))
+# Similar-movie lookups from every request share one pool of RECOMMENDATION_WORKERS
+# threads; a request answers with whatever finished within its deadline
+RECOMMENDATION_WORKERS = int(os.getenv("RECOMMENDATION_WORKERS", "8"))
+RECOMMENDATION_DEADLINE_SECONDS = float(os.getenv("RECOMMENDATION_DEADLINE_SECONDS", "3"))
+
+RECOMMENDATION_LOOKUPS = metrics.register(metrics.Counter(
+    "recommendation_lookups_total",
+    "Similar-movie lookups by outcome (completed, dropped at the deadline, failed)",
+    ("service", "outcome"),
+))
 
 TMDB_API_KEY = os.getenv("TMDB_API_KEY")
 if not TMDB_API_KEY:
     raise ValueError("API key is missing! Set TMDB_API_KEY in the .env file.")
 
 app = Flask(__name__)
+metrics.instrument_app(app, "recommendation")
+tracing.instrument_app(app, "recommendation")
+profiling.instrument_app(app, "recommendation")
+rate_budget.install_admission(app)
+deadline.install(app)
+circuit_breaker.install_handler(app)
+responses.install_compression(app)
+logger = get_logger("recommendation")
+auth.install_login(app)
 
-def fetch_reviews(user_id):
-    reviews = []
-
-    with sqlite3.connect(MOVIES_REVIEWS_DB) as conn:
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            SELECT reviews.id, movies.title, reviews.rating
-            FROM reviews
-            JOIN movies ON reviews.movie_id = movies.id
-            WHERE reviews.user_id = ?     
-        """, (user_id,))
+lookup_executor = ThreadPoolExecutor(max_workers=RECOMMENDATION_WORKERS, thread_name_prefix="recommendation")
 
-    reviews_data = cursor.fetchall()
+with sqlite3.connect(MOVIES_REVIEWS_DB) as conn:
+    rating_aggregates.init_db(conn)
+    review_query.init_db(conn)
 
-    if reviews_data:
-        for review_id, title, rating in reviews_data:
-            reviews.append({
-                "review_id": review_id,
-                "title": title,
-                "rating": rating,
-                #"review_text": review_text
-            })
+genre_backfill_lock = threading.Lock()
 
-    return reviews
+def link_missing_genres():
+    """
+    Link reviewed movies that have no genres (older reviews, imported titles
+    the index had no genres for), looking them up on TMDB at background
+    priority when needed. Runs one pass at a time.
+    """
+    if not genre_backfill_lock.acquire(blocking=False):
+        return
+    try:
+        with sqlite3.connect(MOVIES_REVIEWS_DB) as conn:
+            rating_aggregates.link_missing_genres(conn, catalog_import.fetch_details)
+    except Exception as e:
+        logger.warning("Genre backfill failed", extra={"error": repr(e)})
+    finally:
+        genre_backfill_lock.release()
+
+def start_genre_backfill():
+    threading.Thread(target=link_missing_genres, name="genre-backfill", daemon=True).start()
 
-genre_cache = {}
-movie_cache = {}
+def fetch_reviews(user_id):
+    """
+    param: user_id:- The logged in user's id
+    Return (liked, reviewed_ids): the user's highest-rated reviews above
+    LIKED_RATING, at most RECOMMENDATION_SEEDS of them, to seed recommendations
+    from, and a sorted array of every TMDB id they reviewed to exclude
+    """
+    with sqlite3.connect(MOVIES_REVIEWS_DB) as conn:
+        with metrics.time_query("movies", "fetch_reviewed_ids"):
+            reviewed_ids = candidate_pool.sorted_ids(tmdb_id for (tmdb_id,) in conn.execute("""
+                SELECT movies.tmdb_id
+                FROM reviews
+                JOIN movies ON reviews.movie_id = movies.id
+                WHERE reviews.user_id = ?
+            """, (user_id,)))
+        top = review_query.query_reviews(conn, user_id, sort="rating", limit=RECOMMENDATION_SEEDS)
+
+    liked = [review for review in top["reviews"] if review["rating"] > LIKED_RATING]
+    return liked, reviewed_ids
+
+# Shared across worker processes when CACHE_BACKEND is sqlite or redis. Expired
+# entries stay available for a while to serve when an upstream is down.
+# Candidate lists are kept as columnar CandidatePools (plain columns in shared backends);
+# v2 leaves behind the {id, title} lists and per-process genre masks of older entries.
+movie_cache = cache_backend.get_cache("genre_movies_v2", default_ttl=6 * 3600, stale_ttl=7 * 24 * 3600,
+                                      encode=candidate_pool.CandidatePool.to_columns,
+                                      decode=candidate_pool.CandidatePool.from_columns)
+# Only these fields of each movie are kept in a candidate pool
+CANDIDATE_FIELDS = "id,title,vote_average,genre_ids"
+movie_genre_cache = cache_backend.get_cache("movie_genre", default_ttl=7 * 24 * 3600, stale_ttl=30 * 24 * 3600)
 
 def get_genre_id(genre_name):
     """
     param: genre_name:- genre name
-    Fetch all the genre ids from TMDB and return a specified genre's ID
-    """
-    if not genre_cache:
-        # Fetch all genres from TMDB and populate the cache
-        url = f"https://api.themoviedb.org/3/genre/movie/list?api_key={TMDB_API_KEY}&language=en-US"
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            for genre in data.get("genres", []):
-                if genre and isinstance(genre, dict) and genre.get("name"):
-                    genre_cache[genre["name"].lower()] = genre["id"]
-        else:
-            print(f"Error fetching genres: {response.status_code}")
-            return None
-
-    # Return the genre ID from the cache
-    return genre_cache.get(genre_name.lower())
+    Look up a genre's ID in the shared local genre catalog
+    """
+    return genre_catalog.id_for(genre_name)
 
-@lru_cache(maxsize=1000)
 def get_movie_genre_from_tmdb(movie_id):
+    """
+    param: movie_id:- TMDB movie id
+    Return (genre, stale); while TMDB is unavailable the genre comes from an
+    expired cache entry, if any
+    """
+    cached = movie_genre_cache.get(movie_id)
+    if cached is not None:
+        return cached, False
+
     TMDB_MOVIE_URL = f"https://api.themoviedb.org/3/movie/{movie_id}"
     params = {
         "api_key": TMDB_API_KEY
     }
 
-    response = requests.get(TMDB_MOVIE_URL, params=params)
+    try:
+        response = upstream.get("tmdb", "/movie/{id}", TMDB_MOVIE_URL, params=params)
+        if circuit_breaker.is_failure(response.status_code):
+            response.raise_for_status()
+    except requests.RequestException:
+        return movie_genre_cache.get_stale(movie_id), True
 
     if response.status_code == 200:
         movie_data = response.json()
         genres = movie_data.get("genres", [])
 
         if genres:
-            return genres[0]["name"].lower()
+            genre = genres[0]["name"].lower()
+            movie_genre_cache.set(movie_id, genre)
+            return genre, False
         
-    return None
+    return None, False
 
-def get_similar_movies(movie_id, user_reviewed_ids):
-    genre = get_movie_genre_from_tmdb(movie_id)
+def get_similar_movies(movie_id, reviewed_ids):
+    """
+    param: movie_id:- TMDB id of a movie the user liked
+    param: reviewed_ids:- Sorted array of TMDB ids the user already reviewed
+    Return (pool, stale): candidates from movie_id's genre the user hasn't
+    reviewed
+    """
+    empty = candidate_pool.CandidatePool.empty()
+    genre, stale = get_movie_genre_from_tmdb(movie_id)
 
     # Ensure genre is valid before proceeding
     if not genre:
-        print(f"Error: Could not fetch genre for movie ID {movie_id}")
-        return []
+        if stale:
+            # TMDB is down; the circuit breaker already logged it once
+            logger.debug("Genre unavailable while TMDB is down", extra={"movie_id": movie_id})
+        else:
+            logger.error("Could not fetch genre for movie", extra={"movie_id": movie_id})
+        return empty, stale
 
     genre_id = get_genre_id(genre)
     
     if not genre_id:
-        print(f"Error: Could not fetch genre ID for genre '{genre}'")
-        return []
+        logger.error("Could not fetch genre ID", extra={"genre": genre})
+        return empty, stale
     
-    if genre_id in movie_cache:
-        print(f"Using cached movie list for genre {genre} (ID: {genre_id})")
-        movie_results = movie_cache[genre_id]
-
-    print(f"Fetching movies from microservice for genre {genre} (ID: {genre_id})")
-
-    response = requests.get(f"{MICROSERVICE_SEARCH_URL}?genre={genre_id}&num_of_movies=20")
-    print(f"Response status code: {response.status_code}")
-    if response.status_code != 200:
-        print(f"Error: Movie search service failed for genre '{genre}'")
-        return []
-    
-    movie_results = response.json()
-    movie_cache[genre_id] = movie_results
-
-    recommended_movies = [
-        (movie["id"], movie["title"]) for movie in movie_results if movie["id"] not in user_reviewed_ids
-    ]
-
-    return recommended_movies
-
-def get_recommendations(user_reviews):
-    recommendations = []
-    reviewed_movie_ids = [review['review_id'] for review in user_reviews if review['rating'] >= 7]
-
-    all_recommended_movies = set()
+    pool = movie_cache.get(genre_id)
+    if pool is not None:
+        logger.debug("Using cached movie list", extra={"genre": genre, "genre_id": genre_id})
+    else:
+        logger.debug("Fetching movies from microservice", extra={"genre": genre, "genre_id": genre_id})
+
+        try:
+            # Nobody will open these results, so movie search shouldn't prefetch for them
+            response = upstream.get("movie_search", "/movies", MICROSERVICE_SEARCH_URL,
+                                    params={"genre": genre_id, "num_of_movies": 20, "fields": CANDIDATE_FIELDS,
+                                            "prefetch": 0},
+                                    headers={"X-Client-Id": "recommendation"})
+            if circuit_breaker.is_failure(response.status_code):
+                response.raise_for_status()
+        except requests.RequestException as e:
+            logger.debug("Movie search unavailable", extra={"genre": genre, "error": repr(e)})
+            response = None
+            pool = movie_cache.get_stale(genre_id) or empty
+            stale = True
+
+        if response is not None:
+            if response.status_code != 200:
+                logger.error("Movie search service failed", extra={"genre": genre, "status": response.status_code})
+                return empty, stale
+
+            pool = candidate_pool.CandidatePool.from_movies(response.json())
+            if response.headers.get(responses.STALE_HEADER):
+                stale = True
+            else:
+                movie_cache.set(genre_id, pool)
+
+    return pool.exclude(reviewed_ids), stale
+
+def _lookup_similar(movie_id, reviewed_ids):
+    # Lookups still queued when the deadline passes are not worth starting
+    deadline.check()
+    return get_similar_movies(movie_id, reviewed_ids)
+
+def get_recommendations(liked, reviewed_ids):
+    """
+    param: liked:- Reviews to find similar movies for (see fetch_reviews())
+    param: reviewed_ids:- Sorted TMDB ids the user already reviewed, liked or not
+    Return (recommendations, stale, meta). Lookups run on the shared pool
+    under a RECOMMENDATION_DEADLINE_SECONDS deadline; recommendations are
+    drawn from the lookups that completed in time and meta counts them as
+    completed, dropped (unfinished at the deadline) or failed. stale is set
+    when any lookup was served from expired data because an upstream was
+    unavailable
+    """
+    pools = []
+    any_stale = False
+    meta = {"completed": 0, "dropped": 0, "failed": 0}
 
-    with ThreadPoolExecutor() as executor:
+    with deadline.budget(RECOMMENDATION_DEADLINE_SECONDS):
         futures = [
-            executor.submit(get_similar_movies, review['review_id'], reviewed_movie_ids)
-            for review in user_reviews if review['rating'] > 7
+            # Each lookup runs in a copy of the request context, so its spans join this
+            # trace and its upstream calls see the deadline
+            lookup_executor.submit(contextvars.copy_context().run, _lookup_similar, review['tmdb_id'], reviewed_ids)
+            for review in liked
         ]
-        for future in futures:
-            similar_movies = future.result()
-            all_recommended_movies.update(similar_movies)
-
-    all_recommended_movies = list(all_recommended_movies)
-    random.shuffle(all_recommended_movies)
-    recommendations = all_recommended_movies[:5]
-
-    if not recommendations:
-        recommendations.append({"suggestion": "No similar movies found. Try reviewing more!"})
+        done, _ = wait(futures, timeout=deadline.remaining())
+
+    for future in futures:
+        if future not in done:
+            future.cancel()
+            meta["dropped"] += 1
+        elif future.exception() is not None:
+            if isinstance(future.exception(), deadline.DeadlineExceeded):
+                meta["dropped"] += 1
+            else:
+                logger.error("Similar-movie lookup failed", extra={"error": repr(future.exception())})
+                meta["failed"] += 1
+        else:
+            pool, stale = future.result()
+            pools.append(pool)
+            any_stale = any_stale or stale
+            meta["completed"] += 1
+    for outcome, count in meta.items():
+        if count:
+            RECOMMENDATION_LOOKUPS.inc(metrics.SERVICE_NAME, outcome, amount=count)
 
-    return recommendations
+    recommendations = candidate_pool.CandidatePool.concat(pools).unique().sample(5)
+    return recommendations, any_stale, meta
 
 @app.route("/recommendations", methods=["GET"])
 def recommend_movies():
-    user_id = request.args.get("user_id")
+    user_id = auth.current_user_id()
     if not user_id:
-        return jsonify({"Error": "User ID is required"}), 400
+        return jsonify({"Error": "A valid session token is required"}), 401
     
-    reviews = fetch_reviews(user_id)
-    if not reviews:
+    liked, reviewed_ids = fetch_reviews(user_id)
+    if not len(reviewed_ids):
         return jsonify({"Error": "No reviews found for this user"}), 404
     
-    recommendations = get_recommendations(reviews)
-    return jsonify(recommendations), 200
+    recommendations, stale, meta = get_recommendations(liked, reviewed_ids)
+    return responses.json_response({"recommendations": recommendations, "meta": meta},
+                                   headers=responses.stale_headers(stale))
+
+@app.route("/reviews", methods=["GET"])
+def list_reviews():
+    """
+    One page of the user's reviews. ?sort=date|rating, ?order=desc|asc,
+    ?limit=, ?min_rating=, ?genre= (TMDB genre id or name) and ?year= select
+    the page; pass the returned "next"/"prev" value back as ?cursor= to move
+    """
+    user_id = auth.current_user_id()
+    if not user_id:
+        return jsonify({"Error": "A valid session token is required"}), 401
+
+    genre = request.args.get("genre")
+    genre_id = None
+    if genre:
+        genre_id = int(genre) if genre.isdigit() else get_genre_id(genre)
+        if genre_id is None:
+            return jsonify({"Error": "Genre not found"}), 404
+
+    try:
+        with sqlite3.connect(MOVIES_REVIEWS_DB) as conn:
+            page = review_query.query_reviews(
+                conn, user_id,
+                sort=request.args.get("sort", "date"),
+                order=request.args.get("order", "desc"),
+                limit=request.args.get("limit", default=review_query.DEFAULT_PAGE_SIZE, type=int),
+                cursor=request.args.get("cursor"),
+                min_rating=request.args.get("min_rating", type=float),
+                genre_id=genre_id,
+                year=request.args.get("year", type=int),
+            )
+    except review_query.InvalidQuery as e:
+        return jsonify({"Error": str(e)}), 400
+    return responses.json_response(page)
+
+@app.route("/reviews/import", methods=["POST"])
+def import_reviews():
+    user_id = auth.current_user_id()
+    if not user_id:
+        return jsonify({"Error": "A valid session token is required"}), 401
+
+    fmt = request.args.get("format", "csv")
+    try:
+        rating_scale = float(request.args.get("rating_scale", 10))
+    except ValueError:
+        rating_scale = None
+    if not review_io.valid_rating_scale(rating_scale):
+        return jsonify({"Error": "rating_scale must be a number above 0"}), 400
+    lines = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+    result = review_io.import_reviews(lines, fmt, user_id, rating_scale, db_path=MOVIES_REVIEWS_DB)
+    start_genre_backfill()
+    return jsonify(result), 200
+
+@app.route("/reviews/export", methods=["GET"])
+def export_reviews():
+    user_id = auth.current_user_id()
+    if not user_id:
+        return jsonify({"Error": "A valid session token is required"}), 401
+
+    fmt = request.args.get("format", "csv")
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(review_io.export_reviews(user_id, fmt, db_path=MOVIES_REVIEWS_DB), mimetype=mimetype)
+
+@app.route("/community/top", methods=["GET"])
+def community_top():
+    """
+    Highest-scored movies among all users' reviews, optionally for one genre
+    (?genre= takes a TMDB genre id or name)
+    """
+    genre = request.args.get("genre")
+    limit = request.args.get("limit", default=10, type=int)
+    min_reviews = request.args.get("min_reviews", default=1, type=int)
+
+    genre_id = None
+    if genre:
+        genre_id = int(genre) if genre.isdigit() else get_genre_id(genre)
+        if genre_id is None:
+            return jsonify({"Error": "Genre not found"}), 404
+
+    with sqlite3.connect(MOVIES_REVIEWS_DB) as conn:
+        top = rating_aggregates.top_movies(conn, genre_id, limit, min_reviews)
+        summary = rating_aggregates.genre_summary(conn, genre_id) if genre_id is not None else None
+    return responses.json_response({"genre_id": genre_id, "genre": summary, "movies": top})
 
 def run_recommendation_service():
+    genre_catalog.load()
+    start_genre_backfill()
     app.run(port=8083)
 
 if __name__ == "__main__":
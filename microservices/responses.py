@@ -0,0 +1,132 @@
+"""
+Compact JSON responses for the microservices.
+
+json_response() encodes with orjson when it is installed (falling back to the
+standard library with compact separators), project() trims result objects to
+the fields a client asked for with `fields=`, ndjson_response() streams
+results one JSON object per line as they are produced, and
+install_compression(app) gzip- or brotli-compresses (non-streamed) responses
+according to Accept-Encoding.
+"""
+import gzip
+import json
+from flask import Response, request, stream_with_context
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller bodies gain nothing from compression
+MIN_COMPRESS_SIZE = 500
+# Set on responses served from local copies because an upstream was unavailable
+STALE_HEADER = "X-Data-Stale"
+# Last line of a streamed listing; headers only describe its first page
+STREAM_STATUS_KEY = "_status"
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def json_response(data, status=200, headers=None):
+    """
+    param: data:- JSON-serialisable object
+    param: status:- HTTP status code
+    param: headers:- Extra response headers
+    """
+    return Response(dumps(data), status=status, headers=headers, mimetype="application/json")
+
+
+def ndjson_response(items, headers=None):
+    """
+    param: items:- Iterable of JSON-serialisable objects, consumed lazily
+    param: headers:- Extra response headers
+    Stream items as chunked NDJSON, one object per line
+    """
+    def generate():
+        for item in items:
+            yield dumps(item) + b"\n"
+
+    return Response(stream_with_context(generate()), headers=headers, mimetype="application/x-ndjson")
+
+
+def stale_headers(stale):
+    """
+    param: stale:- Whether the response body is last known good data
+    """
+    return {STALE_HEADER: "1"} if stale else None
+
+
+def parse_fields(value):
+    """
+    param: value:- Comma-separated `fields` query parameter
+    Return the requested field names, or None for "everything"
+    """
+    if not value:
+        return None
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    return fields or None
+
+
+def project(items, fields):
+    """
+    param: items:- List of result dicts
+    param: fields:- Field names to keep (None keeps everything)
+    """
+    if not fields:
+        return items
+    return [{field: item[field] for field in fields if field in item} for item in items]
+
+
+def _accepted_encodings(header):
+    accepted = {}
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.lower()] = quality
+    return {coding for coding, quality in accepted.items() if quality > 0}
+
+
+def install_compression(app):
+    """
+    param: app:- The service's Flask app
+    Compress eligible responses with brotli (if available) or gzip
+    """
+    @app.after_request
+    def _compress(response):
+        if (response.direct_passthrough or response.is_streamed or response.status_code < 200
+                or response.status_code >= 300 or "Content-Encoding" in response.headers):
+            return response
+
+        response.vary.add("Accept-Encoding")
+        body = response.get_data()
+        if len(body) < MIN_COMPRESS_SIZE:
+            return response
+
+        accepted = _accepted_encodings(request.headers.get("Accept-Encoding", ""))
+        if brotli is not None and "br" in accepted:
+            response.set_data(brotli.compress(body, quality=BROTLI_QUALITY))
+            response.headers["Content-Encoding"] = "br"
+        elif "gzip" in accepted:
+            response.set_data(gzip.compress(body, compresslevel=GZIP_LEVEL))
+            response.headers["Content-Encoding"] = "gzip"
+        return response
+
+    return app
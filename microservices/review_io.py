@@ -0,0 +1,340 @@
+"""
+Bulk import and export of a user's reviews.
+
+Imports stream a CSV or NDJSON file (Letterboxd and IMDb export column names
+are recognised) in chunks of CHUNK_SIZE rows. Titles in each chunk are
+resolved to TMDB ids through movies.db, then the local title index, then
+concurrent TMDB searches, with every answer cached for the rest of the run.
+Each chunk is written with executemany in a single transaction, together
+with its updates to the community rating aggregates. A row identical to a
+review the user already has (same movie, rating and text) is skipped as a
+duplicate, so re-importing a file or importing one's own export is a no-op.
+
+Exports stream rows straight from the cursor, so neither direction holds the
+whole file in memory.
+
+usage: python review_io.py import --user-id ID FILE [--rating-scale 5] [--workers 16]
+       python review_io.py export --user-id ID FILE
+"""
+import argparse
+import csv
+import io
+import json
+import math
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import catalog_import
+import metrics
+import rate_budget
+import rating_aggregates
+import title_index
+import upstream
+from service_logging import get_logger
+
+MOVIES_REVIEWS_DB = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "movies.db"))
+TMDB_SEARCH_URL = "https://api.themoviedb.org/3/search/movie"
+CHUNK_SIZE = 1000
+# Imported ratings are scaled to the CLI's 1-10 range and must fall inside it
+MAX_RATING = 10
+EXPORT_FIELDS = ["tmdb_id", "title", "year", "rating", "review"]
+
+# Column names used by our own export, Letterboxd and IMDb
+TITLE_COLUMNS = ("title", "Title", "Name", "name")
+YEAR_COLUMNS = ("year", "Year", "release_year")
+RATING_COLUMNS = ("rating", "Rating", "Your Rating")
+REVIEW_COLUMNS = ("review", "Review", "review_text")
+TMDB_ID_COLUMNS = ("tmdb_id", "tmdbID")
+
+logger = get_logger("review_io")
+
+
+def _first(row, columns):
+    for column in columns:
+        value = row.get(column)
+        if value not in (None, ""):
+            return value
+    return None
+
+
+def parse_rows(lines, fmt):
+    """
+    param: lines:- Iterable of text lines
+    param: fmt:- "csv" or "ndjson"
+    Yield raw dict rows one at a time, or None for an NDJSON line that is
+    not a JSON object
+    """
+    if fmt == "csv":
+        yield from csv.DictReader(lines)
+    else:
+        for line_number, line in enumerate(lines, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("Skipping malformed line", extra={"line": line_number})
+                yield None
+                continue
+            yield row if isinstance(row, dict) else None
+
+
+def valid_rating_scale(rating_scale):
+    """
+    param: rating_scale:- Maximum rating in the import file
+    Return whether it is a usable scale (a finite number above 0)
+    """
+    return isinstance(rating_scale, (int, float)) and math.isfinite(rating_scale) and rating_scale > 0
+
+
+def normalize_row(row, rating_scale=10):
+    """
+    param: row:- Raw dict from the import file
+    param: rating_scale:- Maximum rating in the file (5 for Letterboxd)
+    Return a review dict or None if the row has no usable title/rating
+    """
+    if not isinstance(row, dict):
+        return None
+    title = _first(row, TITLE_COLUMNS)
+    rating = _first(row, RATING_COLUMNS)
+    if not title or rating is None:
+        return None
+    try:
+        rating = float(rating) * MAX_RATING / rating_scale
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(rating) or not 0 < rating <= MAX_RATING:
+        return None
+    year = _first(row, YEAR_COLUMNS)
+    tmdb_id = _first(row, TMDB_ID_COLUMNS)
+    return {
+        "title": str(title).strip(),
+        "year": int(year) if year and str(year).isdigit() else None,
+        "rating": rating,
+        "review": _first(row, REVIEW_COLUMNS) or "",
+        "tmdb_id": int(tmdb_id) if tmdb_id and str(tmdb_id).isdigit() else None,
+    }
+
+
+class TitleResolver:
+    def __init__(self, conn, workers=16):
+        self.conn = conn
+        self.workers = workers
+        self.cache = {}
+
+    def _from_movies_db(self, title, year):
+        query = "SELECT tmdb_id, title, release_year FROM movies WHERE title = ? COLLATE NOCASE"
+        params = [title]
+        if year:
+            query += " AND release_year = ?"
+            params.append(year)
+        return self.conn.execute(query + " LIMIT 1", params).fetchone()
+
+    def _from_title_index(self, title, year):
+        for movie in title_index.exact_matches(title, limit=10):
+            release_year = (movie.get("release_date") or "")[:4]
+            if not year or release_year == str(year):
+                return movie["id"], movie["title"], int(release_year) if release_year.isdigit() else year
+        return None
+
+    def _from_tmdb(self, key):
+        title, year = key
+        params = {"api_key": os.getenv("TMDB_API_KEY"), "query": title}
+        if year:
+            params["primary_release_year"] = year
+        try:
+            # Bulk imports must not starve interactive searches of TMDB budget
+            with rate_budget.priority(rate_budget.BACKGROUND):
+                response = upstream.get("tmdb", "/search/movie", TMDB_SEARCH_URL, params=params, timeout=10)
+        except requests.RequestException as e:
+            logger.warning("TMDB lookup failed", extra={"title": title, "error": repr(e)})
+            return key, None
+        if response.status_code != 200:
+            return key, None
+        results = response.json().get("results", [])
+        if not results:
+            return key, None
+        # A year-filtered search isn't TMDB's ranking for the bare title
+        title_index.add_movies(results, query=None if year else title)
+        movie = results[0]
+        release_year = (movie.get("release_date") or "")[:4]
+        return key, (movie["id"], movie["title"], int(release_year) if release_year.isdigit() else year)
+
+    def resolve(self, keys):
+        """
+        param: keys:- Iterable of (title, year) pairs
+        Resolve every key not yet cached, hitting TMDB concurrently for the rest
+        """
+        remote = []
+        for key in set(keys):
+            if key in self.cache:
+                metrics.record_cache("review_import_titles", True)
+                continue
+            metrics.record_cache("review_import_titles", False)
+            found = self._from_movies_db(*key) or self._from_title_index(*key)
+            if found:
+                self.cache[key] = tuple(found)
+            else:
+                remote.append(key)
+
+        if remote:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for key, found in executor.map(self._from_tmdb, remote):
+                    self.cache[key] = found
+        return self.cache
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _write_chunk(conn, user_id, reviews):
+    """
+    Write one chunk of resolved reviews; return how many were new rather
+    than duplicates of the user's existing reviews
+    """
+    with metrics.time_query("movies", "import_reviews"):
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO movies (tmdb_id, title, release_year) VALUES (?, ?, ?)",
+                             {(r["tmdb_id"], r["title"], r["year"]) for r in reviews})
+            tmdb_ids = list({r["tmdb_id"] for r in reviews})
+            placeholders = ",".join("?" * len(tmdb_ids))
+            movie_ids = dict(conn.execute(f"SELECT tmdb_id, id FROM movies WHERE tmdb_id IN ({placeholders})",
+                                          tmdb_ids).fetchall())
+            seen = set(conn.execute(f"""
+                SELECT movie_id, rating, review_text FROM reviews
+                WHERE user_id = ? AND movie_id IN ({placeholders})
+            """, [user_id] + [movie_ids[tmdb_id] for tmdb_id in tmdb_ids]).fetchall())
+            rows = []
+            for r in reviews:
+                row = (movie_ids[r["tmdb_id"]], r["rating"], r["review"])
+                if row not in seen:
+                    seen.add(row)
+                    rows.append(row)
+            conn.executemany("INSERT INTO reviews (user_id, movie_id, rating, review_text) VALUES (?, ?, ?, ?)",
+                             [(user_id,) + row for row in rows])
+            for tmdb_id, genres in title_index.genre_ids(tmdb_ids).items():
+                rating_aggregates.link_genres(conn, movie_ids[tmdb_id], genres)
+            rating_aggregates.apply_reviews(conn, [(movie_id, rating, 1) for movie_id, rating, _ in rows])
+    return len(rows)
+
+
+def import_reviews(lines, fmt, user_id, rating_scale=10, workers=16, db_path=MOVIES_REVIEWS_DB):
+    """
+    param: lines:- Iterable of text lines from the import file
+    param: fmt:- "csv" or "ndjson"
+    param: user_id:- Owner of the imported reviews
+    param: rating_scale:- Maximum rating in the file
+    param: workers:- Concurrent TMDB lookups
+    Return counts of imported, duplicate and skipped rows
+    """
+    if not valid_rating_scale(rating_scale):
+        raise ValueError(f"rating_scale must be a number above 0, not {rating_scale!r}")
+    imported = duplicates = skipped = 0
+    start = time.perf_counter()
+    title_index.init_index()
+    with sqlite3.connect(db_path) as conn:
+        rating_aggregates.init_db(conn)
+        resolver = TitleResolver(conn, workers)
+        rows = (normalize_row(row, rating_scale) for row in parse_rows(lines, fmt))
+        for chunk in _chunks(rows, CHUNK_SIZE):
+            reviews = [r for r in chunk if r]
+            skipped += len(chunk) - len(reviews)
+
+            resolved = resolver.resolve((r["title"], r["year"]) for r in reviews if not r["tmdb_id"])
+            ready = []
+            for review in reviews:
+                if not review["tmdb_id"]:
+                    found = resolved.get((review["title"], review["year"]))
+                    if not found:
+                        skipped += 1
+                        continue
+                    review["tmdb_id"], review["title"], review["year"] = found
+                ready.append(review)
+
+            written = _write_chunk(conn, user_id, ready) if ready else 0
+            imported += written
+            duplicates += len(ready) - written
+            logger.info("Imported review chunk", extra={"imported": imported, "duplicates": duplicates,
+                                                        "skipped": skipped,
+                                                        "seconds": round(time.perf_counter() - start, 1)})
+    return {"imported": imported, "duplicates": duplicates, "skipped": skipped}
+
+
+def export_reviews(user_id, fmt, db_path=MOVIES_REVIEWS_DB):
+    """
+    param: user_id:- Owner of the reviews
+    param: fmt:- "csv" or "ndjson"
+    Yield the export one line at a time
+    """
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.execute("""
+            SELECT movies.tmdb_id, movies.title, movies.release_year, reviews.rating, reviews.review_text
+            FROM reviews
+            JOIN movies ON reviews.movie_id = movies.id
+            WHERE reviews.user_id = ?
+            ORDER BY reviews.id
+        """, (user_id,))
+
+        if fmt == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(EXPORT_FIELDS)
+            for row in cursor:
+                writer.writerow(row)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            if buffer.getvalue():
+                # Header of an empty export
+                yield buffer.getvalue()
+        else:
+            for row in cursor:
+                yield json.dumps(dict(zip(EXPORT_FIELDS, row))) + "\n"
+
+
+def format_for(path):
+    return "ndjson" if path.endswith((".ndjson", ".jsonl", ".json")) else "csv"
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Bulk import or export a user's reviews")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("path")
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument("--rating-scale", type=float, default=10)
+    parser.add_argument("--workers", type=int, default=16)
+    args = parser.parse_args(argv)
+    if not valid_rating_scale(args.rating_scale):
+        parser.error("--rating-scale must be a number above 0")
+
+    fmt = format_for(args.path)
+    if args.command == "import":
+        with open(args.path, encoding="utf-8", newline="") as f:
+            result = import_reviews(f, fmt, args.user_id, args.rating_scale, args.workers)
+        # Titles the index had no genres for are looked up on TMDB for the genre aggregates
+        with sqlite3.connect(MOVIES_REVIEWS_DB) as conn:
+            linked = rating_aggregates.link_missing_genres(conn, catalog_import.fetch_details, args.workers)
+        print(f"Imported {result['imported']} reviews ({result['duplicates']} already present, "
+              f"{result['skipped']} skipped); {linked} movies linked to their genres.")
+    else:
+        with open(args.path, "w", encoding="utf-8", newline="") as f:
+            for chunk in export_reviews(args.user_id, fmt):
+                f.write(chunk)
+        print(f"Exported reviews to {args.path}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
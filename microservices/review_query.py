@@ -0,0 +1,144 @@
+"""
+Paged, filtered listing of a user's reviews.
+
+query_reviews() returns one page at a time using keyset pagination: each
+page continues from the (sort key, id) of the last row shown, carried in an
+opaque cursor, instead of an OFFSET that re-reads every earlier row. Reviews
+sort by date (created_at) or rating, newest/highest first by default, and
+can be filtered by minimum rating, TMDB genre and release year.
+
+The composite indexes (user_id, created_at, id) and (user_id, rating, id)
+make every page a single index range scan starting at the cursor; the genre
+and year filters are checked per row during that scan. The genre filter uses
+the movie_genres links kept by rating_aggregates, so a movie reviewed before
+those existed only matches once link_missing_genres() has found its genres
+(from the title index, or TMDB while it is reachable).
+"""
+import base64
+import json
+import metrics
+
+SORT_COLUMNS = {"date": "reviews.created_at", "rating": "reviews.rating"}
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+
+
+class InvalidQuery(ValueError):
+    """Bad sort, filter or cursor value"""
+
+
+def init_db(conn):
+    """
+    param: conn:- Connection to movies.db
+    Add reviews.created_at (backfilling existing rows) and the listing indexes
+    """
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(reviews)")}
+    if not columns:
+        # The CLI creates the reviews table (with created_at) and calls this again
+        return
+    if "created_at" not in columns:
+        with conn:
+            # ALTER TABLE can't add a CURRENT_TIMESTAMP default; the trigger below fills it instead
+            conn.execute("ALTER TABLE reviews ADD COLUMN created_at TIMESTAMP")
+            conn.execute("UPDATE reviews SET created_at = datetime('now') WHERE created_at IS NULL")
+    conn.executescript("""
+        CREATE TRIGGER IF NOT EXISTS reviews_created_at AFTER INSERT ON reviews
+        WHEN new.created_at IS NULL BEGIN
+            UPDATE reviews SET created_at = datetime('now') WHERE id = new.id;
+        END;
+        CREATE INDEX IF NOT EXISTS idx_reviews_user_created ON reviews (user_id, created_at, id);
+        CREATE INDEX IF NOT EXISTS idx_reviews_user_rating ON reviews (user_id, rating, id);
+    """)
+
+
+def _encode_cursor(sort, order, key, review_id, direction):
+    data = json.dumps({"s": sort, "o": order, "k": key, "i": review_id, "d": direction}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).rstrip(b"=").decode("ascii")
+
+
+def _decode_cursor(cursor, sort, order):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        key, review_id, direction = data["k"], int(data["i"]), data["d"]
+    except (ValueError, KeyError, TypeError):
+        raise InvalidQuery("Invalid cursor")
+    if data.get("s") != sort or data.get("o") != order or direction not in ("next", "prev"):
+        raise InvalidQuery("Cursor does not match this sort order")
+    return key, review_id, direction
+
+
+def query_reviews(conn, user_id, sort="date", order="desc", limit=DEFAULT_PAGE_SIZE, cursor=None,
+                  min_rating=None, genre_id=None, year=None):
+    """
+    param: conn:- Connection to movies.db
+    param: user_id:- Owner of the reviews
+    param: sort:- "date" or "rating"
+    param: order:- "desc" (newest/highest first) or "asc"
+    param: limit:- Page size (at most MAX_PAGE_SIZE)
+    param: cursor:- "next" or "prev" cursor from a previous page, None for the first
+    param: min_rating:- Only reviews rated at least this
+    param: genre_id:- Only movies in this TMDB genre (movies not yet linked to
+                      their genres are left out)
+    param: year:- Only movies released this year
+    Return {"reviews": [...], "next": cursor or None, "prev": cursor or None}
+    """
+    if sort not in SORT_COLUMNS:
+        raise InvalidQuery(f"sort must be one of {', '.join(SORT_COLUMNS)}")
+    if order not in ("asc", "desc"):
+        raise InvalidQuery("order must be asc or desc")
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    column = SORT_COLUMNS[sort]
+
+    conditions = ["reviews.user_id = ?"]
+    params = [user_id]
+    if min_rating is not None:
+        conditions.append("reviews.rating >= ?")
+        params.append(min_rating)
+    if year is not None:
+        conditions.append("movies.release_year = ?")
+        params.append(year)
+    if genre_id is not None:
+        conditions.append("EXISTS (SELECT 1 FROM movie_genres WHERE movie_genres.movie_id = reviews.movie_id"
+                          " AND movie_genres.genre_id = ?)")
+        params.append(genre_id)
+
+    direction = "next"
+    if cursor:
+        key, after_id, direction = _decode_cursor(cursor, sort, order)
+        # Paging back walks the index the other way from the first row shown
+        forward_desc = (order == "desc") == (direction == "next")
+        conditions.append(f"({column}, reviews.id) {'<' if forward_desc else '>'} (?, ?)")
+        params.extend([key, after_id])
+    else:
+        forward_desc = order == "desc"
+    scan = "DESC" if forward_desc else "ASC"
+
+    sql = f"""
+        SELECT reviews.id, movies.tmdb_id, movies.title, movies.release_year,
+               reviews.rating, reviews.review_text, reviews.created_at, {column}
+        FROM reviews
+        JOIN movies ON reviews.movie_id = movies.id
+        WHERE {" AND ".join(conditions)}
+        ORDER BY {column} {scan}, reviews.id {scan}
+        LIMIT ?
+    """
+    with metrics.time_query("movies", f"list_reviews_{sort}"):
+        rows = conn.execute(sql, params + [limit + 1]).fetchall()
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "prev":
+        rows.reverse()
+
+    reviews = [{
+        "review_id": review_id, "tmdb_id": tmdb_id, "title": title, "year": release_year,
+        "rating": rating, "review": review_text, "created_at": created_at,
+    } for review_id, tmdb_id, title, release_year, rating, review_text, created_at, _ in rows]
+
+    has_next = more if direction == "next" else bool(cursor)
+    has_prev = bool(cursor) if direction == "next" else more
+    return {
+        "reviews": reviews,
+        "next": _encode_cursor(sort, order, rows[-1][-1], rows[-1][0], "next") if rows and has_next else None,
+        "prev": _encode_cursor(sort, order, rows[0][-1], rows[0][0], "prev") if rows and has_prev else None,
+    }
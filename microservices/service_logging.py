@@ -0,0 +1,55 @@
+"""
+Leveled, structured (logfmt) logging shared by the microservices.
+
+Use get_logger(__name__) and pass fields through `extra`, e.g.
+logger.info("genre query", extra={"genre": 28}). The level is read from
+LOG_LEVEL (default INFO).
+"""
+import logging
+import os
+import sys
+
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def _logfmt_value(value):
+    text = str(value)
+    if not text or any(c in text for c in ' ="'):
+        return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return text
+
+
+class LogfmtFormatter(logging.Formatter):
+    def format(self, record):
+        fields = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                fields[key] = value
+        line = " ".join(f"{key}={_logfmt_value(value)}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+_configured = False
+
+
+def get_logger(name):
+    """
+    param: name:- Logger name, normally the module's __name__
+    Return a logger that writes logfmt lines to stderr
+    """
+    global _configured
+    if not _configured:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(LogfmtFormatter())
+        root = logging.getLogger()
+        root.addHandler(handler)
+        root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+        _configured = True
+    return logging.getLogger(name)
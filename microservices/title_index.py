@@ -0,0 +1,342 @@
+"""
+Local full-text index over every movie title the services have seen.
+
+Titles from TMDB search/discover results and from movies.db are stored in
+title_index.db with an FTS5 index (trigram tokenizer, so any substring of
+three or more characters matches). A title search is answered locally when
+that query was already fetched from TMDB within TITLE_SEARCH_TTL_HOURS
+(default 168), replaying TMDB's ranking for it, or when an indexed title
+equals the query (exact matches first, then other local matches). Anything
+else goes to TMDB and the results are merged in. Substring matches alone
+never answer a search: they are ranked by popularity, not relevance, so
+"Her" would put "Brother" ahead of the movie actually asked for.
+
+Rows seeded from the TMDB ID export or movies.db carry only a title (the
+export's original title) and no genres, so they are stored unenriched and
+stay out of search results until a TMDB search/discover result or detail
+fetch fills them in.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import metrics
+from service_logging import get_logger
+
+TITLE_INDEX_DB = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "title_index.db"))
+MOVIES_REVIEWS_DB = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "movies.db"))
+TITLE_SEARCH_TTL = float(os.getenv("TITLE_SEARCH_TTL_HOURS", "168")) * 3600
+# Trigram matching needs at least this many characters
+MIN_QUERY_LENGTH = 3
+
+logger = get_logger("title_index")
+
+_local = threading.local()
+
+
+def _connect():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(TITLE_INDEX_DB)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+    return conn
+
+
+def init_index():
+    conn = _connect()
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS titles (
+                tmdb_id INTEGER PRIMARY KEY,
+                title TEXT NOT NULL,
+                original_title TEXT,
+                release_date TEXT,
+                popularity REAL NOT NULL DEFAULT 0,
+                vote_average REAL,
+                payload TEXT NOT NULL,
+                enriched INTEGER NOT NULL DEFAULT 1
+            )""")
+        if "enriched" not in {row[1] for row in conn.execute("PRAGMA table_info(titles)")}:
+            conn.execute("ALTER TABLE titles ADD COLUMN enriched INTEGER NOT NULL DEFAULT 1")
+            conn.execute("""
+                UPDATE titles SET enriched = 0
+                WHERE release_date IS NULL AND json_extract(payload, '$.genre_ids') IS NULL
+            """)
+        try:
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS titles_fts USING fts5(
+                    title, original_title, content='titles', content_rowid='tmdb_id', tokenize='trigram'
+                )""")
+        except sqlite3.OperationalError:
+            # SQLite older than 3.34 has no trigram tokenizer; fall back to word/prefix matching
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS titles_fts USING fts5(
+                    title, original_title, content='titles', content_rowid='tmdb_id'
+                )""")
+        conn.executescript("""
+            CREATE TRIGGER IF NOT EXISTS titles_ai AFTER INSERT ON titles BEGIN
+                INSERT INTO titles_fts(rowid, title, original_title)
+                VALUES (new.tmdb_id, new.title, new.original_title);
+            END;
+            CREATE TRIGGER IF NOT EXISTS titles_ad AFTER DELETE ON titles BEGIN
+                INSERT INTO titles_fts(titles_fts, rowid, title, original_title)
+                VALUES ('delete', old.tmdb_id, old.title, old.original_title);
+            END;
+            CREATE TRIGGER IF NOT EXISTS titles_au AFTER UPDATE OF title, original_title ON titles BEGIN
+                INSERT INTO titles_fts(titles_fts, rowid, title, original_title)
+                VALUES ('delete', old.tmdb_id, old.title, old.original_title);
+                INSERT INTO titles_fts(rowid, title, original_title)
+                VALUES (new.tmdb_id, new.title, new.original_title);
+            END;
+            CREATE TABLE IF NOT EXISTS searched_queries (
+                query TEXT PRIMARY KEY,
+                searched_at REAL NOT NULL,
+                tmdb_ids TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_titles_title ON titles (title COLLATE NOCASE);
+        """)
+        # Queries remembered before TMDB's ranking was stored are fetched again
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(searched_queries)")}
+        if "tmdb_ids" not in columns:
+            conn.execute("ALTER TABLE searched_queries ADD COLUMN tmdb_ids TEXT")
+
+
+def _normalize(query):
+    return " ".join(query.lower().split())
+
+
+def _row_from_movie(movie):
+    if "genre_ids" not in movie and "genres" in movie:
+        # Detail payloads list genres as objects; keep the search-result shape
+        movie = dict(movie, genre_ids=[genre["id"] for genre in movie["genres"]])
+    return (
+        movie["id"],
+        movie.get("title") or movie.get("original_title") or "",
+        movie.get("original_title"),
+        movie.get("release_date"),
+        movie.get("popularity") or 0,
+        movie.get("vote_average"),
+        json.dumps(movie),
+    )
+
+
+UPSERT_SQL = """
+    INSERT INTO titles (tmdb_id, title, original_title, release_date, popularity, vote_average, payload, enriched)
+    VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+    ON CONFLICT(tmdb_id) DO UPDATE SET
+        enriched = 1,
+        title = excluded.title,
+        original_title = excluded.original_title,
+        release_date = COALESCE(excluded.release_date, titles.release_date),
+        popularity = excluded.popularity,
+        vote_average = COALESCE(excluded.vote_average, titles.vote_average),
+        payload = excluded.payload
+"""
+
+
+def add_movies(movies, query=None):
+    """
+    param: movies:- TMDB movie result dicts
+    param: query:- The title query these results answer, if any
+    Merge TMDB results into the index and remember that `query` was fetched,
+    along with TMDB's ranking of the results
+    """
+    rows = [_row_from_movie(movie) for movie in movies if movie.get("id")]
+    conn = _connect()
+    with metrics.time_query("title_index", "upsert_titles"):
+        with conn:
+            conn.executemany(UPSERT_SQL, rows)
+            if query is not None:
+                conn.execute("INSERT OR REPLACE INTO searched_queries (query, searched_at, tmdb_ids) VALUES (?, ?, ?)",
+                             (_normalize(query), time.time(), json.dumps([row[0] for row in rows])))
+
+
+EXPORT_UPSERT_SQL = """
+    INSERT INTO titles (tmdb_id, title, original_title, popularity, payload, enriched)
+    VALUES (?, ?, ?, ?, ?, 0)
+    ON CONFLICT(tmdb_id) DO UPDATE SET popularity = excluded.popularity
+"""
+
+
+def upsert_export_rows(conn, rows):
+    """
+    param: conn:- Connection from bulk_connection(), inside a transaction
+    param: rows:- (tmdb_id, original_title, popularity) tuples from a TMDB ID export
+    Insert new titles, unenriched, and refresh popularity of known ones,
+    leaving richer search/discover payloads untouched
+    """
+    conn.executemany(EXPORT_UPSERT_SQL, (
+        (tmdb_id, title, title, popularity,
+         json.dumps({"id": tmdb_id, "title": title, "original_title": title, "popularity": popularity}))
+        for tmdb_id, title, popularity in rows
+    ))
+
+
+def bulk_connection():
+    """
+    Open a dedicated connection tuned for large batched writes
+    """
+    conn = sqlite3.connect(TITLE_INDEX_DB)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")
+    return conn
+
+
+def import_reviewed_movies(movies_db=MOVIES_REVIEWS_DB):
+    """
+    param: movies_db:- Path to the CLI's movies.db
+    Add titles users have reviewed, unenriched, without overwriting richer
+    TMDB entries
+    """
+    if not os.path.exists(movies_db):
+        return 0
+    with sqlite3.connect(movies_db) as source:
+        try:
+            rows = source.execute("SELECT tmdb_id, title, release_year FROM movies").fetchall()
+        except sqlite3.OperationalError:
+            return 0
+
+    conn = _connect()
+    with metrics.time_query("title_index", "import_reviewed"):
+        with conn:
+            conn.executemany("""
+                INSERT OR IGNORE INTO titles (tmdb_id, title, release_date, payload, enriched)
+                VALUES (?, ?, ?, ?, 0)
+            """, [(tmdb_id, title, str(year) if year else None,
+                   json.dumps({"id": tmdb_id, "title": title, "release_date": str(year) if year else ""}))
+                  for tmdb_id, title, year in rows])
+    return len(rows)
+
+
+def _fts_phrase(query):
+    return '"' + query.replace('"', '""') + '"'
+
+
+def search_local(query, limit=20):
+    """
+    param: query:- Title search text
+    param: limit:- Maximum number of results
+    Return indexed TMDB result dicts matching the query, most popular first
+    """
+    normalized = _normalize(query)
+    if len(normalized) < MIN_QUERY_LENGTH:
+        return []
+    conn = _connect()
+    with metrics.time_query("title_index", "search"):
+        rows = conn.execute("""
+            SELECT titles.payload
+            FROM titles_fts
+            JOIN titles ON titles.tmdb_id = titles_fts.rowid
+            WHERE titles_fts MATCH ? AND titles.enriched = 1
+            ORDER BY titles.popularity DESC
+            LIMIT ?
+        """, (_fts_phrase(normalized), limit)).fetchall()
+    return [json.loads(payload) for (payload,) in rows]
+
+
+def genre_ids(tmdb_ids):
+    """
+    param: tmdb_ids:- TMDB movie ids
+    Return {tmdb_id: [genre ids]} for indexed movies whose payload lists genres
+    """
+    tmdb_ids = list(tmdb_ids)
+    if not tmdb_ids:
+        return {}
+    placeholders = ",".join("?" * len(tmdb_ids))
+    rows = _connect().execute(f"SELECT tmdb_id, payload FROM titles WHERE tmdb_id IN ({placeholders})",
+                              tmdb_ids).fetchall()
+    genres = {}
+    for tmdb_id, payload in rows:
+        payload = json.loads(payload)
+        # Detail payloads list {"id", "name"} genres instead of genre_ids
+        ids = payload.get("genre_ids") or [genre["id"] for genre in payload.get("genres") or []]
+        if ids:
+            genres[tmdb_id] = ids
+    return genres
+
+
+def _payloads(conn, tmdb_ids):
+    placeholders = ",".join("?" * len(tmdb_ids))
+    rows = conn.execute(f"SELECT tmdb_id, payload FROM titles WHERE tmdb_id IN ({placeholders}) AND enriched = 1",
+                        tmdb_ids).fetchall()
+    return dict(rows)
+
+
+def searched_results(query, limit=20):
+    """
+    param: query:- Title search text
+    param: limit:- Maximum number of results
+    Return TMDB's results for a query fetched within TITLE_SEARCH_TTL, in
+    TMDB's order, or None if it wasn't
+    """
+    conn = _connect()
+    row = conn.execute("SELECT searched_at, tmdb_ids FROM searched_queries WHERE query = ?",
+                       (_normalize(query),)).fetchone()
+    if row is None or row[1] is None or time.time() - row[0] >= TITLE_SEARCH_TTL:
+        return None
+    tmdb_ids = json.loads(row[1])[:limit]
+    if not tmdb_ids:
+        return []
+    payloads = _payloads(conn, tmdb_ids)
+    return [json.loads(payloads[tmdb_id]) for tmdb_id in tmdb_ids if tmdb_id in payloads]
+
+
+def exact_matches(query, limit=20):
+    """
+    param: query:- Title search text
+    param: limit:- Maximum number of results
+    Return indexed movies whose title equals the query (ignoring case and
+    extra whitespace), most popular first
+    """
+    normalized = _normalize(query)
+    if not normalized:
+        return []
+    with metrics.time_query("title_index", "exact"):
+        rows = _connect().execute("""
+            SELECT payload FROM titles
+            WHERE title = ? COLLATE NOCASE AND enriched = 1
+            ORDER BY popularity DESC
+            LIMIT ?
+        """, (normalized, limit)).fetchall()
+    return [json.loads(payload) for (payload,) in rows]
+
+
+def search_offline(query, limit=20):
+    """
+    param: query:- Title search text
+    param: limit:- Maximum number of results
+    Return local matches with exact title matches first, for answering
+    without TMDB
+    """
+    results = exact_matches(query, limit)
+    seen = {movie["id"] for movie in results}
+    results += [movie for movie in search_local(query, limit) if movie["id"] not in seen]
+    return results[:limit]
+
+
+def search(query, fetch_remote, limit=20):
+    """
+    param: query:- Title search text
+    param: fetch_remote:- Callable(query) returning TMDB results on a local miss
+    param: limit:- Maximum number of results
+    Answer from the local index when it can, otherwise fetch and merge
+    """
+    results = searched_results(query, limit)
+    if results is None and exact_matches(query, 1):
+        results = search_offline(query, limit)
+    if results:
+        metrics.record_cache("title_index", True)
+        return results
+
+    metrics.record_cache("title_index", False)
+    remote = fetch_remote(query)
+    if remote:
+        add_movies(remote, query=query)
+        logger.debug("Indexed TMDB results", extra={"query": query, "results": len(remote)})
+    # Partial local matches are still better than nothing if TMDB has none
+    return remote or search_offline(query, limit)
@@ -0,0 +1,288 @@
+"""
+Lightweight distributed tracing with W3C traceparent propagation.
+
+Spans are kept in a context variable, so nested start_span() calls form a
+tree and upstream.request() copies the active span into the `traceparent`
+header of every outbound call. Finished spans go to the exporter picked by
+TRACE_EXPORTER:
+ - memory (default): the last TRACE_MEMORY_LIMIT spans, served on /traces
+ - file: one JSON object per line appended to TRACE_FILE (default traces.jsonl)
+ - none: spans are dropped
+
+Pointing every process at the same TRACE_FILE collects whole traces without
+any external backend. `python tracing.py show traces.jsonl [trace_id]`
+prints them as trees.
+"""
+import contextvars
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+SERVICE_NAME = "unknown"
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, kind="internal", attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.service = SERVICE_NAME
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.start = time.time()
+        self.end = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "kind": self.kind,
+            "service": self.service,
+            "start": self.start,
+            "duration_ms": round((self.end - self.start) * 1000, 3) if self.end else None,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class InMemoryExporter:
+    def __init__(self, limit):
+        self._spans = deque(maxlen=limit)
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self._spans.append(span.to_dict())
+
+    def spans(self, trace_id=None):
+        with self._lock:
+            spans = list(self._spans)
+        if trace_id:
+            spans = [s for s in spans if s["trace_id"] == trace_id]
+        return spans
+
+
+class FileExporter:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict()) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    def spans(self, trace_id=None):
+        return [s for s in load_spans(self.path) if not trace_id or s["trace_id"] == trace_id]
+
+
+class NullExporter:
+    def export(self, span):
+        pass
+
+    def spans(self, trace_id=None):
+        return []
+
+
+def _build_exporter():
+    kind = os.getenv("TRACE_EXPORTER", "memory").lower()
+    if kind == "file":
+        return FileExporter(os.getenv("TRACE_FILE", "traces.jsonl"))
+    if kind == "none":
+        return NullExporter()
+    return InMemoryExporter(int(os.getenv("TRACE_MEMORY_LIMIT", "5000")))
+
+
+exporter = _build_exporter()
+
+
+def parse_traceparent(header):
+    """
+    param: header:- Value of an incoming traceparent header
+    Return (trace_id, parent_span_id) or None if the header is malformed
+    """
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    trace_id, span_id = parts[1].lower(), parts[2].lower()
+    try:
+        int(trace_id, 16), int(span_id, 16)
+    except ValueError:
+        return None
+    if trace_id == "0" * 32 or span_id == "0" * 16:
+        return None
+    return trace_id, span_id
+
+
+def current_span():
+    return _current_span.get()
+
+
+@contextmanager
+def start_span(name, kind="internal", attributes=None, traceparent=None):
+    """
+    param: name:- Span name, e.g. "GET /movies" or "sqlite fetch_reviews"
+    param: kind:- "server", "client" or "internal"
+    param: attributes:- Initial span attributes
+    param: traceparent:- Remote parent header; only used when no span is active
+    Start a child of the active span (or a new trace) and make it current
+    """
+    parent = _current_span.get()
+    remote = parse_traceparent(traceparent) if parent is None else None
+    if parent is not None:
+        span = Span(name, parent.trace_id, parent.span_id, kind, attributes)
+    elif remote:
+        span = Span(name, remote[0], remote[1], kind, attributes)
+    else:
+        span = Span(name, secrets.token_hex(16), None, kind, attributes)
+
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.status = "error"
+        span.set_attribute("error", repr(e))
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end = time.time()
+        exporter.export(span)
+
+
+def inject(headers=None):
+    """
+    param: headers:- Outgoing header dict (created if None)
+    Add the active span's traceparent to the headers
+    """
+    headers = dict(headers or {})
+    span = _current_span.get()
+    if span is not None:
+        headers["traceparent"] = span.traceparent()
+    return headers
+
+
+def configure(service_name):
+    """
+    param: service_name:- Name recorded on every span from this process
+    """
+    global SERVICE_NAME
+    SERVICE_NAME = service_name
+
+
+def instrument_app(app, service_name):
+    """
+    param: app:- The service's Flask app
+    param: service_name:- Name recorded on every span from this process
+    Open a server span per request (continuing any incoming traceparent)
+    and add /traces for inspecting the in-memory collector
+    """
+    from flask import g, jsonify, request
+
+    configure(service_name)
+
+    @app.before_request
+    def _start_trace():
+        manager = start_span(f"{request.method} {request.path}", kind="server",
+                             traceparent=request.headers.get("traceparent"))
+        g._trace_manager = manager
+        g._trace_span = manager.__enter__()
+
+    @app.after_request
+    def _tag_trace(response):
+        span = g.get("_trace_span")
+        if span is not None:
+            span.set_attribute("http.status_code", response.status_code)
+            if request.url_rule:
+                span.set_attribute("http.route", request.url_rule.rule)
+            if response.status_code >= 500:
+                span.status = "error"
+            response.headers["traceparent"] = span.traceparent()
+        return response
+
+    @app.teardown_request
+    def _end_trace(error=None):
+        manager = g.pop("_trace_manager", None)
+        g.pop("_trace_span", None)
+        if manager is not None:
+            if error is not None:
+                manager.__exit__(type(error), error, error.__traceback__)
+            else:
+                manager.__exit__(None, None, None)
+
+    @app.route("/traces", methods=["GET"])
+    def traces():
+        return jsonify(exporter.spans(request.args.get("trace_id")))
+
+    return app
+
+
+def load_spans(path):
+    spans = []
+    if not os.path.exists(path):
+        return spans
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                spans.append(json.loads(line))
+    return spans
+
+
+def format_trace(spans):
+    """
+    param: spans:- Span dicts belonging to a single trace
+    Render the spans as an indented tree ordered by start time
+    """
+    children = {}
+    ids = {s["span_id"] for s in spans}
+    for span in sorted(spans, key=lambda s: s["start"]):
+        parent = span["parent_id"] if span["parent_id"] in ids else None
+        children.setdefault(parent, []).append(span)
+
+    lines = []
+
+    def walk(parent, depth):
+        for span in children.get(parent, []):
+            lines.append(f"{'  ' * depth}{span['service']}: {span['name']} "
+                         f"{span['duration_ms']}ms [{span['status']}]")
+            walk(span["span_id"], depth + 1)
+
+    walk(None, 0)
+    return "\n".join(lines)
+
+
+def main(argv):
+    if len(argv) < 2 or argv[0] != "show":
+        print("usage: python tracing.py show <traces.jsonl> [trace_id]")
+        return 1
+    spans = load_spans(argv[1])
+    trace_ids = [argv[2]] if len(argv) > 2 else list(dict.fromkeys(s["trace_id"] for s in spans))
+    for trace_id in trace_ids:
+        print(f"trace {trace_id}")
+        print(format_trace([s for s in spans if s["trace_id"] == trace_id]))
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
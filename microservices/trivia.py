@@ -2,13 +2,31 @@ from flask import Flask, jsonify, request
 import random
 import sqlite3
 import os
-import requests
 from dotenv import load_dotenv
 import html
+import logging
+import requests
+import circuit_breaker
+import deadline
+import metrics
+import profiling
+import rate_budget
+import responses
+import tracing
+import upstream
+from service_logging import get_logger
 
 load_dotenv()
 
 app = Flask(__name__)
+metrics.instrument_app(app, "trivia")
+tracing.instrument_app(app, "trivia")
+profiling.instrument_app(app, "trivia")
+rate_budget.install_admission(app)
+deadline.install(app)
+circuit_breaker.install_handler(app)
+responses.install_compression(app)
+logger = get_logger("trivia")
 TRIVIA_API_KEY = os.getenv("TRIVIA_API_KEY")
 if not TRIVIA_API_KEY:
     raise ValueError("API key is missing! Set the API key in the .env file.")
@@ -30,9 +48,15 @@ def init_db():
 init_db()
 
 def fetch_trivia_from_api():
-    response = requests.get(TRIVIA_API_KEY)
+    try:
+        response = upstream.get("trivia_api", "/api.php", TRIVIA_API_KEY)
+    except requests.RequestException as e:
+        # Questions already in trivia.db keep being served
+        logger.warning("Trivia API unavailable", extra={"error": repr(e)})
+        return []
     if response.status_code == 200:
         return response.json().get("results", [])
+    logger.warning("Trivia API request failed", extra={"status": response.status_code})
     return []
 
 def cache_questions():
@@ -40,25 +64,28 @@ def cache_questions():
     conn = sqlite3.connect("trivia.db")
     cursor = conn.cursor()
 
-    for item in trivia_data:
-        normalized_question = html.unescape(item["question"]).strip()
-        cursor.execute("""
-            INSERT INTO trivia (question, correct_answer, incorrect_answers)
-            SELECT ?, ?, ?
-            WHERE NOT EXISTS (
-                SELECT 1 FROM trivia WHERE LOWER(TRIM(question)) = ?
-            )  
-        """, (normalized_question, item["correct_answer"], "|".join(item["incorrect_answers"]), normalized_question))
-    
-    conn.commit()
+    with metrics.time_query("trivia", "cache_questions"):
+        for item in trivia_data:
+            normalized_question = html.unescape(item["question"]).strip()
+            cursor.execute("""
+                INSERT INTO trivia (question, correct_answer, incorrect_answers)
+                SELECT ?, ?, ?
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM trivia WHERE LOWER(TRIM(question)) = ?
+                )  
+            """, (normalized_question, item["correct_answer"], "|".join(item["incorrect_answers"]), normalized_question))
+        
+        conn.commit()
     conn.close()
+    logger.info("Cached trivia questions", extra={"fetched": len(trivia_data)})
 
 @app.route("/trivia/random", methods=['GET'])
 def get_random_trivia():
     conn = sqlite3.connect("trivia.db")
     cursor = conn.cursor()
-    cursor.execute("SELECT question, correct_answer, incorrect_answers FROM trivia ORDER BY RANDOM() LIMIT 1")
-    result = cursor.fetchone()
+    with metrics.time_query("trivia", "random_question"):
+        cursor.execute("SELECT question, correct_answer, incorrect_answers FROM trivia ORDER BY RANDOM() LIMIT 1")
+        result = cursor.fetchone()
     conn.close()
     
     if result:
@@ -79,14 +106,16 @@ def get_random_trivia():
             "correct_answer": correct_answer
         })
     else:
+        logger.warning("Trivia table is empty")
         return jsonify({"Error": "No trivia found, please reload cache"})
     
 @app.route("/trivia/cache", methods=['GET'])
 def get_cached_questions():
     conn = sqlite3.connect("trivia.db")
     cursor = conn.cursor()
-    cursor.execute("SELECT question FROM trivia")
-    questions = cursor.fetchall()
+    with metrics.time_query("trivia", "all_questions"):
+        cursor.execute("SELECT question FROM trivia")
+        questions = cursor.fetchall()
     conn.close()
     return jsonify({"cached_questions": [q[0] for q in questions]})
 
@@ -99,38 +128,29 @@ def check_answer():
     conn = sqlite3.connect("trivia.db")
     cursor = conn.cursor()
 
-    
-
-    cursor.execute("SELECT question, correct_answer FROM trivia")
-    all_questions = cursor.fetchall()
-
-    """
-    print("DEBUG: Stored Questions in DB:")
-    for q in all_questions:
-        print(f" - {html.unescape(q[0]).strip()}")
-"""
-
-    cursor.execute("SELECT question, COUNT(*) FROM trivia GROUP BY question HAVING COUNT(*) > 1")
-    duplicates = cursor.fetchall()
-    print("DEBUG: Duplicate Questions in DB:")
-    for dup in duplicates:
-        print(f"- '{dup[0]}' appears {dup[1]} times")
+    # The duplicate scan reads the whole table, so only run it when debugging
+    if logger.isEnabledFor(logging.DEBUG):
+        with metrics.time_query("trivia", "duplicate_questions"):
+            cursor.execute("SELECT question, COUNT(*) FROM trivia GROUP BY question HAVING COUNT(*) > 1")
+            duplicates = cursor.fetchall()
+        for dup in duplicates:
+            logger.debug("Duplicate question in DB", extra={"question": dup[0], "count": dup[1]})
 
     normalized_question = html.unescape(question).strip().lower()
 
-    cursor.execute("SELECT correct_answer FROM trivia WHERE LOWER(TRIM(question)) = ?", (normalized_question,))
-    result = cursor.fetchone()
+    with metrics.time_query("trivia", "answer_lookup"):
+        cursor.execute("SELECT correct_answer FROM trivia WHERE LOWER(TRIM(question)) = ?", (normalized_question,))
+        result = cursor.fetchone()
     conn.close()
 
-    print(f"Result: {result}")
-
     if result:
         correct_answer = html.unescape(result[0].strip())  # Normalize stored answer
-        print(f"Comparing: '{correct_answer.lower()}' vs '{user_answer.lower()}'")  # Debugging
+        logger.debug("Comparing answers", extra={"expected": correct_answer.lower(), "given": user_answer.lower()})
 
         correct = result[0].strip().lower() == user_answer.strip().lower()
         return jsonify({"correct": correct}), 200
     else:
+        logger.info("Question not found", extra={"question": normalized_question})
         return jsonify({"Error": "Question not found"}), 404
 
 def run_trivia_service():
@@ -0,0 +1,93 @@
+"""
+Single entry point for outbound HTTP calls (TMDB and the other microservices).
+
+Routing every `requests` call through here keeps upstream latency and error
+counts in one place instead of scattered around each service, and gives each
+call a client span whose traceparent is forwarded to the callee. Calls to
+budgeted upstreams (TMDB) first take a token from the shared rate budget.
+Each upstream has a circuit breaker, and calls without an explicit timeout
+get (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT), shortened to whatever
+is left of the request's deadline (see deadline.py). Calls to the
+INTERNAL_UPSTREAMS pass that deadline on.
+"""
+import os
+import requests
+import circuit_breaker
+import deadline
+import metrics
+import rate_budget
+import tracing
+
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3.05"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "10"))
+# The microservices, which honour the deadline header (see deadline.install)
+INTERNAL_UPSTREAMS = {"movie_search", "recommendation", "trivia", "where_to_watch"}
+
+
+def request(upstream, endpoint, method, url, **kwargs):
+    """
+    param: upstream:- Name of the remote system ("tmdb", "movie_search", ...)
+    param: endpoint:- Templated path used as the metrics label, e.g. "/movie/{id}"
+    param: method:- HTTP method
+    param: url:- Full URL to call
+    Perform the call with `requests` and record its latency and status.
+    Raises rate_budget.RateBudgetExceeded when no TMDB token is available in
+    time, circuit_breaker.CircuitOpen when the upstream's circuit is open and
+    deadline.DeadlineExceeded when the request's deadline runs out; all are
+    requests.RequestException subclasses.
+    """
+    attributes = {"upstream": upstream, "http.method": method, "http.endpoint": endpoint,
+                  "priority": rate_budget.current_priority()}
+    deadline.check()
+    timeout = kwargs.get("timeout", (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+    breaker = circuit_breaker.get(upstream)
+    with tracing.start_span(f"{method} {upstream} {endpoint}", kind="client", attributes=attributes) as span:
+        breaker.allow()
+        # Set once the call's outcome is recorded; any other exit gives the reservation back
+        recorded = False
+        try:
+            rate_budget.acquire(upstream)
+            kwargs["headers"] = tracing.inject(kwargs.get("headers"))
+            # Capped after the token wait, which may have used up the deadline (cap_timeout then
+            # raises); a timeout the deadline cut short says nothing about the upstream
+            kwargs["timeout"] = deadline.cap_timeout(timeout)
+            if upstream in INTERNAL_UPSTREAMS:
+                kwargs["headers"] = deadline.inject(kwargs["headers"])
+            cut_short = kwargs["timeout"] != timeout
+            try:
+                with metrics.time_upstream(upstream, endpoint) as timer:
+                    response = requests.request(method, url, **kwargs)
+                    timer.status = response.status_code
+            except requests.Timeout as e:
+                if cut_short:
+                    raise deadline.DeadlineExceeded(f"Request deadline exceeded calling {upstream}") from e
+                recorded = True
+                breaker.record_failure()
+                raise
+            except requests.RequestException:
+                recorded = True
+                breaker.record_failure()
+                raise
+            if response.headers.get(deadline.EXCEEDED_HEADER):
+                # The callee gave up at the deadline passed on to it
+                raise deadline.DeadlineExceeded(f"Request deadline exceeded in {upstream}")
+            recorded = True
+            if circuit_breaker.is_failure(response.status_code):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        finally:
+            if not recorded:
+                breaker.release()
+        span.set_attribute("http.status_code", response.status_code)
+        if response.status_code >= 500:
+            span.status = "error"
+    return response
+
+
+def get(upstream, endpoint, url, **kwargs):
+    return request(upstream, endpoint, "GET", url, **kwargs)
+
+
+def post(upstream, endpoint, url, **kwargs):
+    return request(upstream, endpoint, "POST", url, **kwargs)
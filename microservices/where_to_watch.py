@@ -1,18 +1,62 @@
 from flask import Flask, jsonify, request
-import requests
 import sqlite3
 import os
+import threading
+import time
+import contextvars
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+import requests
+import cache_backend
+import circuit_breaker
+import deadline
+import metrics
+import profiling
+import rate_budget
+import responses
+import tracing
+import upstream
+from service_logging import get_logger
 
 load_dotenv()
 app = Flask(__name__)
+metrics.instrument_app(app, "where_to_watch")
+tracing.instrument_app(app, "where_to_watch")
+profiling.instrument_app(app, "where_to_watch")
+rate_budget.install_admission(app)
+deadline.install(app)
+circuit_breaker.install_handler(app)
+responses.install_compression(app)
+logger = get_logger("where_to_watch")
 
 TMDB_API_KEY = os.getenv("TMDB_API_KEY")
 TMDB_BASE_URL = "https://api.themoviedb.org/3"
+WHERE_TO_WATCH_DB = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "where_to_watch.db"))
+
+PROVIDER_TTL_HOURS = float(os.getenv("PROVIDER_TTL_HOURS", "24"))
+# The sweeper refreshes entries this long before they expire
+PROVIDER_REFRESH_AHEAD_HOURS = float(os.getenv("PROVIDER_REFRESH_AHEAD_HOURS", "2"))
+# Entries nobody asked for within this window are left to expire
+PROVIDER_SWEEP_IDLE_DAYS = float(os.getenv("PROVIDER_SWEEP_IDLE_DAYS", "30"))
+PROVIDER_SWEEP_INTERVAL = float(os.getenv("PROVIDER_SWEEP_INTERVAL", "300"))
+PROVIDER_SWEEP_BATCH = int(os.getenv("PROVIDER_SWEEP_BATCH", "50"))
+PROVIDER_REFRESH_WORKERS = int(os.getenv("PROVIDER_REFRESH_WORKERS", "4"))
+MAX_BULK_REFRESH = 100
+# A bulk refresh answers after this long; refreshes still running are reported as pending
+BULK_REFRESH_TIMEOUT = float(os.getenv("BULK_REFRESH_TIMEOUT", "20"))
+
+PROVIDER_REFRESHES = metrics.register(metrics.Counter(
+    "provider_refreshes_total",
+    "Watch provider refreshes by trigger and outcome",
+    ("service", "trigger", "outcome"),
+))
+
+def _connect():
+    return sqlite3.connect(WHERE_TO_WATCH_DB, timeout=5)
 
 def init_db():
-    conn = sqlite3.connect("where_to_watch.db")
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("""
        CREATE TABLE IF NOT EXISTS watch_providers (
@@ -22,77 +66,267 @@ def init_db():
             last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )                                             
     """)
+    # Request frequency drives which entries the sweeper refreshes first
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(watch_providers)")}
+    if "request_count" not in columns:
+        cursor.execute("ALTER TABLE watch_providers ADD COLUMN request_count INTEGER NOT NULL DEFAULT 0")
+    if "last_requested" not in columns:
+        cursor.execute("ALTER TABLE watch_providers ADD COLUMN last_requested TIMESTAMP")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_watch_providers_last_updated ON watch_providers (last_updated)")
     conn.commit()
     conn.close()
-    print("Database initialized!")
+    logger.info("Database initialized")
 
 init_db()
 
+# Hot lookups skip SQLite; shared across workers when CACHE_BACKEND is sqlite or redis
+provider_cache = cache_backend.get_cache("watch_providers", default_ttl=PROVIDER_TTL_HOURS * 3600)
+
 def get_watch_providers(movie_id):
+    """
+    param: movie_id:- TMDB movie id
+    Fetch US streaming providers from TMDB; raises requests.RequestException
+    when TMDB is unavailable
+    """
     url = f"{TMDB_BASE_URL}/movie/{movie_id}/watch/providers?api_key={TMDB_API_KEY}"
-    response = requests.get(url).json()
-    providers = response.get("results", {}).get("US", {}).get("flatrate", [])
+    response = upstream.get("tmdb", "/movie/{id}/watch/providers", url)
+    if response.status_code == 404:
+        return []
+    response.raise_for_status()
+    providers = response.json().get("results", {}).get("US", {}).get("flatrate", [])
     return [p["provider_name"] for p in providers] if providers else []
 
 def cache_watch_providers(movie_id, title, services):
-    conn = sqlite3.connect("where_to_watch.db")
+    conn = _connect()
     cursor = conn.cursor()
-    cursor.execute("""
-        INSERT OR REPLACE INTO watch_providers (movie_id, title, services, last_updated)
-        VALUES (?, ?, ?, datetime('now'))                  
-    """, (movie_id, title, "|".join(services)))
-    conn.commit()
+    with metrics.time_query("where_to_watch", "upsert_providers"):
+        # Titles are unique; like the old INSERT OR REPLACE, the newer movie wins
+        cursor.execute("DELETE FROM watch_providers WHERE title = ? AND movie_id != ?", (title, movie_id))
+        # Empty answers are stored too, so titles with no providers don't hit TMDB every time
+        cursor.execute("""
+            INSERT INTO watch_providers (movie_id, title, services, last_updated)
+            VALUES (?, ?, ?, datetime('now'))
+            ON CONFLICT (movie_id) DO UPDATE SET
+                title = excluded.title, services = excluded.services, last_updated = excluded.last_updated
+        """, (movie_id, title, "|".join(services)))
+        conn.commit()
     conn.close()
 
-def get_cached_watch_provider(movie_id):
-    conn = sqlite3.connect("where_to_watch.db")
+def get_stored_watch_providers(movie_id):
+    """
+    param: movie_id:- TMDB movie id
+    Return (services, title, fresh_for) from where_to_watch.db, or None;
+    fresh_for is the seconds left of the entry's TTL (0 or less once expired)
+    """
+    conn = _connect()
     cursor = conn.cursor()
-    cursor.execute("SELECT services FROM watch_providers WHERE movie_id = ?", (movie_id,))
-    result = cursor.fetchone()
+    with metrics.time_query("where_to_watch", "select_services"):
+        cursor.execute("""
+            SELECT services, title, (julianday(last_updated) - julianday('now')) * 86400 + ?
+            FROM watch_providers WHERE movie_id = ?
+        """, (PROVIDER_TTL_HOURS * 3600, movie_id))
+        result = cursor.fetchone()
     conn.close()
-    return result[0].split("|") if result else None
-    
-def should_refresh_cache(movie_id):
-    conn = sqlite3.connect("where_to_watch.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT last_updated FROM watch_providers WHERE movie_id = ?", (movie_id,))
-    result = cursor.fetchone()
-    conn.close()
-
     if not result:
-        return True
-    
-    last_updated = datetime.strptime(result[0], "%Y-%m-%d %H:%M:%S")
-    return last_updated < datetime.now() - timedelta(hours=24)
-    
+        return None
+    services, title, fresh_for = result
+    return (services.split("|") if services else []), title, fresh_for or 0
+
+def refresh_providers(movie_id, title, trigger):
+    """
+    param: movie_id:- TMDB movie id
+    param: title:- Title stored alongside the providers
+    param: trigger:- Metrics label: "request", "sweep" or "manual"
+    Fetch providers from TMDB and update where_to_watch.db and the cache
+    """
+    try:
+        services = get_watch_providers(movie_id)
+    except requests.RequestException:
+        PROVIDER_REFRESHES.inc(metrics.SERVICE_NAME, trigger, "failed")
+        raise
+    cache_watch_providers(movie_id, title, services)
+    provider_cache.set(movie_id, services)
+    PROVIDER_REFRESHES.inc(metrics.SERVICE_NAME, trigger, "refreshed")
+    return services
+
+
+class ProviderSweeper:
+    """
+    Keeps where_to_watch.db fresh ahead of user requests.
+
+    Lookups are counted in memory and flushed to request_count/last_requested
+    on each sweep. Every PROVIDER_SWEEP_INTERVAL seconds the sweeper takes up
+    to PROVIDER_SWEEP_BATCH recently requested entries that expire within
+    PROVIDER_REFRESH_AHEAD_HOURS, most requested first, and refreshes them on
+    PROVIDER_REFRESH_WORKERS threads at background priority. Expired entries
+    hit by a request are served as-is and refreshed on the same pool.
+    """
+
+    def __init__(self, workers=PROVIDER_REFRESH_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="provider-refresh")
+        self._requests = Counter()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def record_request(self, movie_id):
+        with self._lock:
+            self._requests[int(movie_id)] += 1
+
+    def _flush_requests(self):
+        with self._lock:
+            counts, self._requests = self._requests, Counter()
+        if not counts:
+            return
+        conn = _connect()
+        with conn:
+            with metrics.time_query("where_to_watch", "record_requests"):
+                conn.executemany("""
+                    UPDATE watch_providers
+                    SET request_count = request_count + ?, last_requested = datetime('now')
+                    WHERE movie_id = ?
+                """, [(count, movie_id) for movie_id, count in counts.items()])
+        conn.close()
+
+    def _due(self, limit):
+        conn = _connect()
+        with metrics.time_query("where_to_watch", "select_due"):
+            rows = conn.execute("""
+                SELECT movie_id, title FROM watch_providers
+                WHERE last_updated < datetime('now', ?)
+                  AND last_requested >= datetime('now', ?)
+                ORDER BY request_count DESC, last_updated
+                LIMIT ?
+            """, (f"-{PROVIDER_TTL_HOURS - PROVIDER_REFRESH_AHEAD_HOURS} hours",
+                  f"-{PROVIDER_SWEEP_IDLE_DAYS} days", limit)).fetchall()
+        conn.close()
+        return rows
+
+    def _refresh(self, movie_id, title, trigger):
+        try:
+            with rate_budget.priority(rate_budget.BACKGROUND):
+                return refresh_providers(movie_id, title, trigger)
+        except requests.RequestException as e:
+            logger.debug("Provider refresh failed", extra={"movie_id": movie_id, "error": repr(e)})
+            return None
+        finally:
+            with self._lock:
+                self._in_flight.discard(movie_id)
+
+    def submit(self, movie_id, title, trigger="request"):
+        """Refresh one entry in the background unless it is already being refreshed"""
+        movie_id = int(movie_id)
+        with self._lock:
+            if movie_id in self._in_flight:
+                return None
+            self._in_flight.add(movie_id)
+        # A fresh context: the refresh outlives the request, so it must not inherit its
+        # deadline or its (soon finished) trace span
+        return self._executor.submit(contextvars.Context().run, self._refresh, movie_id, title, trigger)
+
+    def sweep(self):
+        """Run one sweep; return the number of entries refreshed"""
+        self._flush_requests()
+        due = self._due(PROVIDER_SWEEP_BATCH)
+        futures = [f for f in (self.submit(movie_id, title, "sweep") for movie_id, title in due) if f]
+        refreshed = sum(1 for future in futures if future.result() is not None)
+        if due:
+            logger.info("Provider sweep finished", extra={"due": len(due), "refreshed": refreshed})
+        return refreshed
+
+    def _loop(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.warning("Provider sweep failed", extra={"error": repr(e)})
+            time.sleep(PROVIDER_SWEEP_INTERVAL)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="provider-sweeper", daemon=True)
+            self._thread.start()
+
+
+sweeper = ProviderSweeper()
+
 @app.route("/watch/<title>/<movie_id>", methods=["GET"])
 def where_to_watch(title, movie_id):
-    print(f"Received request: title={title}, movie_id={movie_id}")
-    if not movie_id:
+    logger.debug("Received request", extra={"title": title, "movie_id": movie_id})
+    if not movie_id.isdigit():
         return jsonify({"Error": "Movie not found"}), 404
+    sweeper.record_request(movie_id)
+
+    services = provider_cache.get(movie_id)
+    if services is not None:
+        return jsonify({"title": title, "services": services})
 
-    if not should_refresh_cache(movie_id):
-        return jsonify({"title": title, "services": get_cached_watch_provider(movie_id)})
-    
-    services = get_watch_providers(movie_id)
-    if services:
-        cache_watch_providers(movie_id, title, services)
+    stored = get_stored_watch_providers(movie_id)
+    metrics.record_cache("watch_providers_db", stored is not None and stored[2] > 0)
+    if stored is not None:
+        services, _, fresh_for = stored
+        if fresh_for > 0:
+            # Cached only for the rest of the row's TTL, so no answer outlives PROVIDER_TTL_HOURS
+            provider_cache.set(movie_id, services, ttl=fresh_for)
+            return jsonify({"title": title, "services": services})
+        # Serve the stored answer now and refresh it off the request path
+        sweeper.submit(movie_id, title)
+        if circuit_breaker.get("tmdb").state != circuit_breaker.CLOSED:
+            return jsonify({"title": title, "services": services, "stale": True}), 200, responses.stale_headers(True)
+        return jsonify({"title": title, "services": services})
 
+    services = refresh_providers(movie_id, title, "request")
     return jsonify({"title": title, "services": services})
 
-@app.route("/watch/<title>/refresh", methods=["GET"])
-def refresh_watch_providers(movie_id, title):
-    if not movie_id:
+@app.route("/watch/<title>/<movie_id>/refresh", methods=["GET", "POST"])
+def refresh_watch_providers(title, movie_id):
+    if not movie_id.isdigit():
         return jsonify({"Error": "Movie not found"}), 404
-    
-    services = get_watch_providers(movie_id)
-    if services:
-        cache_watch_providers(movie_id, title, services)
 
+    services = refresh_providers(movie_id, title, "manual")
     return jsonify({"title": title, "services": services, "status": "Refreshed"})
 
+@app.route("/watch/refresh", methods=["POST"])
+def bulk_refresh_watch_providers():
+    """
+    Refresh stored entries by id: {"movie_ids": [...]}. Ids that were never
+    looked up have no title to store and are reported as not found; refreshes
+    unfinished after BULK_REFRESH_TIMEOUT are reported as pending and carry
+    on in the background.
+    """
+    data = request.get_json(silent=True) or {}
+    movie_ids = data.get("movie_ids")
+    if not isinstance(movie_ids, list) or not movie_ids:
+        return jsonify({"Error": "movie_ids must be a non-empty list"}), 400
+    if len(movie_ids) > MAX_BULK_REFRESH:
+        return jsonify({"Error": f"At most {MAX_BULK_REFRESH} ids per request"}), 400
+
+    results = {}
+    futures = {}
+    for movie_id in movie_ids:
+        stored = get_stored_watch_providers(movie_id) if str(movie_id).isdigit() else None
+        if stored is None:
+            results[str(movie_id)] = {"status": "Not found"}
+            continue
+        future = sweeper.submit(movie_id, stored[1], "manual")
+        if future is None:
+            results[str(movie_id)] = {"status": "Already refreshing"}
+        else:
+            futures[str(movie_id)] = future
+
+    done, _ = wait(futures.values(), timeout=BULK_REFRESH_TIMEOUT)
+    for movie_id, future in futures.items():
+        if future not in done:
+            results[movie_id] = {"status": "Pending"}
+            continue
+        services = future.result()
+        results[movie_id] = ({"status": "Refreshed", "services": services} if services is not None
+                             else {"status": "Failed"})
+    return jsonify({"results": results})
+
 def run_where_to_watch_service():
+    sweeper.start()
     app.run(port=8082)
 
 if __name__ == "__main__":
-    run_where_to_watch_service() 
\ No newline at end of file
+    run_where_to_watch_service() 
@@ -0,0 +1,162 @@
+"""
+RedisCache against an in-process server speaking the Redis protocol (RESP2).
+
+usage: python -m pytest tests/test_cache_backend.py
+"""
+import os
+import socketserver
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "microservices"))
+import cache_backend
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    """Just enough of Redis for RedisCache: AUTH, SELECT, GET, SET [EX], DEL"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, password=None):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.password = password
+        self.data = {}
+        self.commands = []
+        self.connections = 0
+        # Set to make the server close the connection instead of answering the next command
+        self.drop_next = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        auth = f":{self.password}@" if self.password else ""
+        return f"redis://{auth}{host}:{port}/3"
+
+
+class StandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        authed = server.password is None
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            if server.drop_next.is_set():
+                server.drop_next.clear()
+                return
+            name = args[0].upper()
+            with server.lock:
+                server.commands.append([name] + args[1:])
+            if name == "AUTH":
+                authed = args[1] == server.password
+                self._write(b"+OK\r\n" if authed else b"-ERR invalid password\r\n")
+            elif not authed:
+                self._write(b"-NOAUTH Authentication required.\r\n")
+            elif name == "SELECT":
+                self._write(b"+OK\r\n")
+            elif name == "GET":
+                self._write_bulk(self._get(args[1]))
+            elif name == "SET":
+                expires = time.monotonic() + int(args[4]) if len(args) > 4 and args[3].upper() == "EX" else None
+                with server.lock:
+                    server.data[args[1]] = (args[2], expires)
+                self._write(b"+OK\r\n")
+            elif name == "DEL":
+                with server.lock:
+                    removed = server.data.pop(args[1], None) is not None
+                self._write(b":%d\r\n" % removed)
+            else:
+                self._write(b"-ERR unknown command\r\n")
+
+    def _get(self, key):
+        with self.server.lock:
+            value, expires = self.server.data.get(key, (None, None))
+            if expires is not None and expires <= time.monotonic():
+                del self.server.data[key]
+                return None
+        return value
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line or not line.startswith(b"*"):
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2].decode("utf-8"))
+        return args
+
+    def _write(self, data):
+        self.wfile.write(data)
+
+    def _write_bulk(self, value):
+        if value is None:
+            self._write(b"$-1\r\n")
+        else:
+            data = value.encode("utf-8")
+            self._write(b"$%d\r\n%s\r\n" % (len(data), data))
+
+
+class RedisCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer(password="secret")
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.cache = cache_backend.RedisCache(self.server.url, timeout=2)
+
+    def tearDown(self):
+        self.cache._reset()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_set_delete(self):
+        self.assertIsNone(self.cache.get("missing"))
+        self.cache.set("movie", {"id": 1, "title": "Her"})
+        self.assertEqual(self.cache.get("movie"), {"id": 1, "title": "Her"})
+        self.cache.delete("movie")
+        self.assertIsNone(self.cache.get("movie"))
+
+    def test_set_with_ttl_expires(self):
+        self.cache.set("short", [1, 2], ttl=0.2)
+        self.assertIn(["SET", "short", "[1, 2]", "EX", "1"], self.server.commands)
+        self.assertEqual(self.cache.get("short"), [1, 2])
+        time.sleep(1.1)
+        self.assertIsNone(self.cache.get("short"))
+
+    def test_handshake_authenticates_and_selects_db(self):
+        self.cache.get("anything")
+        self.assertEqual(self.server.commands[:2], [["AUTH", "secret"], ["SELECT", "3"]])
+
+    def test_wrong_password_is_an_error(self):
+        cache = cache_backend.RedisCache(self.server.url.replace("secret", "wrong"), timeout=2)
+        try:
+            with self.assertRaises(RuntimeError):
+                cache.get("anything")
+        finally:
+            cache._reset()
+
+    def test_reconnects_after_server_drops_connection(self):
+        self.cache.set("kept", "value")
+        self.server.drop_next.set()
+        with self.assertRaises(OSError):
+            self.cache.get("kept")
+        self.assertEqual(self.cache.get("kept"), "value")
+        self.assertEqual(self.server.connections, 2)
+        # The new connection repeats the handshake
+        self.assertEqual([c[0] for c in self.server.commands].count("AUTH"), 2)
+
+    def test_namespaced_cache_treats_dropped_connection_as_miss(self):
+        cache = cache_backend.NamespacedCache("genres", self.cache, default_ttl=60)
+        cache.set(18, ["Drama"])
+        self.server.drop_next.set()
+        self.assertIsNone(cache.get(18))
+        self.assertEqual(cache.get(18), ["Drama"])
+
+
+if __name__ == "__main__":
+    unittest.main()